@@ -4,6 +4,26 @@ import { Card, CardContent, CardHeader, CardTitle } from '@/components/ui/card';
 import { Progress } from '@/components/ui/progress';
 import { Upload, File, X, CheckCircle, AlertCircle } from 'lucide-react';
 
+// Tentativas por chunk antes de marcar o upload com erro
+const CHUNK_RETRIES = 3;
+// Tamanho das folhas da árvore de hash (igual ao servidor)
+const HASH_BLOCK_SIZE = 1024 * 1024;
+// Throughput medido no último upload (bytes/s), usado pelo servidor para escolher o chunk
+const THROUGHPUT_STORAGE_KEY = 'aiapad_upload_throughput';
+// Consulta do processamento (ingestão) após o upload
+const INGEST_POLL_INTERVAL = 2000;
+// Falhas seguidas na consulta antes de desistir
+const INGEST_POLL_RETRIES = 5;
+// Estágios da ingestão no servidor (ver ingest_pipeline.INGEST_STAGES)
+const INGEST_STAGE_LABELS = {
+  assemble: 'Montagem',
+  verify: 'Verificação',
+  store: 'Armazenamento',
+  validate: 'Validação',
+  metadata: 'Metadados',
+  derivatives: 'Derivados'
+};
+
 const SlideUpload = ({ onUploadComplete, onUploadStart }) => {
   const [isDragOver, setIsDragOver] = useState(false);
   const [uploadQueue, setUploadQueue] = useState([]);
@@ -72,7 +92,7 @@ const SlideUpload = ({ onUploadComplete, onUploadStart }) => {
         name: file.name,
         size: file.size,
         progress: 0,
-        status: 'pending', // pending, uploading, completed, error
+        status: 'pending', // pending, hashing, uploading, processing, completed, error, ingest_error
         error: null
       }));
 
@@ -85,72 +105,283 @@ const SlideUpload = ({ onUploadComplete, onUploadStart }) => {
     }
   };
 
+  const updateUploadItem = (id, changes) => {
+    setUploadQueue(prev => prev.map(item => 
+      item.id === id 
+        ? { ...item, ...changes }
+        : item
+    ));
+  };
+
+  const postJson = async (url, body) => {
+    const response = await fetch(url, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: body ? JSON.stringify(body) : undefined
+    });
+    const data = await response.json();
+    if (!response.ok) {
+      throw new Error(data.error || `Erro no upload: ${response.status}`);
+    }
+    return data;
+  };
+
+  const toHex = (bytes) => Array.from(bytes)
+    .map(b => b.toString(16).padStart(2, '0'))
+    .join('');
+
+  const sha256Hex = async (blob) => {
+    // crypto.subtle só existe em contextos seguros (HTTPS/localhost)
+    if (!window.crypto?.subtle) return null;
+    const digest = await window.crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return toHex(new Uint8Array(digest));
+  };
+
+  // Raiz da árvore de hash (folhas SHA-256 de 1MB), igual à calculada pelo servidor
+  const computeTreeHash = async (file, onProgress) => {
+    if (!window.crypto?.subtle) return null;
+    const subtle = window.crypto.subtle;
+
+    let level = [];
+    for (let offset = 0; offset < file.size; offset += HASH_BLOCK_SIZE) {
+      const block = await file.slice(offset, offset + HASH_BLOCK_SIZE).arrayBuffer();
+      level.push(new Uint8Array(await subtle.digest('SHA-256', block)));
+      onProgress(Math.round((Math.min(offset + HASH_BLOCK_SIZE, file.size) / file.size) * 100));
+    }
+    if (level.length === 0) {
+      return toHex(new Uint8Array(await subtle.digest('SHA-256', new ArrayBuffer(0))));
+    }
+
+    while (level.length > 1) {
+      const next = [];
+      for (let i = 0; i + 1 < level.length; i += 2) {
+        const pair = new Uint8Array(64);
+        pair.set(level[i]);
+        pair.set(level[i + 1], 32);
+        next.push(new Uint8Array(await subtle.digest('SHA-256', pair)));
+      }
+      if (level.length % 2) next.push(level[level.length - 1]);
+      level = next;
+    }
+    return toHex(level[0]);
+  };
+
+  // Conteúdo já existe no servidor: provar posse com o hash de um trecho do arquivo
+  const linkDuplicate = async (file, challenge) => {
+    const { token, offset, length } = challenge;
+    const rangeHash = await sha256Hex(file.slice(offset, offset + length));
+    return postJson('/api/upload/link', { token, range_hash: rangeHash });
+  };
+
+  const finishUpload = (uploadItem, response) => {
+    updateUploadItem(uploadItem.id, { status: 'completed', progress: 100, slideData: response });
+
+    if (onUploadComplete) {
+      onUploadComplete(response);
+    }
+  };
+
+  const stageLabel = (stage) => INGEST_STAGE_LABELS[stage] || stage;
+
+  // Consultar a ingestão até a lâmina sair de 'processing' (ready ou error)
+  const waitForIngest = async (itemId, ingestUrl) => {
+    let failures = 0;
+    for (;;) {
+      let data = {};
+      let ok = false;
+      try {
+        const response = await fetch(ingestUrl);
+        data = await response.json().catch(() => ({}));
+        ok = response.ok;
+      } catch (error) {
+        data = { error: error.message };
+      }
+
+      if (ok) {
+        failures = 0;
+        const stages = data.stages || [];
+        const done = stages.filter(stage => ['completed', 'skipped'].includes(stage.status)).length;
+        const current = stages.find(stage => ['running', 'failed'].includes(stage.status)) ||
+                        stages.find(stage => stage.status === 'pending');
+        updateUploadItem(itemId, {
+          progress: stages.length ? Math.round((done / stages.length) * 100) : 0,
+          ingestStage: current?.stage
+        });
+        if (data.status !== 'processing') return data;
+      } else if (++failures >= INGEST_POLL_RETRIES) {
+        throw new Error(data.error || 'Erro ao consultar o processamento');
+      }
+
+      await new Promise(resolve => setTimeout(resolve, INGEST_POLL_INTERVAL));
+    }
+  };
+
+  // Upload recebido (202): a lâmina só está disponível quando a ingestão termina
+  const followIngest = async (uploadItem, uploadId, response) => {
+    const ingestUrl = response.ingest_url || `/api/upload/${uploadId}/ingest`;
+    updateUploadItem(uploadItem.id, { status: 'processing', progress: 0, error: null, uploadId, ingestUrl });
+
+    const ingest = await waitForIngest(uploadItem.id, ingestUrl);
+    if (ingest.status === 'ready') {
+      finishUpload(uploadItem, { ...response, slide: ingest.slide });
+      return;
+    }
+
+    const failed = (ingest.stages || []).find(stage => stage.status === 'failed');
+    updateUploadItem(uploadItem.id, {
+      status: 'ingest_error',
+      error: failed
+        ? `${stageLabel(failed.stage)}: ${failed.error || 'falha no processamento'}`
+        : 'Falha no processamento da lâmina'
+    });
+  };
+
+  // Reexecutar a ingestão a partir do estágio que falhou (sem reenviar o arquivo)
+  const retryIngest = async (uploadItem) => {
+    try {
+      updateUploadItem(uploadItem.id, { status: 'processing', error: null });
+      const response = await postJson(`/api/upload/${uploadItem.uploadId}/ingest/retry`);
+      await followIngest(uploadItem, uploadItem.uploadId, { ...response, ingest_url: uploadItem.ingestUrl });
+    } catch (error) {
+      updateUploadItem(uploadItem.id, { status: 'ingest_error', error: error.message });
+    }
+  };
+
+  const sendChunk = async (uploadId, index, blob) => {
+    const chunkHash = await sha256Hex(blob);
+    let lastError = null;
+
+    for (let attempt = 0; attempt < CHUNK_RETRIES; attempt++) {
+      try {
+        const headers = { 'Content-Type': 'application/octet-stream' };
+        if (chunkHash) headers['X-Chunk-SHA256'] = chunkHash;
+
+        const response = await fetch(`/api/upload/${uploadId}/chunk/${index}`, {
+          method: 'POST',
+          headers,
+          body: blob
+        });
+        const data = await response.json().catch(() => ({}));
+        if (response.ok) return data;
+
+        // Estrutura do arquivo recusada pelo servidor: reenviar não adianta
+        if (response.status === 422) {
+          const error = new Error(data.error || 'Arquivo rejeitado');
+          error.rejected = true;
+          throw error;
+        }
+        lastError = new Error(data.error || `Erro no chunk ${index}: ${response.status}`);
+      } catch (error) {
+        if (error.rejected) throw error;
+        lastError = error;
+      }
+
+      // Espera crescente antes de reenviar apenas este chunk
+      await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+    }
+
+    throw lastError;
+  };
+
   const uploadFile = async (uploadItem) => {
     try {
       // Atualizar status para uploading
-      setUploadQueue(prev => prev.map(item => 
-        item.id === uploadItem.id 
-          ? { ...item, status: 'uploading', progress: 0 }
-          : item
-      ));
+      updateUploadItem(uploadItem.id, { status: 'uploading', error: null });
 
       if (onUploadStart) {
         onUploadStart(uploadItem);
       }
 
-      const formData = new FormData();
-      formData.append('file', uploadItem.file);
+      // Nova sessão, ou retomada enviando apenas os chunks que faltam
+      let session;
+      let pending;
+      if (uploadItem.uploadId) {
+        session = await postJson(`/api/upload/${uploadItem.uploadId}/resume`);
+        session.upload_id = uploadItem.uploadId;
+        pending = session.missing_chunks || [];
+      } else {
+        updateUploadItem(uploadItem.id, { status: 'hashing', progress: 0 });
+        const fileHash = await computeTreeHash(
+          uploadItem.file,
+          progress => updateUploadItem(uploadItem.id, { progress })
+        );
 
-      const xhr = new XMLHttpRequest();
+        const initBody = {
+          filename: uploadItem.file.name,
+          file_size: uploadItem.file.size,
+          file_hash: fileHash || undefined,
+          client_throughput: Number(localStorage.getItem(THROUGHPUT_STORAGE_KEY)) || undefined
+        };
+        session = await postJson('/api/upload/init', initBody);
 
-      // Monitorar progresso
-      xhr.upload.addEventListener('progress', (e) => {
-        if (e.lengthComputable) {
-          const progress = Math.round((e.loaded / e.total) * 100);
-          setUploadQueue(prev => prev.map(item => 
-            item.id === uploadItem.id 
-              ? { ...item, progress }
-              : item
-          ));
+        if (session.status === 'duplicate') {
+          try {
+            finishUpload(uploadItem, await linkDuplicate(uploadItem.file, session.dedup_challenge));
+            return;
+          } catch (error) {
+            // Arquivo removido no servidor entre o init e o link: enviar normalmente
+            session = await postJson('/api/upload/init', { ...initBody, deduplicate: false });
+          }
         }
-      });
 
-      // Configurar resposta
-      xhr.addEventListener('load', () => {
-        if (xhr.status === 201) {
-          const response = JSON.parse(xhr.responseText);
-          setUploadQueue(prev => prev.map(item => 
-            item.id === uploadItem.id 
-              ? { ...item, status: 'completed', progress: 100, slideData: response }
-              : item
-          ));
-          
-          if (onUploadComplete) {
-            onUploadComplete(response);
+        pending = Array.from({ length: session.total_chunks }, (_, i) => i);
+        updateUploadItem(uploadItem.id, { status: 'uploading' });
+        updateUploadItem(uploadItem.id, { uploadId: session.upload_id });
+      }
+
+      const chunkSize = session.chunk_size || uploadItem.chunkSize;
+      updateUploadItem(uploadItem.id, { chunkSize });
+
+      let completedChunks = session.total_chunks - pending.length;
+      const reportProgress = () => {
+        const progress = Math.round((completedChunks / session.total_chunks) * 100);
+        updateUploadItem(uploadItem.id, { progress });
+      };
+      reportProgress();
+
+      // Várias conexões simultâneas; chunks podem terminar fora de ordem
+      const parallel = Math.max(1, Math.min(session.max_parallel_chunks || 1, pending.length));
+      let next = 0;
+      const transferStart = performance.now();
+      let bytesSent = 0;
+      let aborted = false;
+      const worker = async () => {
+        while (!aborted && next < pending.length) {
+          const index = pending[next++];
+          const start = index * chunkSize;
+          const blob = uploadItem.file.slice(start, Math.min(start + chunkSize, uploadItem.file.size));
+          let result;
+          try {
+            result = await sendChunk(session.upload_id, index, blob);
+          } catch (error) {
+            aborted = true;
+            throw error;
+          }
+          bytesSent += blob.size;
+          completedChunks += 1;
+          reportProgress();
+
+          // Servidor aguarda um trecho para validar o formato (ex.: IFD no fim
+          // do arquivo): antecipar esse chunk na fila
+          const wanted = pending.indexOf(result.format_pending_chunk, next);
+          if (wanted > next) {
+            pending.splice(wanted, 1);
+            pending.splice(next, 0, result.format_pending_chunk);
           }
-        } else {
-          throw new Error(`Erro no upload: ${xhr.status}`);
         }
-      });
+      };
+      await Promise.all(Array.from({ length: parallel }, worker));
 
-      xhr.addEventListener('error', () => {
-        setUploadQueue(prev => prev.map(item => 
-          item.id === uploadItem.id 
-            ? { ...item, status: 'error', error: 'Erro de conexão' }
-            : item
-        ));
-      });
+      const transferSeconds = (performance.now() - transferStart) / 1000;
+      if (transferSeconds > 1) {
+        localStorage.setItem(THROUGHPUT_STORAGE_KEY, String(Math.round(bytesSent / transferSeconds)));
+      }
 
-      // Enviar requisição
-      xhr.open('POST', '/api/slides/upload');
-      xhr.send(formData);
+      const response = await postJson(`/api/upload/${session.upload_id}/complete`);
+      await followIngest(uploadItem, session.upload_id, response);
 
     } catch (error) {
-      setUploadQueue(prev => prev.map(item => 
-        item.id === uploadItem.id 
-          ? { ...item, status: 'error', error: error.message }
-          : item
-      ));
+      updateUploadItem(uploadItem.id, { status: 'error', error: error.message });
     }
   };
 
@@ -250,11 +481,23 @@ const SlideUpload = ({ onUploadComplete, onUploadStart }) => {
                         </Button>
                       </div>
                     )}
+                    {upload.status === 'ingest_error' && (
+                      <div className="flex items-center gap-2">
+                        <AlertCircle className="h-5 w-5 text-red-500" />
+                        <Button 
+                          size="sm" 
+                          variant="outline"
+                          onClick={() => retryIngest(upload)}
+                        >
+                          Reprocessar
+                        </Button>
+                      </div>
+                    )}
                     <Button
                       size="sm"
                       variant="ghost"
                       onClick={() => removeFromQueue(upload.id)}
-                      disabled={upload.status === 'uploading'}
+                      disabled={['hashing', 'uploading'].includes(upload.status)}
                     >
                       <X className="h-4 w-4" />
                     </Button>
@@ -262,12 +505,17 @@ const SlideUpload = ({ onUploadComplete, onUploadStart }) => {
                 </div>
 
                 {/* Barra de Progresso */}
-                {(upload.status === 'uploading' || upload.status === 'pending') && (
+                {['pending', 'hashing', 'uploading', 'processing'].includes(upload.status) && (
                   <div className="space-y-1">
                     <Progress value={upload.progress} className="h-2" />
                     <div className="flex justify-between text-xs text-muted-foreground">
                       <span>
-                        {upload.status === 'pending' ? 'Aguardando...' : 'Enviando...'}
+                        {upload.status === 'pending'
+                          ? 'Aguardando...'
+                          : upload.status === 'hashing' ? 'Calculando hash...'
+                          : upload.status === 'processing'
+                            ? `Processando${upload.ingestStage ? `: ${stageLabel(upload.ingestStage)}` : ''}...`
+                            : 'Enviando...'}
                       </span>
                       <span>{upload.progress}%</span>
                     </div>
@@ -280,6 +528,11 @@ const SlideUpload = ({ onUploadComplete, onUploadStart }) => {
                     Erro: {upload.error}
                   </p>
                 )}
+                {upload.status === 'ingest_error' && upload.error && (
+                  <p className="text-xs text-red-500">
+                    Falha no processamento: {upload.error}
+                  </p>
+                )}
 
                 {/* Status de Sucesso */}
                 {upload.status === 'completed' && (
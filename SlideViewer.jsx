@@ -3,7 +3,7 @@ import { Button } from '@/components/ui/button';
 import { Card, CardContent, CardHeader, CardTitle } from '@/components/ui/card';
 import { ZoomIn, ZoomOut, RotateCcw, Move, MousePointer, Square, Circle } from 'lucide-react';
 
-const SlideViewer = ({ slide, onAnnotation }) => {
+const SlideViewer = ({ slide, onAnnotation, heatmapAnalysisId }) => {
   const canvasRef = useRef(null);
   const containerRef = useRef(null);
   const [zoom, setZoom] = useState(1);
@@ -14,12 +14,54 @@ const SlideViewer = ({ slide, onAnnotation }) => {
   const [annotations, setAnnotations] = useState([]);
   const [currentAnnotation, setCurrentAnnotation] = useState(null);
   const [isDrawing, setIsDrawing] = useState(false);
+  const heatmapRef = useRef(null);
 
   useEffect(() => {
-    if (slide && canvasRef.current) {
+    heatmapRef.current = null;
+    if (slide && heatmapAnalysisId) {
+      loadHeatmap();
+    } else if (slide && canvasRef.current) {
       loadSlideImage();
     }
-  }, [slide]);
+  }, [slide, heatmapAnalysisId]);
+
+  const loadHeatmap = async () => {
+    try {
+      // Overlay servido pelo backend como tiles alinhados à pirâmide da lâmina
+      const infoResponse = await fetch(`/api/slides/${slide.id}/analyses/${heatmapAnalysisId}/heatmap`);
+      if (!infoResponse.ok) return;
+      const info = await infoResponse.json();
+
+      // Nível mais reduzido cobre a lâmina inteira em um único tile
+      const level = info.level_dimensions.length - 1;
+      const [width, height] = info.level_dimensions[level];
+      const tileUrl = info.tile_url
+        .replace('{level}', level)
+        .replace('{x}', 0)
+        .replace('{y}', 0)
+        .replace('{width}', width)
+        .replace('{height}', height);
+
+      const response = await fetch(tileUrl);
+      if (!response.ok) return;
+      const blob = await response.blob();
+      const img = new Image();
+      await new Promise((resolve) => {
+        img.onload = () => {
+          heatmapRef.current = img;
+          resolve();
+        };
+        // Overlay inválido: a lâmina é desenhada sem ele
+        img.onerror = resolve;
+        img.src = URL.createObjectURL(blob);
+      });
+    } catch (error) {
+      console.error('Erro ao carregar heatmap:', error);
+    } finally {
+      // A lâmina é sempre desenhada; o overlay só entra se tiver carregado
+      loadSlideImage();
+    }
+  };
 
   const loadSlideImage = async () => {
     try {
@@ -57,6 +99,11 @@ const SlideViewer = ({ slide, onAnnotation }) => {
     
     // Desenhar imagem
     ctx.drawImage(img, x, y, imgWidth, imgHeight);
+
+    // Desenhar heatmap da análise sobre a imagem
+    if (heatmapRef.current) {
+      ctx.drawImage(heatmapRef.current, x, y, imgWidth, imgHeight);
+    }
     
     // Desenhar anotações
     drawAnnotations(ctx);
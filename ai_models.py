@@ -4,6 +4,13 @@ from PIL import Image
 import json
 from typing import Dict, List, Tuple, Optional
 import openslide
+from src.utils.profiling import StageTimer
+from src.utils.slide_processor import read_image_within_budget
+
+# Resolução máxima da imagem usada na análise da lâmina inteira
+ANALYSIS_MAX_MEGAPIXELS = 4
+# Tamanho (pixels do nível 0) de cada célula do heatmap, alinhado aos tiles da pirâmide
+HEATMAP_TILE_SIZE = 256
 
 class BasicClassifier:
     """Classificador básico para análise de lâminas patológicas"""
@@ -11,24 +18,34 @@ class BasicClassifier:
     def __init__(self):
         self.model_name = "basic_classifier"
         self.version = "1.0"
+        self.max_megapixels = ANALYSIS_MAX_MEGAPIXELS
         
-    def analyze_slide(self, slide_path: str, analysis_type: str = "disease_detection") -> Dict:
-        """Analisar uma lâmina e retornar resultados"""
+    def analyze_slide(self, slide_path: str, analysis_type: str = "disease_detection",
+                      timer: Optional[StageTimer] = None, with_heatmap: bool = False) -> Dict:
+        """Analisar uma lâmina e retornar resultados
+
+        Com with_heatmap=True o resultado inclui 'heatmap': array uint8 com um
+        score por tile de HEATMAP_TILE_SIZE pixels do nível 0.
+        """
+        timer = timer or StageTimer(trace_memory=False)
         try:
-            slide = openslide.OpenSlide(slide_path)
-            
-            # Obter thumbnail para análise rápida
-            level = slide.level_count - 1
-            thumbnail = slide.read_region((0, 0), level, slide.level_dimensions[level])
-            thumbnail = thumbnail.convert('RGB')
+            with timer.stage('slide_open'):
+                slide = openslide.OpenSlide(slide_path)
             
-            # Converter para array numpy
-            img_array = np.array(thumbnail)
+            # Obter imagem reduzida dentro do orçamento de memória
+            try:
+                slide_dimensions = slide.dimensions
+                img_array, _ = read_image_within_budget(slide, self.max_megapixels, timer=timer)
+            finally:
+                slide.close()
             
             # Análise básica baseada em características de cor e textura
-            result = self._basic_analysis(img_array, analysis_type)
+            result = self._basic_analysis(img_array, analysis_type, timer)
+            
+            if with_heatmap:
+                with timer.stage('heatmap'):
+                    result['heatmap'] = self.compute_tile_scores(img_array, slide_dimensions)
             
-            slide.close()
             return result
             
         except Exception as e:
@@ -39,17 +56,22 @@ class BasicClassifier:
                 'regions_of_interest': []
             }
     
-    def _basic_analysis(self, img_array: np.ndarray, analysis_type: str) -> Dict:
+    def _basic_analysis(self, img_array: np.ndarray, analysis_type: str,
+                        timer: Optional[StageTimer] = None) -> Dict:
         """Realizar análise básica da imagem"""
+        timer = timer or StageTimer(trace_memory=False)
         
         # Análise de cor para detectar tipo de coloração
-        stain_type = self._detect_stain_type(img_array)
+        with timer.stage('stain_detection'):
+            stain_type = self._detect_stain_type(img_array)
         
         # Análise de textura básica
-        texture_features = self._extract_texture_features(img_array)
+        with timer.stage('texture'):
+            texture_features = self._extract_texture_features(img_array)
         
         # Detecção de regiões de interesse baseada em densidade de núcleos
-        roi_regions = self._detect_roi_regions(img_array)
+        with timer.stage('roi'):
+            roi_regions = self._detect_roi_regions(img_array)
         
         if analysis_type == "disease_detection":
             prediction, confidence = self._disease_detection(img_array, texture_features)
@@ -174,6 +196,39 @@ class BasicClassifier:
         
         return roi_regions
     
+    def compute_tile_scores(self, img_array: np.ndarray, slide_dimensions: Tuple[int, int],
+                            tile_size: int = HEATMAP_TILE_SIZE) -> np.ndarray:
+        """Calcular score (0-255) de densidade nuclear por tile da lâmina"""
+        
+        grid_width = max(1, -(-slide_dimensions[0] // tile_size))
+        grid_height = max(1, -(-slide_dimensions[1] // tile_size))
+        
+        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        
+        # Tecido: qualquer pixel não-branco
+        tissue_mask = gray < 220
+        tissue = tissue_mask.astype(np.uint8) * 255
+        
+        # Núcleos: pixels escuros com limiar de Otsu calculado apenas sobre o tecido
+        # (sobre a imagem inteira o limiar separaria tecido do fundo do vidro)
+        if np.any(tissue_mask):
+            threshold, _ = cv2.threshold(gray[tissue_mask].reshape(1, -1), 0, 255,
+                                         cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        else:
+            threshold = 0
+        nuclei = ((gray <= threshold) & tissue_mask).astype(np.uint8) * 255
+        
+        # Fração de núcleos e de tecido por célula (redução por área)
+        nuclei_fraction = cv2.resize(nuclei, (grid_width, grid_height), interpolation=cv2.INTER_AREA)
+        tissue_fraction = cv2.resize(tissue, (grid_width, grid_height), interpolation=cv2.INTER_AREA)
+        
+        # Densidade relativa ao tecido presente; 0 fica reservado para "sem tecido"
+        density = nuclei_fraction.astype(np.float32) / np.maximum(tissue_fraction.astype(np.float32), 1.0)
+        scores = np.clip(density * 254.0, 0, 254).astype(np.uint8) + 1
+        scores[tissue_fraction < 26] = 0
+        
+        return scores
+    
     def _disease_detection(self, img_array: np.ndarray, texture_features: Dict) -> Tuple[str, float]:
         """Detecção básica de doença baseada em características"""
         
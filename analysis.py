@@ -0,0 +1,300 @@
+import json
+import hashlib
+from datetime import datetime
+from flask import Blueprint, request, jsonify, send_file, current_app
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from src.models.slide import Slide, AIAnalysis, AnalysisBatch, AnalysisBatchItem, db
+from src.models.user import User
+from src.utils.analysis_pipeline import analysis_pool, stale_analysis_filter
+from src.utils.heatmap import (
+    get_slide_levels, heatmap_from_bytes, render_heatmap_tile, encode_png, MAX_OVERLAY_TILE_SIZE
+)
+
+analysis_bp = Blueprint('analysis', __name__)
+
+# Tiles de heatmap com a versão do conteúdo na URL (?v=, ver tile_url) ficam em
+# cache; a versão muda quando a análise é reexecutada (recover_stale)
+HEATMAP_CACHE_MAX_AGE = 86400
+
+# Limites de lote
+MAX_BATCH_SLIDES = 1000
+SUPPORTED_MODELS = {'basic_classifier'}
+SUPPORTED_ANALYSIS_TYPES = {'disease_detection', 'stain_classification', 'classification'}
+# Campos de Slide aceitos no filtro de lote
+BATCH_FILTER_FIELDS = {'scanner_type', 'stain_type', 'status', 'uploaded_by'}
+# Análises idênticas nestes estados são reaproveitadas (exceto órfãs, ver
+# analysis_pipeline.stale_analysis_filter)
+DEDUPLICATION_STATUSES = ('pending', 'processing', 'completed')
+
+def get_current_user():
+    """Obter usuário atual autenticado"""
+    current_user_id = get_jwt_identity()
+    return User.query.get(current_user_id) if current_user_id else None
+
+def _get_heatmap_analysis(slide_id, analysis_id):
+    """Carregar lâmina e análise verificando acesso; retorna (slide, analysis, erro)"""
+    current_user = get_current_user()
+    if not current_user:
+        return None, None, (jsonify({'error': 'Usuário não encontrado'}), 404)
+    
+    slide = Slide.query.get_or_404(slide_id)
+    
+    # Verificar permissão de acesso
+    if not current_user.can_access_slide(slide):
+        return None, None, (jsonify({'error': 'Acesso negado'}), 403)
+    
+    analysis = AIAnalysis.query.filter_by(id=analysis_id, slide_id=slide_id).first_or_404()
+    
+    if analysis.heatmap is None:
+        return None, None, (jsonify({'error': 'Análise não possui heatmap'}), 404)
+    
+    return slide, analysis, None
+
+def _heatmap_version(analysis):
+    """Digest do conteúdo do heatmap (grade e geometria)"""
+    digest = hashlib.blake2b(analysis.heatmap, digest_size=8)
+    digest.update(f'{analysis.heatmap_width}x{analysis.heatmap_height}x{analysis.heatmap_tile_size}'.encode())
+    return digest.hexdigest()
+
+def _set_heatmap_cache_headers(response, etag, versioned):
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if versioned:
+        response.cache_control.max_age = HEATMAP_CACHE_MAX_AGE
+    else:
+        # URL sem versão: o navegador sempre revalida pelo ETag
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+    response.set_etag(etag)
+    return response
+
+@analysis_bp.route('/slides/<int:slide_id>/analyses/<int:analysis_id>/heatmap', methods=['GET'])
+@jwt_required()
+def get_heatmap_info(slide_id, analysis_id):
+    """Obter metadados do heatmap e da pirâmide de overlay"""
+    slide, analysis, error = _get_heatmap_analysis(slide_id, analysis_id)
+    if error:
+        return error
+    
+    try:
+        levels = get_slide_levels(slide.file_path)
+    except Exception as e:
+        return jsonify({'error': f'Erro ao ler lâmina: {str(e)}'}), 500
+    
+    version = _heatmap_version(analysis)
+    return jsonify({
+        'analysis_id': analysis.id,
+        'slide_id': slide.id,
+        'grid_width': analysis.heatmap_width,
+        'grid_height': analysis.heatmap_height,
+        'tile_size': analysis.heatmap_tile_size,
+        'dimensions': levels['dimensions'],
+        'level_dimensions': levels['level_dimensions'],
+        'level_downsamples': levels['level_downsamples'],
+        'version': version,
+        'tile_url': f'/api/slides/{slide.id}/analyses/{analysis.id}/heatmap/'
+                    '{level}/{x}/{y}/{width}/{height}' + f'?v={version}'
+    }), 200
+
+@analysis_bp.route('/slides/<int:slide_id>/analyses/<int:analysis_id>/heatmap/'
+                   '<int:level>/<int:x>/<int:y>/<int:width>/<int:height>', methods=['GET'])
+@jwt_required()
+def get_heatmap_tile(slide_id, analysis_id, level, x, y, width, height):
+    """Obter tile colorido do heatmap, alinhado ao tile da lâmina com os mesmos parâmetros"""
+    slide, analysis, error = _get_heatmap_analysis(slide_id, analysis_id)
+    if error:
+        return error
+    
+    if width <= 0 or height <= 0 or width > MAX_OVERLAY_TILE_SIZE or height > MAX_OVERLAY_TILE_SIZE:
+        return jsonify({'error': 'Tamanho de tile inválido'}), 400
+    
+    # ETag pelo conteúdo: uma análise reexecutada invalida os tiles já em cache
+    version = _heatmap_version(analysis)
+    etag = f'heatmap-{analysis.id}-{version}-{level}-{x}-{y}-{width}-{height}'
+    versioned = request.args.get('v') == version
+    if request.if_none_match.contains(etag):
+        return _set_heatmap_cache_headers(current_app.response_class(status=304), etag, versioned)
+    
+    try:
+        levels = get_slide_levels(slide.file_path)
+        if level >= len(levels['level_downsamples']):
+            return jsonify({'error': 'Nível inválido'}), 400
+        
+        grid = heatmap_from_bytes(analysis.heatmap, analysis.heatmap_width, analysis.heatmap_height)
+        tile = render_heatmap_tile(
+            grid, analysis.heatmap_tile_size, x, y, width, height,
+            levels['level_downsamples'][level], levels['dimensions']
+        )
+        
+        response = send_file(encode_png(tile), mimetype='image/png')
+        return _set_heatmap_cache_headers(response, etag, versioned)
+        
+    except Exception as e:
+        return jsonify({'error': f'Erro ao gerar tile do heatmap: {str(e)}'}), 500
+
+@analysis_bp.route('/analyses/batch', methods=['POST'])
+@jwt_required()
+def create_batch():
+    """Submeter a mesma análise para várias lâminas (lista de ids ou filtro)"""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({'error': 'Usuário não encontrado'}), 404
+    
+    # Verificar permissão para analisar lâminas
+    if not current_user.has_permission('analyze_slides'):
+        return jsonify({'error': 'Permissão insuficiente para analisar lâminas'}), 403
+    
+    data = request.json or {}
+    analysis_type = data.get('analysis_type', 'disease_detection')
+    model_name = data.get('model_name', 'basic_classifier')
+    slide_ids = data.get('slide_ids')
+    slide_filter = data.get('filter')
+    
+    if model_name not in SUPPORTED_MODELS:
+        return jsonify({'error': f'Modelo {model_name} não suportado'}), 400
+    
+    if analysis_type not in SUPPORTED_ANALYSIS_TYPES:
+        return jsonify({'error': f'Tipo de análise {analysis_type} não suportado'}), 400
+    
+    if bool(slide_ids) == bool(slide_filter):
+        return jsonify({'error': 'Informe slide_ids ou filter'}), 400
+    
+    # Selecionar lâminas
+    query = Slide.query
+    if slide_ids:
+        if not isinstance(slide_ids, list) or not all(isinstance(i, int) for i in slide_ids):
+            return jsonify({'error': 'slide_ids deve ser uma lista de inteiros'}), 400
+        query = query.filter(Slide.id.in_(set(slide_ids)))
+    else:
+        if not isinstance(slide_filter, dict) or not set(slide_filter) <= BATCH_FILTER_FIELDS:
+            return jsonify({'error': f'Campos de filtro permitidos: {sorted(BATCH_FILTER_FIELDS)}'}), 400
+        query = query.filter_by(**slide_filter)
+    
+    # Usuários não-admin só analisam lâminas que podem acessar
+    if current_user.user_type != 'admin':
+        query = query.filter(Slide.uploaded_by == current_user.id)
+    
+    # Lâminas menores primeiro: resultados parciais chegam mais cedo
+    slides = query.order_by(Slide.file_size.asc()).limit(MAX_BATCH_SLIDES + 1).all()
+    
+    if not slides:
+        return jsonify({'error': 'Nenhuma lâmina encontrada'}), 404
+    
+    if len(slides) > MAX_BATCH_SLIDES:
+        return jsonify({'error': f'Lote excede o máximo de {MAX_BATCH_SLIDES} lâminas'}), 400
+    
+    if slide_ids and len(slides) != len(set(slide_ids)):
+        missing = sorted(set(slide_ids) - {slide.id for slide in slides})
+        return jsonify({'error': 'Lâminas não encontradas ou sem acesso', 'slide_ids': missing}), 403
+    
+    try:
+        # Análises órfãs de workers encerrados voltam para a fila antes da deduplicação
+        analysis_pool.recover_stale(current_app._get_current_object())
+        
+        batch = AnalysisBatch(
+            created_by=current_user.id,
+            analysis_type=analysis_type,
+            model_name=model_name,
+            slide_filter=json.dumps(slide_filter) if slide_filter else None
+        )
+        db.session.add(batch)
+        
+        # Análises idênticas já concluídas ou em andamento (uma consulta para o lote)
+        existing = {}
+        for analysis in AIAnalysis.query.filter(
+            AIAnalysis.slide_id.in_([slide.id for slide in slides]),
+            AIAnalysis.analysis_type == analysis_type,
+            AIAnalysis.model_name == model_name,
+            AIAnalysis.status.in_(DEDUPLICATION_STATUSES),
+            db.not_(stale_analysis_filter())
+        ).order_by(AIAnalysis.created_date.asc()):
+            # Preferir a mais recente, e concluídas sobre pendentes
+            current = existing.get(analysis.slide_id)
+            if current is None or current.status != 'completed' or analysis.status == 'completed':
+                existing[analysis.slide_id] = analysis
+        
+        new_analyses = []
+        for slide in slides:
+            analysis = existing.get(slide.id)
+            deduplicated = analysis is not None
+            
+            if not deduplicated:
+                analysis = AIAnalysis(
+                    slide_id=slide.id,
+                    analysis_type=analysis_type,
+                    model_name=model_name,
+                    status='pending',
+                    heartbeat_at=datetime.utcnow()
+                )
+                db.session.add(analysis)
+                new_analyses.append(analysis)
+            
+            db.session.add(AnalysisBatchItem(batch=batch, slide_id=slide.id,
+                                             analysis=analysis, deduplicated=deduplicated))
+        
+        db.session.commit()
+        
+        # Agendar somente depois do commit, para os workers enxergarem os registros
+        app = current_app._get_current_object()
+        for analysis in new_analyses:
+            analysis_pool.submit(app, analysis.id)
+        
+        return jsonify({
+            'batch': batch.to_dict(),
+            'scheduled': len(new_analyses),
+            'deduplicated': len(slides) - len(new_analyses)
+        }), 202
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Erro ao criar lote: {str(e)}'}), 500
+
+@analysis_bp.route('/analyses/batch/<int:batch_id>', methods=['GET'])
+@jwt_required()
+def get_batch(batch_id):
+    """Obter progresso agregado (e opcionalmente resultados) de um lote"""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({'error': 'Usuário não encontrado'}), 404
+    
+    batch = AnalysisBatch.query.get_or_404(batch_id)
+    
+    if batch.created_by != current_user.id and current_user.user_type != 'admin':
+        return jsonify({'error': 'Acesso negado'}), 403
+    
+    # Lote não fica parado em análises de workers encerrados
+    analysis_pool.recover_stale(current_app._get_current_object())
+    
+    # Contagem por status em uma única consulta agregada
+    counts = dict(
+        db.session.query(AIAnalysis.status, db.func.count(AnalysisBatchItem.id))
+        .join(AnalysisBatchItem, AnalysisBatchItem.analysis_id == AIAnalysis.id)
+        .filter(AnalysisBatchItem.batch_id == batch_id)
+        .group_by(AIAnalysis.status)
+        .all()
+    )
+    total = sum(counts.values())
+    finished = counts.get('completed', 0) + counts.get('failed', 0)
+    
+    if finished == total:
+        status = 'completed' if not counts.get('failed') else 'completed_with_errors'
+    elif counts.get('processing') or finished:
+        status = 'running'
+    else:
+        status = 'pending'
+    
+    response = {
+        'batch': batch.to_dict(),
+        'status': status,
+        'total': total,
+        'counts': counts,
+        'progress': finished / total * 100 if total else 100.0
+    }
+    
+    if request.args.get('include_results', '').lower() in ('1', 'true'):
+        items = AnalysisBatchItem.query.filter_by(batch_id=batch_id).all()
+        response['results'] = [
+            {**item.to_dict(), 'analysis': item.analysis.to_dict()} for item in items
+        ]
+    
+    return jsonify(response), 200
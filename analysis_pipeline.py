@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from flask import current_app
+from src.models.slide import AIAnalysis, Slide, db
+from src.utils.ai_models import BasicClassifier, HEATMAP_TILE_SIZE
+from src.utils.profiling import StageTimer, analysis_metrics
+from src.utils.cache import cache
+
+# Workers renovam heartbeat_at das análises na fila/em execução a cada intervalo;
+# pending/processing sem heartbeat há mais de ANALYSIS_STALE_SECONDS ficaram
+# órfãs (worker reciclado ou morto) e são reagendadas ou marcadas como falha
+ANALYSIS_HEARTBEAT_INTERVAL = int(os.environ.get('ANALYSIS_HEARTBEAT_INTERVAL', 60))
+ANALYSIS_STALE_SECONDS = int(os.environ.get('ANALYSIS_STALE_SECONDS', 600))
+ANALYSIS_MAX_ATTEMPTS = int(os.environ.get('ANALYSIS_MAX_ATTEMPTS', 3))
+ANALYSIS_RECOVERY_BATCH = 100
+
+def stale_analysis_filter():
+    """Condição SQL: análise em andamento sem heartbeat recente"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ANALYSIS_STALE_SECONDS)
+    return db.and_(
+        AIAnalysis.status.in_(('pending', 'processing')),
+        db.func.coalesce(AIAnalysis.heartbeat_at, AIAnalysis.created_date) < cutoff
+    )
+
+def run_analysis(analysis: AIAnalysis, slide: Slide, classifier: Optional[BasicClassifier] = None) -> AIAnalysis:
+    """Executar análise de IA instrumentada e gravar resultado e tempos por estágio"""
+    classifier = classifier or BasicClassifier()
+    timer = StageTimer().start()
+    
+    analysis.status = 'processing'
+    analysis.attempts = (analysis.attempts or 0) + 1
+    analysis.heartbeat_at = datetime.utcnow()
+    db.session.commit()
+    
+    try:
+        result = classifier.analyze_slide(slide.file_path, analysis.analysis_type,
+                                          timer=timer, with_heatmap=True)
+        
+        # Heatmap é gravado em formato compacto, fora do JSON de resultado
+        heatmap = result.pop('heatmap', None)
+        if heatmap is not None:
+            analysis.heatmap = heatmap.tobytes()
+            analysis.heatmap_height, analysis.heatmap_width = heatmap.shape
+            analysis.heatmap_tile_size = HEATMAP_TILE_SIZE
+        
+        with timer.stage('serialization'):
+            serialized = json.dumps(result)
+        
+        analysis.result = serialized
+        analysis.confidence = result.get('confidence')
+        analysis.status = 'failed' if 'error' in result else 'completed'
+        
+    except Exception as e:
+        analysis.result = json.dumps({'error': str(e)})
+        analysis.status = 'failed'
+    
+    finally:
+        timer.stop()
+        timings = timer.to_dict()
+        analysis.processing_time = timings['total']
+        analysis.stage_timings = json.dumps(timings['stages'])
+        analysis.bytes_read = timings['bytes_read']
+        analysis.peak_memory = timings['peak_memory']
+        db.session.commit()
+        
+        try:
+            analysis_metrics.record(cache.redis_client if cache.enabled else None, timings, slide.scanner_type)
+        except Exception as e:
+            current_app.logger.warning(f"Métricas da análise {analysis.id} não registradas: {e}")
+    
+    return analysis
+
+class AnalysisWorkerPool:
+    """Pool de workers para análises em segundo plano"""
+    
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or int(os.environ.get('ANALYSIS_WORKERS', 2))
+        self._executor = None
+        self._lock = threading.Lock()
+        # Análises na fila ou em execução neste processo (recebem heartbeat)
+        self._inflight = set()
+        self._heartbeat = None
+        self._heartbeat_pid = None
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Criado sob demanda para não herdar threads através do fork do gunicorn
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='aiapad-analysis')
+            return self._executor
+    
+    def submit(self, app, analysis_id: int):
+        """Agendar análise já criada (status pending)"""
+        with self._lock:
+            self._inflight.add(analysis_id)
+        self._start_heartbeat(app)
+        return self._get_executor().submit(self._run, app, analysis_id)
+    
+    def _start_heartbeat(self, app):
+        with self._lock:
+            # Threads não sobrevivem ao fork do gunicorn: recriar no processo filho
+            if self._heartbeat is not None and self._heartbeat_pid == os.getpid() and self._heartbeat.is_alive():
+                return
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, args=(app,),
+                                               name='aiapad-analysis-heartbeat', daemon=True)
+            self._heartbeat_pid = os.getpid()
+            self._heartbeat.start()
+    
+    def _heartbeat_loop(self, app):
+        while True:
+            time.sleep(ANALYSIS_HEARTBEAT_INTERVAL)
+            with app.app_context():
+                try:
+                    with self._lock:
+                        analysis_ids = list(self._inflight)
+                    if analysis_ids:
+                        AIAnalysis.query.filter(AIAnalysis.id.in_(analysis_ids)) \
+                            .update({AIAnalysis.heartbeat_at: datetime.utcnow()}, synchronize_session=False)
+                        db.session.commit()
+                    self.recover_stale(app)
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Erro no heartbeat das análises: {e}")
+                finally:
+                    db.session.remove()
+    
+    def recover_stale(self, app) -> List[int]:
+        """Reagendar neste processo (ou marcar como falha) análises órfãs
+        
+        Cada análise é tomada com um UPDATE condicional: se vários processos
+        tentarem ao mesmo tempo, apenas um a reagenda. Retorna os ids reagendados.
+        """
+        stale = AIAnalysis.query.filter(stale_analysis_filter()) \
+            .order_by(AIAnalysis.created_date).limit(ANALYSIS_RECOVERY_BATCH).all()
+        
+        requeued = []
+        for analysis in stale:
+            exhausted = (analysis.attempts or 0) >= ANALYSIS_MAX_ATTEMPTS
+            values = {AIAnalysis.heartbeat_at: datetime.utcnow()}
+            if exhausted:
+                values[AIAnalysis.status] = 'failed'
+                values[AIAnalysis.result] = json.dumps({'error': 'Análise interrompida (worker encerrado) após '
+                                                                 f'{analysis.attempts} tentativas'})
+            else:
+                values[AIAnalysis.status] = 'pending'
+            
+            claimed = AIAnalysis.query.filter(AIAnalysis.id == analysis.id, stale_analysis_filter()) \
+                .update(values, synchronize_session=False)
+            db.session.commit()
+            if claimed and not exhausted:
+                requeued.append(analysis.id)
+        
+        for analysis_id in requeued:
+            self.submit(app, analysis_id)
+        if stale:
+            app.logger.warning(f"Análises órfãs: {len(requeued)} reagendadas, "
+                               f"{len(stale) - len(requeued)} encerradas")
+        return requeued
+    
+    def _run(self, app, analysis_id: int):
+        with app.app_context():
+            try:
+                analysis = AIAnalysis.query.get(analysis_id)
+                if not analysis or analysis.status != 'pending':
+                    return
+                
+                slide = Slide.query.get(analysis.slide_id)
+                if not slide:
+                    analysis.status = 'failed'
+                    analysis.result = json.dumps({'error': 'Lâmina não encontrada'})
+                    db.session.commit()
+                    return
+                
+                run_analysis(analysis, slide)
+                
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Erro na análise {analysis_id}: {e}")
+            finally:
+                with self._lock:
+                    self._inflight.discard(analysis_id)
+                db.session.remove()
+
+# Instância global do pool
+analysis_pool = AnalysisWorkerPool()
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks das funções críticas de ai_models e slide_processor
+
+Uso:
+    python benchmarks.py                      # executar e mostrar resultados
+    python benchmarks.py --save-baseline      # gravar baseline atual
+    python benchmarks.py --compare            # comparar com baseline (exit 1 em regressão)
+    python benchmarks.py --generate slide.tif --width 20000 --height 15000 --pattern dense
+"""
+
+import os
+import sys
+import gc
+import json
+import math
+import time
+import zlib
+import struct
+import argparse
+import platform
+import statistics
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+# Adicionar diretório do projeto ao path (mesmo esquema do wsgi.py)
+project_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, project_dir)
+
+DEFAULT_BASELINE_PATH = os.path.join(project_dir, 'benchmarks_baseline.json')
+DEFAULT_THRESHOLD = 0.20  # 20% de degradação da mediana é regressão
+
+# Tipos e tags TIFF usados pelo gerador
+TIFF_ASCII = 2
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_RATIONAL = 5
+TIFF_LONG8 = 16
+
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_IMAGE_DESCRIPTION = 270
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_X_RESOLUTION = 282
+TAG_Y_RESOLUTION = 283
+TAG_PLANAR_CONFIG = 284
+TAG_RESOLUTION_UNIT = 296
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+
+COMPRESSION_NONE = 1
+COMPRESSION_DEFLATE = 8
+
+TISSUE_PATTERNS = ('he', 'dense', 'sparse', 'blank')
+
+
+class SyntheticSlideGenerator:
+    """Gerador de lâminas sintéticas em TIFF piramidal com tiles (legível pelo OpenSlide)"""
+
+    def __init__(self, width: int, height: int, tile_size: int = 256, pattern: str = 'he',
+                 seed: int = 0, mpp: float = 0.25, compression: str = 'deflate',
+                 bigtiff: Optional[bool] = None):
+        if pattern not in TISSUE_PATTERNS:
+            raise ValueError(f"Padrão de tecido inválido: {pattern}")
+        if tile_size % 16 != 0:
+            raise ValueError("tile_size deve ser múltiplo de 16")
+
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.pattern = pattern
+        self.seed = seed
+        self.mpp = mpp
+        self.compression = COMPRESSION_DEFLATE if compression == 'deflate' else COMPRESSION_NONE
+
+        # BigTIFF automático quando o arquivo sem compressão passaria de ~3.5GB
+        if bigtiff is None:
+            bigtiff = width * height * 3 * 4 // 3 > 3.5 * 1024 ** 3
+        self.bigtiff = bigtiff
+
+    def level_dimensions(self) -> List[tuple]:
+        """Dimensões de cada nível (downsample 2x até caber em um tile)"""
+        dims = [(self.width, self.height)]
+        while dims[-1][0] > self.tile_size or dims[-1][1] > self.tile_size:
+            w, h = dims[-1]
+            dims.append((max(1, w // 2), max(1, h // 2)))
+        return dims
+
+    def render_tile(self, x0: float, y0: float, scale: float, w: int, h: int) -> np.ndarray:
+        """Renderizar tile proceduralmente a partir de coordenadas do nível 0
+
+        A função é determinística (seed + coordenadas), então cada nível é
+        gerado de forma independente sem manter a imagem inteira em memória.
+        """
+        ys = y0 + np.arange(h, dtype=np.float32)[:, None] * scale
+        xs = x0 + np.arange(w, dtype=np.float32)[None, :] * scale
+
+        tile = np.full((h, w, 3), 242, dtype=np.uint8)  # fundo branco do vidro
+        if self.pattern == 'blank':
+            return tile
+
+        # Máscara de tecido: campo de baixa frequência
+        phase = self.seed * 0.7
+        field = (np.sin(xs / 1900.0 + phase) * np.cos(ys / 1300.0 - phase)
+                 + 0.5 * np.sin((xs + ys) / 2700.0))
+        tissue_threshold = {'he': 0.0, 'dense': -0.6, 'sparse': 0.6}[self.pattern]
+        tissue = field > tissue_threshold
+
+        # Estroma rosado (eosina)
+        tile[tissue] = (226, 150, 190)
+
+        # Núcleos: grade pseudoaleatória de células com hash das coordenadas
+        cell = 24.0
+        density = {'he': 0.35, 'dense': 0.7, 'sparse': 0.15}[self.pattern]
+        cx = np.floor(xs / cell)
+        cy = np.floor(ys / cell)
+        hashed = np.sin(cx * 12.9898 + cy * 78.233 + self.seed * 37.719) * 43758.5453
+        rnd = hashed - np.floor(hashed)
+        local_x = xs / cell - cx - 0.5
+        local_y = ys / cell - cy - 0.5
+        radius = 0.18 + 0.12 * rnd
+        nuclei = tissue & (rnd < density) & (local_x ** 2 + local_y ** 2 < radius ** 2)
+
+        # Núcleos roxos (hematoxilina)
+        tile[nuclei] = (95, 60, 150)
+        return tile
+
+    def write(self, path: str) -> Dict:
+        """Gravar o TIFF piramidal em disco"""
+        dims = self.level_dimensions()
+        offset_size = 8 if self.bigtiff else 4
+        offset_fmt = '<Q' if self.bigtiff else '<I'
+
+        with open(path, 'wb') as f:
+            # Cabeçalho
+            if self.bigtiff:
+                f.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+                next_ifd_pointer = 8
+            else:
+                f.write(b'II' + struct.pack('<HI', 42, 0))
+                next_ifd_pointer = 4
+
+            for level, (lw, lh) in enumerate(dims):
+                scale = self.width / lw
+                tiles_x = math.ceil(lw / self.tile_size)
+                tiles_y = math.ceil(lh / self.tile_size)
+
+                offsets = []
+                byte_counts = []
+                for ty in range(tiles_y):
+                    for tx in range(tiles_x):
+                        # Tiles de borda são sempre gravados com tamanho cheio (spec TIFF)
+                        tile = self.render_tile(tx * self.tile_size * scale,
+                                                ty * self.tile_size * scale,
+                                                scale, self.tile_size, self.tile_size)
+                        data = tile.tobytes()
+                        if self.compression == COMPRESSION_DEFLATE:
+                            data = zlib.compress(data, 6)
+                        offsets.append(f.tell())
+                        byte_counts.append(len(data))
+                        f.write(data)
+
+                description = (f"AIAPad synthetic slide|pattern={self.pattern}|"
+                               f"seed={self.seed}|MPP={self.mpp}").encode('ascii') + b'\x00'
+                # Resolução em pixels por centímetro
+                pixels_per_cm = int(round(10000.0 / (self.mpp * scale)))
+
+                entries = [
+                    (TAG_NEW_SUBFILE_TYPE, TIFF_LONG, [0 if level == 0 else 1]),
+                    (TAG_IMAGE_WIDTH, TIFF_LONG, [lw]),
+                    (TAG_IMAGE_LENGTH, TIFF_LONG, [lh]),
+                    (TAG_BITS_PER_SAMPLE, TIFF_SHORT, [8, 8, 8]),
+                    (TAG_COMPRESSION, TIFF_SHORT, [self.compression]),
+                    (TAG_PHOTOMETRIC, TIFF_SHORT, [2]),
+                    (TAG_IMAGE_DESCRIPTION, TIFF_ASCII, description),
+                    (TAG_SAMPLES_PER_PIXEL, TIFF_SHORT, [3]),
+                    (TAG_X_RESOLUTION, TIFF_RATIONAL, [pixels_per_cm, 1]),
+                    (TAG_Y_RESOLUTION, TIFF_RATIONAL, [pixels_per_cm, 1]),
+                    (TAG_PLANAR_CONFIG, TIFF_SHORT, [1]),
+                    (TAG_RESOLUTION_UNIT, TIFF_SHORT, [3]),
+                    (TAG_TILE_WIDTH, TIFF_LONG, [self.tile_size]),
+                    (TAG_TILE_LENGTH, TIFF_LONG, [self.tile_size]),
+                    (TAG_TILE_OFFSETS, TIFF_LONG8 if self.bigtiff else TIFF_LONG, offsets),
+                    (TAG_TILE_BYTE_COUNTS, TIFF_LONG8 if self.bigtiff else TIFF_LONG, byte_counts),
+                ]
+
+                ifd_offset = self._align(f)
+                self._patch(f, next_ifd_pointer, offset_fmt, ifd_offset)
+                next_ifd_pointer = self._write_ifd(f, entries, offset_size)
+
+        return {
+            'path': path,
+            'file_size': os.path.getsize(path),
+            'levels': len(dims),
+            'level_dimensions': dims,
+            'tile_size': self.tile_size,
+            'bigtiff': self.bigtiff
+        }
+
+    def _align(self, f) -> int:
+        """IFDs precisam começar em offset par"""
+        position = f.tell()
+        if position % 2:
+            f.write(b'\x00')
+            position += 1
+        return position
+
+    def _patch(self, f, position: int, fmt: str, value: int):
+        current = f.tell()
+        f.seek(position)
+        f.write(struct.pack(fmt, value))
+        f.seek(current)
+
+    def _write_ifd(self, f, entries: List[tuple], offset_size: int) -> int:
+        """Gravar um IFD e retornar a posição do ponteiro para o próximo IFD"""
+        count_fmt, entry_size = ('<Q', 20) if self.bigtiff else ('<H', 12)
+        ifd_start = f.tell()
+        ifd_size = struct.calcsize(count_fmt) + len(entries) * entry_size + offset_size
+        extra_offset = ifd_start + ifd_size
+
+        entry_bytes = [struct.pack(count_fmt, len(entries))]
+        extra_bytes = []
+
+        for tag, tiff_type, values in sorted(entries, key=lambda e: e[0]):
+            payload = self._pack_values(tiff_type, values)
+            count = len(values) // 2 if tiff_type == TIFF_RATIONAL else len(values)
+            if self.bigtiff:
+                header = struct.pack('<HHQ', tag, tiff_type, count)
+            else:
+                header = struct.pack('<HHI', tag, tiff_type, count)
+
+            if len(payload) <= offset_size:
+                entry_bytes.append(header + payload.ljust(offset_size, b'\x00'))
+            else:
+                if extra_offset % 2:
+                    extra_bytes.append(b'\x00')
+                    extra_offset += 1
+                entry_bytes.append(header + struct.pack('<Q' if self.bigtiff else '<I', extra_offset))
+                extra_bytes.append(payload)
+                extra_offset += len(payload)
+
+        f.write(b''.join(entry_bytes))
+        next_ifd_pointer = f.tell()
+        f.write(b'\x00' * offset_size)
+        f.write(b''.join(extra_bytes))
+        return next_ifd_pointer
+
+    def _pack_values(self, tiff_type: int, values) -> bytes:
+        if tiff_type == TIFF_ASCII:
+            return bytes(values)
+        fmt = {TIFF_SHORT: 'H', TIFF_LONG: 'I', TIFF_RATIONAL: 'I', TIFF_LONG8: 'Q'}[tiff_type]
+        return struct.pack(f'<{len(values)}{fmt}', *values)
+
+
+def generate_synthetic_slide(path: str, width: int, height: int, **kwargs) -> Dict:
+    """Atalho para gerar uma lâmina sintética"""
+    return SyntheticSlideGenerator(width, height, **kwargs).write(path)
+
+
+def run_benchmark(name: str, func: Callable, rounds: int = 10, warmup: int = 2) -> Dict:
+    """Executar função repetidamente e coletar estatísticas (estilo pytest-benchmark)"""
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return {
+        'name': name,
+        'rounds': rounds,
+        'min': min(timings),
+        'max': max(timings),
+        'mean': statistics.mean(timings),
+        'median': statistics.median(timings),
+        'stddev': statistics.stdev(timings) if len(timings) > 1 else 0.0
+    }
+
+
+def build_benchmarks(workdir: str, slide_size: int = 8192) -> Dict[str, Callable]:
+    """Montar os benchmarks com entradas sintéticas determinísticas"""
+    from src.utils.ai_models import AnnotationProcessor, BasicClassifier, StainNormalizer
+    from src.utils.slide_processor import SlideProcessor
+
+    generator = SyntheticSlideGenerator(slide_size, slide_size, pattern='he', seed=42)
+    slide_path = os.path.join(workdir, f'synthetic_{slide_size}.tif')
+    if not os.path.exists(slide_path):
+        generator.write(slide_path)
+
+    region = generator.render_tile(0, 0, 1.0, 1024, 1024)
+    patch_gray = region[:64, :64].mean(axis=2).astype(np.uint8)
+
+    annotation_processor = AnnotationProcessor()
+    classifier = BasicClassifier()
+    normalizer = StainNormalizer()
+    slide_processor = SlideProcessor()
+
+    return {
+        'ai_models.calculate_lbp_histogram[64x64]':
+            lambda: annotation_processor._calculate_lbp_histogram(patch_gray),
+        'ai_models.detect_roi_regions[1024x1024]':
+            lambda: classifier._detect_roi_regions(region),
+        'ai_models.normalize_he_stain[1024x1024]':
+            lambda: normalizer.normalize_he_stain(region),
+        'slide_processor.extract_metadata':
+            lambda: slide_processor.extract_metadata(slide_path),
+        'slide_processor.get_tile_coordinates[level0]':
+            lambda: slide_processor.get_tile_coordinates(slide_path, 0),
+    }
+
+
+def load_baseline(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: List[Dict]):
+    baseline = {
+        'created_at': time.time(),
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor()
+        },
+        'benchmarks': {r['name']: {'median': r['median'], 'min': r['min']} for r in results}
+    }
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def compare_with_baseline(results: List[Dict], baseline: Dict, threshold: float) -> List[Dict]:
+    """Retornar benchmarks cuja mediana piorou além do limiar"""
+    regressions = []
+    reference = baseline.get('benchmarks', {})
+
+    for result in results:
+        base = reference.get(result['name'])
+        if not base or base['median'] <= 0:
+            continue
+        ratio = result['median'] / base['median']
+        result['baseline_median'] = base['median']
+        result['ratio'] = ratio
+        if ratio > 1 + threshold:
+            regressions.append(result)
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks do AIAPad')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--filter', default=None, help='Executar apenas benchmarks contendo este texto')
+    parser.add_argument('--slide-size', type=int, default=8192)
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'aiapad-bench'))
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--json', dest='json_output', default=None, help='Gravar resultados em JSON')
+
+    # Geração avulsa de lâminas sintéticas
+    parser.add_argument('--generate', default=None, metavar='PATH')
+    parser.add_argument('--width', type=int, default=20000)
+    parser.add_argument('--height', type=int, default=15000)
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--pattern', choices=TISSUE_PATTERNS, default='he')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bigtiff', action='store_true', default=None)
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        info = generate_synthetic_slide(args.generate, args.width, args.height,
+                                        tile_size=args.tile_size, pattern=args.pattern,
+                                        seed=args.seed, bigtiff=args.bigtiff)
+        print(json.dumps(info, indent=2))
+        return 0
+
+    os.makedirs(args.workdir, exist_ok=True)
+    benchmarks = build_benchmarks(args.workdir, args.slide_size)
+
+    results = []
+    for name, func in benchmarks.items():
+        if args.filter and args.filter not in name:
+            continue
+        result = run_benchmark(name, func, rounds=args.rounds, warmup=args.warmup)
+        results.append(result)
+        print(f"{name:55s} median={result['median'] * 1000:10.3f}ms "
+              f"min={result['min'] * 1000:10.3f}ms stddev={result['stddev'] * 1000:8.3f}ms")
+
+    if args.json_output:
+        with open(args.json_output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"Baseline gravada em {args.baseline}")
+
+    if args.compare:
+        baseline = load_baseline(args.baseline)
+        if not baseline:
+            print(f"Baseline não encontrada: {args.baseline}")
+            return 2
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        for r in regressions:
+            print(f"REGRESSÃO {r['name']}: {r['median'] * 1000:.3f}ms vs "
+                  f"{r['baseline_median'] * 1000:.3f}ms ({(r['ratio'] - 1) * 100:+.1f}%)")
+        if regressions:
+            return 1
+        print(f"Nenhuma regressão acima de {args.threshold * 100:.0f}%")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,349 @@
 import os
+import re
 import json
+import math
+import socket
+import fnmatch
 import time
+import random
 import hashlib
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from uuid import UUID
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import wraps
-from flask import current_app, request
+from flask import current_app, request, has_request_context, copy_current_request_context
 import redis
+import numpy as np
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import inspect as sa_inspect
+from src.utils.cache_codecs import encode_value, decode_value, default_compression
+from src.utils.cache_metrics import CacheMetrics
+
+# Contadores de geração: chaves dependentes de uma lâmina/usuário embutem a
+# geração atual; invalidar é um INCR e as chaves antigas expiram pelo TTL
+GENERATION_KEY_PREFIX = 'cache_gen:'
+
+# Prefixos de chave versionados e o tipo de dono (tag) de cada um
+TAGGED_PREFIXES = {
+    'slide_metadata': 'slide',
+    'slide_tiles': 'slide',
+    'slide_thumbnail': 'slide',
+    'ai_analysis': 'slide',
+    'slide_annotations': 'slide',
+    'user_permissions': 'user',
+    'user_slides': 'user',
+    'user_stats': 'user'
+}
+
+# <prefixo>:<id do dono>:g<geração>[:<resto>]
+TAGGED_KEY_RE = re.compile(r'^([a-z_]+):([^:]+):g(\d+)(?::|$)')
+
+# Lote de chaves por SCAN/UNLINK (evita bloquear o Redis)
+SCAN_BATCH_SIZE = 1000
+
+# Trava de cálculo (single-flight): chave de trava e liberação apenas pelo dono
+LOCK_KEY_PREFIX = 'cache_lock:'
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Cache de tiles: admissão (doorkeeper TinyLFU), cota por lâmina e remoção por
+# tamanho/frequência (GDSF) sob um orçamento global de bytes. Índices:
+#   tile_cache:index      zset chave -> prioridade (todas as lâminas)
+#   tile_cache:slide:<id> zset chave -> prioridade (uma lâmina)
+#   tile_cache:expiry     zset chave -> expiração (epoch)
+#   tile_cache:meta       hash chave -> "<bytes>:<acessos>:<lâmina>"
+#   tile_cache:usage      hash <lâmina>/total -> bytes; clock -> inflação (L)
+# Prioridade GDSF: L + acessos * 1024 / bytes; L sobe para a prioridade de cada
+# tile removido, então tiles sem acessos recentes acabam saindo.
+#
+# Os scripts só acessam chaves recebidas em KEYS. Por isso:
+#   - o índice de outra lâmina não é alterado quando um tile dela sai pelo
+#     orçamento global; a entrada fica órfã (sem meta) e é descartada na
+#     próxima admissão ou liberação daquela lâmina;
+#   - os dados dos tiles removidos são devolvidos ao cliente, que faz o UNLINK.
+TILE_INDEX_KEY = 'tile_cache:index'
+TILE_SLIDE_INDEX_PREFIX = 'tile_cache:slide:'
+TILE_EXPIRY_KEY = 'tile_cache:expiry'
+TILE_META_KEY = 'tile_cache:meta'
+TILE_USAGE_KEY = 'tile_cache:usage'
+TILE_SEEN_PREFIX = 'tile_cache:seen:'
+# Bitmap do doorkeeper por janela (2^22 bits = 512 KiB) e posições por tile
+TILE_DOORKEEPER_BITS = 2 ** 22
+TILE_DOORKEEPER_HASHES = 3
+# Remoções por admissão (limita o tempo do script no Redis)
+TILE_MAX_EVICTIONS = 64
+# Entradas expiradas (e órfãs do índice da lâmina) retiradas por admissão
+TILE_EXPIRY_BATCH = 32
+
+# KEYS: tile, index, slide index, expiry, meta, usage, janela atual, janela anterior
+# ARGV: dados, ttl, bytes, lâmina, cota, orçamento, agora, ttl da janela,
+#       lote de expirados, máximo de remoções, posições...
+# Retorna {1 admitido | 0 aguardando segundo acesso | -1 recusado, removidos,
+#          chaves dos tiles removidos...}
+TILE_ADMIT_SCRIPT = """
+local size = tonumber(ARGV[3])
+local slide = ARGV[4]
+local quota = tonumber(ARGV[5])
+local budget = tonumber(ARGV[6])
+local now = tonumber(ARGV[7])
+
+local function forget(key)
+    local meta = redis.call('HGET', KEYS[5], key)
+    redis.call('ZREM', KEYS[2], key)
+    redis.call('ZREM', KEYS[4], key)
+    if not meta then
+        redis.call('ZREM', KEYS[3], key)
+        return 0
+    end
+    local bytes, freq, owner = string.match(meta, '^(%d+):(%d+):(.*)$')
+    -- Índice de outra lâmina não está em KEYS: a entrada fica órfã
+    if owner == slide then
+        redis.call('ZREM', KEYS[3], key)
+    end
+    redis.call('HDEL', KEYS[5], key)
+    redis.call('HINCRBY', KEYS[6], owner, -tonumber(bytes))
+    redis.call('HINCRBY', KEYS[6], 'total', -tonumber(bytes))
+    return tonumber(freq)
+end
+
+-- Tiles que já expiraram (TTL) saem dos índices e da contagem de bytes
+for _, key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now, 'LIMIT', 0, ARGV[9])) do
+    forget(key)
+end
+
+-- Entradas órfãs do índice da lâmina (tiles removidos pelo orçamento global)
+for _, key in ipairs(redis.call('ZRANGE', KEYS[3], 0, tonumber(ARGV[9]) - 1)) do
+    if redis.call('HEXISTS', KEYS[5], key) == 0 then
+        redis.call('ZREM', KEYS[3], key)
+    end
+end
+
+local freq = 0
+if redis.call('HEXISTS', KEYS[5], KEYS[1]) == 1 then
+    -- Tile já admitido sendo regravado: mantém a frequência
+    freq = forget(KEYS[1])
+elseif tonumber(ARGV[8]) > 0 then
+    local current, previous = true, true
+    for i = 11, #ARGV do
+        if redis.call('GETBIT', KEYS[7], ARGV[i]) == 0 then current = false end
+        if redis.call('GETBIT', KEYS[8], ARGV[i]) == 0 then previous = false end
+    end
+    if not current then
+        for i = 11, #ARGV do
+            redis.call('SETBIT', KEYS[7], ARGV[i], 1)
+        end
+        redis.call('EXPIRE', KEYS[7], ARGV[8])
+    end
+    if not (current or previous) then
+        return {0, 0}
+    end
+end
+
+if size > quota or size > budget then
+    return {-1, 0}
+end
+
+freq = freq + 1
+local clock = tonumber(redis.call('HGET', KEYS[6], 'clock') or '0')
+local priority = clock + freq * 1024 / size
+local victims = {}
+
+local function finish(status)
+    if #victims > 0 then
+        redis.call('HSET', KEYS[6], 'clock', tostring(clock))
+    end
+    local result = {status, #victims}
+    for _, key in ipairs(victims) do
+        result[#result + 1] = key
+    end
+    return result
+end
+
+local function evict(index, candidate_priority)
+    while #victims < tonumber(ARGV[10]) do
+        local victim = redis.call('ZRANGE', index, 0, 0, 'WITHSCORES')
+        if #victim == 0 then
+            return false
+        end
+        if redis.call('HEXISTS', KEYS[5], victim[1]) == 0 then
+            -- Órfã: já removida do cache
+            redis.call('ZREM', index, victim[1])
+        else
+            local score = tonumber(victim[2])
+            -- Admissão TinyLFU: o novo tile não desloca um tile mais valioso
+            if candidate_priority and score > candidate_priority then
+                return false
+            end
+            clock = math.max(clock, score)
+            forget(victim[1])
+            victims[#victims + 1] = victim[1]
+            return true
+        end
+    end
+    return false
+end
+
+-- Cota da lâmina: a lâmina substitui os próprios tiles menos valiosos
+while tonumber(redis.call('HGET', KEYS[6], slide) or '0') + size > quota do
+    if not evict(KEYS[3], nil) then
+        return finish(-1)
+    end
+end
+
+-- Orçamento global
+while tonumber(redis.call('HGET', KEYS[6], 'total') or '0') + size > budget do
+    if not evict(KEYS[2], priority) then
+        return finish(-1)
+    end
+end
+
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], priority, KEYS[1])
+redis.call('ZADD', KEYS[3], priority, KEYS[1])
+redis.call('ZADD', KEYS[4], now + tonumber(ARGV[2]), KEYS[1])
+redis.call('HSET', KEYS[5], KEYS[1], size .. ':' .. freq .. ':' .. slide)
+redis.call('HINCRBY', KEYS[6], slide, size)
+redis.call('HINCRBY', KEYS[6], 'total', size)
+return finish(1)
+"""
+
+# KEYS: index, meta, usage, slide index, lâminas recentes, tiles... (todos da lâmina)
+# ARGV: lâmina, agora, máximo de recentes
+# Retorna os dados de cada tile (nil se ausente) e registra o acesso
+TILE_TOUCH_SCRIPT = """
+redis.call('ZADD', KEYS[5], ARGV[2], ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[5], 0, -(tonumber(ARGV[3]) + 1))
+local clock = tonumber(redis.call('HGET', KEYS[3], 'clock') or '0')
+local values = {}
+for i = 6, #KEYS do
+    local value = redis.call('GET', KEYS[i])
+    values[i - 5] = value
+    if value then
+        local meta = redis.call('HGET', KEYS[2], KEYS[i])
+        if meta then
+            local bytes, freq, owner = string.match(meta, '^(%d+):(%d+):(.*)$')
+            if owner == ARGV[1] then
+                freq = tonumber(freq) + 1
+                local priority = clock + freq * 1024 / tonumber(bytes)
+                redis.call('ZADD', KEYS[1], priority, KEYS[i])
+                redis.call('ZADD', KEYS[4], priority, KEYS[i])
+                redis.call('HSET', KEYS[2], KEYS[i], bytes .. ':' .. freq .. ':' .. owner)
+            end
+        end
+    end
+end
+return values
+"""
+
+# KEYS: index, slide index, expiry, meta, usage; ARGV: lâmina
+# Remove os registros dos tiles da lâmina; retorna as chaves (UNLINK no cliente)
+TILE_RELEASE_SCRIPT = """
+local released = {}
+local freed = tonumber(redis.call('HGET', KEYS[5], ARGV[1]) or '0')
+for _, key in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+    local meta = redis.call('HGET', KEYS[4], key)
+    -- Entradas órfãs (tile já removido pelo orçamento global) são ignoradas
+    if meta and string.match(meta, '^%d+:%d+:(.*)$') == ARGV[1] then
+        redis.call('ZREM', KEYS[1], key)
+        redis.call('ZREM', KEYS[3], key)
+        redis.call('HDEL', KEYS[4], key)
+        released[#released + 1] = key
+    end
+end
+redis.call('DEL', KEYS[2])
+redis.call('HDEL', KEYS[5], ARGV[1])
+redis.call('HINCRBY', KEYS[5], 'total', -freed)
+return released
+"""
+
+# Lâminas visualizadas recentemente (zset lâmina -> último acesso), usado
+# pelo aquecimento do cache (cache_warmup)
+RECENT_SLIDES_KEY = 'recent_slides'
+RECENT_SLIDES_MAX = 1000
+
+# Cache local (L1) por processo: prefixo -> TTL máximo local em segundos.
+# O TTL limita a defasagem caso uma mensagem de invalidação seja perdida.
+# Valores com expiração lógica (stale-while-revalidate / XFetch) são gravados
+# neste envelope: v = valor, e = expiração lógica (epoch), d = tempo de cálculo (s)
+ENVELOPE_MARKER = '__swr__'
+
+def _is_envelope(entry):
+    return isinstance(entry, dict) and entry.get(ENVELOPE_MARKER) == 1
+
+DEFAULT_L1_PREFIXES = 'user_permissions=30,slide_metadata=60,cache_gen=10'
+INVALIDATION_CHANNEL = 'cache_invalidate'
+
+def _parse_l1_prefixes(value):
+    """'prefixo=ttl,...' -> {prefixo: ttl}"""
+    prefixes = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            prefix, ttl = item.split('=', 1)
+            if prefix.strip() and float(ttl) > 0:
+                prefixes[prefix.strip()] = float(ttl)
+    return prefixes
+
+class LocalCache:
+    """LRU com TTL por entrada, limitado em número de entradas (thread-safe)
+    
+    Guarda os bytes como estão no Redis: cada leitura desserializa uma cópia
+    nova, então quem chama pode alterar o valor sem afetar o cache.
+    """
+    
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Incrementado a cada invalidação: leituras do Redis iniciadas antes
+        # de uma invalidação não são guardadas (evita reinserir valor antigo)
+        self.epoch = 0
+    
+    def get(self, key):
+        """Retorna (encontrado, valor)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            if entry[1] < time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, entry[0]
+    
+    def set(self, key, value, ttl, epoch=None):
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+    
+    def invalidate(self, key):
+        with self._lock:
+            self.epoch += 1
+            self._data.pop(key, None)
+    
+    def invalidate_pattern(self, pattern):
+        with self._lock:
+            self.epoch += 1
+            for key in [key for key in self._data if fnmatch.fnmatchcase(key, pattern)]:
+                del self._data[key]
+    
+    def clear(self):
+        with self._lock:
+            self.epoch += 1
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
 
 class CacheManager:
     """Gerenciador de cache para AIAPad"""
@@ -12,6 +351,42 @@ class CacheManager:
     def __init__(self, app=None):
         self.redis_client = None
         self.enabled = False
+        # Formato dos valores (o codec fica gravado no cabeçalho de cada valor)
+        self.default_codec = os.environ.get('CACHE_CODEC', 'json')
+        self.compression = os.environ.get('CACHE_COMPRESSION', default_compression())
+        if self.compression == 'none':
+            self.compression = None
+        self.compress_threshold = int(os.environ.get('CACHE_COMPRESS_THRESHOLD', 4096))
+        # Varredura opcional de chaves de gerações antigas (0 desativa)
+        self.sweep_interval = int(os.environ.get('CACHE_SWEEP_INTERVAL', 0))
+        self._sweeper = None
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+        # Cálculos em andamento neste processo (chave -> Future)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # Scripts Lua registrados no cliente atual (fonte -> Script)
+        self._scripts = {}
+        # Recálculos em segundo plano (valores servidos ainda válidos ou vencidos)
+        self._refreshing = set()
+        self._refresh_executor = None
+        self._refresh_pid = None
+        self.refresh_workers = int(os.environ.get('CACHE_REFRESH_WORKERS', 2))
+        # L1 por processo na frente do Redis, apenas para prefixos habilitados
+        self.l1_prefixes = _parse_l1_prefixes(os.environ.get('CACHE_L1_PREFIXES', DEFAULT_L1_PREFIXES))
+        self.l1 = LocalCache(int(os.environ.get('CACHE_L1_MAX_ENTRIES', 10000)))
+        self._listener = None
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+        self._listener_ready = threading.Event()
+        self._node_id = None
+        # Acertos, falhas, latência e tamanho por prefixo (exportados em /metrics)
+        self.metrics = CacheMetrics() if os.environ.get('CACHE_METRICS', '1') != '0' else None
+        # Tiles: orçamento global, cota por lâmina (bytes) e janela do doorkeeper
+        # (segundos; 0 admite tiles já no primeiro acesso)
+        self.tile_budget = int(os.environ.get('CACHE_TILE_BUDGET', 512 * 1024 * 1024))
+        self.tile_slide_quota = int(os.environ.get('CACHE_TILE_SLIDE_QUOTA', 64 * 1024 * 1024))
+        self.tile_doorkeeper_window = int(os.environ.get('CACHE_TILE_DOORKEEPER_WINDOW', 900))
         
         if app:
             self.init_app(app)
@@ -25,6 +400,10 @@ class CacheManager:
             self.redis_client.ping()
             self.enabled = True
             app.logger.info("Cache Redis inicializado")
+            
+            if self.sweep_interval > 0:
+                # Iniciada na primeira requisição de cada worker (após o fork)
+                app.before_request(lambda: self.start_sweeper(app))
         except Exception as e:
             app.logger.warning(f"Cache Redis não disponível: {e}")
             self.enabled = False
@@ -34,28 +413,266 @@ class CacheManager:
         if not self.enabled:
             return None
         
+        entry = self._get_entry(key)
+        if _is_envelope(entry):
+            # Valor servido apenas dentro da expiração lógica
+            return entry['v'] if time.time() < entry['e'] else None
+        return entry
+    
+    def _get_entry(self, key):
+        """Valor decodificado como gravado (inclusive envelopes)"""
+        if not self.enabled:
+            return None
+        
+        start = time.perf_counter()
         try:
-            value = self.redis_client.get(key)
+            value = self._get_raw(key)
+            self.record_metric('get', key, 'hit' if value else 'miss', start,
+                               len(value) if value else None)
             if value:
-                return json.loads(value.decode('utf-8'))
+                return decode_value(value)
         except Exception as e:
+            self.record_metric('get', key, 'error', start)
             current_app.logger.error(f"Erro ao ler cache: {e}")
         
         return None
     
-    def set(self, key, value, timeout=300):
-        """Definir valor no cache"""
+    def record_metric(self, op, key, result, start, size=None):
+        """Registrar operação nas métricas (start: time.perf_counter() do início)"""
+        if self.metrics is None:
+            return
+        
+        self.metrics.record(op, key, result, time.perf_counter() - start, size)
+        if self.enabled:
+            try:
+                self.metrics.maybe_flush(self.redis_client)
+            except Exception:
+                pass
+    
+    def get_many(self, keys):
+        """Obter várias chaves em uma ida ao Redis (MGET)
+        
+        Retorna (encontrados {chave: valor}, chaves ausentes na ordem recebida)
+        para que os ausentes sejam calculados e gravados em lote com set_many.
+        """
+        keys = list(dict.fromkeys(keys))
+        if not self.enabled or not keys:
+            return {}, keys
+        
+        hits = {}
+        start = time.perf_counter()
+        try:
+            raw_values = self._get_many_raw(keys)
+            for key in keys:
+                raw = raw_values.get(key)
+                self.record_metric('get', key, 'hit' if raw else 'miss', start,
+                                   len(raw) if raw else None)
+                entry = decode_value(raw) if raw else None
+                if _is_envelope(entry):
+                    entry = entry['v'] if time.time() < entry['e'] else None
+                if entry is not None:
+                    hits[key] = entry
+        except Exception as e:
+            current_app.logger.error(f"Erro ao ler cache em lote: {e}")
+        
+        return hits, [key for key in keys if key not in hits]
+    
+    def _get_many_raw(self, keys):
+        """Bytes de várias chaves (L1 primeiro, um MGET para o restante)"""
+        result = {}
+        remote = []
+        use_l1 = self.l1_prefixes and self._ensure_listener()
+        for key in keys:
+            if use_l1 and self._l1_ttl(key):
+                found, value = self.l1.get(key)
+                if found:
+                    self._count_l1_hit(key)
+                    result[key] = value
+                    continue
+            remote.append(key)
+        
+        if remote:
+            epoch = self.l1.epoch
+            for key, value in zip(remote, self.redis_client.mget(remote)):
+                if value is None:
+                    continue
+                result[key] = value
+                l1_ttl = use_l1 and self._l1_ttl(key)
+                if l1_ttl:
+                    self.l1.set(key, value, l1_ttl, epoch=epoch)
+        
+        return result
+    
+    def set_many(self, mapping, timeout=300, codec=None):
+        """Gravar várias chaves em uma ida ao Redis (pipeline sem transação)"""
+        if not self.enabled or not mapping:
+            return False
+        
+        start = time.perf_counter()
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            sizes = {}
+            for key, value in mapping.items():
+                serialized = self.encode(value, codec)
+                sizes[key] = len(serialized)
+                pipe.setex(key, timeout, serialized)
+            self._queue_invalidations(pipe, mapping.keys())
+            pipe.execute()
+            for key, size in sizes.items():
+                self.record_metric('set', key, 'ok', start, size)
+            return True
+        except Exception as e:
+            current_app.logger.error(f"Erro ao escrever cache em lote: {e}")
+            return False
+    
+    def delete_many(self, keys):
+        """Remover várias chaves com um único comando"""
+        keys = list(keys)
+        if not self.enabled or not keys:
+            return False
+        
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.unlink(*keys)
+            self._queue_invalidations(pipe, keys)
+            pipe.execute()
+            return True
+        except Exception as e:
+            current_app.logger.error(f"Erro ao deletar cache em lote: {e}")
+            return False
+    
+    def _queue_invalidations(self, pipe, keys):
+        """Incluir no pipeline as invalidações de L1 das chaves com prefixo habilitado"""
+        for key in keys:
+            if self._l1_ttl(key):
+                self.l1.invalidate(key)
+                pipe.publish(INVALIDATION_CHANNEL, f"{self._node_id or '-'} key {key}")
+    
+    def _l1_ttl(self, key):
+        """TTL local da chave, ou None se o prefixo não usa L1"""
+        if not self.l1_prefixes:
+            return None
+        return self.l1_prefixes.get(key.split(':', 1)[0])
+    
+    def _get_raw(self, key):
+        """Bytes da chave, pelo L1 quando o prefixo estiver habilitado"""
+        l1_ttl = self._l1_ttl(key)
+        if not l1_ttl or not self._ensure_listener():
+            return self.redis_client.get(key)
+        
+        found, value = self.l1.get(key)
+        if found:
+            self._count_l1_hit(key)
+            return value
+        
+        epoch = self.l1.epoch
+        value = self.redis_client.get(key)
+        if value is not None:
+            self.l1.set(key, value, l1_ttl, epoch=epoch)
+        return value
+    
+    def _count_l1_hit(self, key):
+        if self.metrics is not None:
+            self.metrics.count(key, 'l1_hit')
+    
+    def _publish_invalidation(self, kind, target):
+        """Avisar os demais processos para descartar a chave/padrão do L1"""
+        if kind == 'key':
+            if not self._l1_ttl(target):
+                return
+            self.l1.invalidate(target)
+        else:
+            if not self.l1_prefixes:
+                return
+            self.l1.invalidate_pattern(target)
+        
+        try:
+            self.redis_client.publish(INVALIDATION_CHANNEL, f"{self._node_id or '-'} {kind} {target}")
+        except Exception as e:
+            current_app.logger.error(f"Erro ao publicar invalidação do cache: {e}")
+    
+    def _ensure_listener(self):
+        """Garantir a assinatura de invalidações neste processo
+        
+        Sem assinatura ativa o L1 não é usado (valores poderiam ficar
+        desatualizados sem aviso).
+        """
+        listener = self._listener
+        if listener is not None and self._listener_pid == os.getpid() and listener.is_alive():
+            return self._listener_ready.is_set()
+        
+        with self._listener_lock:
+            # Threads não sobrevivem ao fork do gunicorn: recriar no processo filho
+            if self._listener is None or self._listener_pid != os.getpid() or not self._listener.is_alive():
+                self._node_id = f"{socket.gethostname()}:{os.getpid()}:{os.urandom(4).hex()}"
+                self._listener_ready = threading.Event()
+                self.l1.clear()
+                self._listener = threading.Thread(target=self._listen_invalidations,
+                                                  name='aiapad-cache-invalidation', daemon=True)
+                self._listener_pid = os.getpid()
+                self._listener.start()
+        return self._listener_ready.is_set()
+    
+    def _listen_invalidations(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.redis_client.pubsub(ignore_subscribe_messages=False)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        self._listener_ready.set()
+                        continue
+                    if message['type'] != 'message':
+                        continue
+                    
+                    sender, kind, target = message['data'].decode('utf-8').split(' ', 2)
+                    if sender == self._node_id:
+                        continue
+                    if kind == 'key':
+                        self.l1.invalidate(target)
+                    else:
+                        self.l1.invalidate_pattern(target)
+            except Exception:
+                pass
+            finally:
+                # Mensagens podem ter sido perdidas: L1 desativado até reassinar
+                self._listener_ready.clear()
+                self.l1.clear()
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(1)
+    
+    def set(self, key, value, timeout=300, codec=None):
+        """Definir valor no cache
+        
+        codec: 'json' (padrão), 'pickle' (dados internos; preserva datetime e
+        NumPy) ou 'msgpack' se instalado. Valores acima de compress_threshold
+        são comprimidos.
+        """
         if not self.enabled:
             return False
         
+        start = time.perf_counter()
         try:
-            serialized = json.dumps(value, default=str)
+            serialized = self.encode(value, codec)
             self.redis_client.setex(key, timeout, serialized)
+            self.record_metric('set', key, 'ok', start, len(serialized))
+            self._publish_invalidation('key', key)
             return True
         except Exception as e:
+            self.record_metric('set', key, 'error', start)
             current_app.logger.error(f"Erro ao escrever cache: {e}")
             return False
     
+    def encode(self, value, codec=None):
+        """Serializar valor no formato do cache (cabeçalho + dados)"""
+        return encode_value(value, codec or self.default_codec, self.compression,
+                            self.compress_threshold)
+    
     def delete(self, key):
         """Deletar chave do cache"""
         if not self.enabled:
@@ -63,25 +680,321 @@ class CacheManager:
         
         try:
             self.redis_client.delete(key)
+            self._publish_invalidation('key', key)
             return True
         except Exception as e:
             current_app.logger.error(f"Erro ao deletar cache: {e}")
             return False
     
     def clear_pattern(self, pattern):
-        """Limpar chaves que correspondem ao padrão"""
+        """Limpar chaves que correspondem ao padrão
+        
+        Usa SCAN em lotes e UNLINK (liberação em segundo plano no Redis), sem
+        bloquear outros clientes como KEYS. Para invalidar dados de uma lâmina
+        ou usuário, prefira bump_generation.
+        """
         if not self.enabled:
             return False
         
         try:
-            keys = self.redis_client.keys(pattern)
-            if keys:
-                self.redis_client.delete(*keys)
+            batch = []
+            for key in self.redis_client.scan_iter(match=pattern, count=SCAN_BATCH_SIZE):
+                batch.append(key)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    self.redis_client.unlink(*batch)
+                    batch = []
+            if batch:
+                self.redis_client.unlink(*batch)
+            self._publish_invalidation('pattern', pattern)
             return True
         except Exception as e:
             current_app.logger.error(f"Erro ao limpar cache: {e}")
             return False
     
+    def get_generation(self, tag):
+        """Geração atual de uma tag (ex.: 'slide:42')
+        
+        Contador ausente (nunca criado ou removido do Redis) é iniciado com o
+        instante atual em ms, nunca com um valor já usado por chaves antigas.
+        """
+        if not self.enabled:
+            return 0
+        
+        key = f"{GENERATION_KEY_PREFIX}{tag}"
+        try:
+            value = self._get_raw(key)
+            if value is None:
+                self.redis_client.set(key, int(time.time() * 1000), nx=True)
+                value = self.redis_client.get(key)
+            return int(value)
+        except Exception as e:
+            current_app.logger.error(f"Erro ao ler geração do cache: {e}")
+            return 0
+    
+    def bump_generation(self, tag):
+        """Invalidar todas as chaves de uma tag em O(1) (INCR da geração)"""
+        if not self.enabled:
+            return False
+        
+        key = f"{GENERATION_KEY_PREFIX}{tag}"
+        try:
+            pipe = self.redis_client.pipeline()
+            pipe.set(key, int(time.time() * 1000), nx=True)
+            pipe.incr(key)
+            pipe.execute()
+            self._publish_invalidation('key', key)
+            return True
+        except Exception as e:
+            current_app.logger.error(f"Erro ao invalidar cache: {e}")
+            return False
+    
+    def tagged_key(self, prefix, owner_id, *parts):
+        """Chave versionada: <prefixo>:<id>:g<geração>[:<partes>]"""
+        generation = self.get_generation(f"{TAGGED_PREFIXES[prefix]}:{owner_id}")
+        key = f"{prefix}:{owner_id}:g{generation}"
+        if parts:
+            key += ':' + ':'.join(str(part) for part in parts)
+        return key
+    
+    def sweep_stale_generations(self, max_keys=10000):
+        """Remover chaves de gerações antigas antes do TTL (libera memória)
+        
+        Percorre no máximo max_keys chaves por chamada; o cursor do SCAN fica
+        no Redis e a próxima chamada (de qualquer processo) continua dali.
+        Retorna o número de chaves removidas.
+        """
+        if not self.enabled:
+            return 0
+        
+        cursor_key = 'cache_sweep:cursor'
+        cursor = int(self.redis_client.get(cursor_key) or 0)
+        generations = {}
+        scanned = 0
+        removed = 0
+        
+        while True:
+            cursor, keys = self.redis_client.scan(cursor=cursor, count=SCAN_BATCH_SIZE)
+            stale = []
+            for key in keys:
+                match = TAGGED_KEY_RE.match(key.decode('utf-8', 'replace'))
+                if not match or match.group(1) not in TAGGED_PREFIXES:
+                    continue
+                
+                tag = f"{TAGGED_PREFIXES[match.group(1)]}:{match.group(2)}"
+                if tag not in generations:
+                    value = self.redis_client.get(f"{GENERATION_KEY_PREFIX}{tag}")
+                    generations[tag] = int(value) if value is not None else None
+                if generations[tag] is not None and int(match.group(3)) < generations[tag]:
+                    stale.append(key)
+            
+            if stale:
+                self.redis_client.unlink(*stale)
+                removed += len(stale)
+            
+            scanned += len(keys)
+            if cursor == 0 or scanned >= max_keys:
+                break
+        
+        self.redis_client.set(cursor_key, cursor)
+        return removed
+    
+    def start_sweeper(self, app):
+        """Iniciar varredura periódica neste processo, se configurada"""
+        if not self.enabled or self.sweep_interval <= 0:
+            return
+        
+        with self._sweeper_lock:
+            # Threads não sobrevivem ao fork do gunicorn: recriar no processo filho
+            if self._sweeper is not None and self._sweeper_pid == os.getpid() and self._sweeper.is_alive():
+                return
+            
+            self._sweeper = threading.Thread(target=self._sweep_loop, args=(app,),
+                                             name='aiapad-cache-sweeper', daemon=True)
+            self._sweeper_pid = os.getpid()
+            self._sweeper.start()
+    
+    def _sweep_loop(self, app):
+        while True:
+            time.sleep(self.sweep_interval * random.uniform(0.8, 1.2))
+            with app.app_context():
+                try:
+                    removed = self.sweep_stale_generations()
+                    if removed:
+                        app.logger.info(f"Cache: {removed} chaves de gerações antigas removidas")
+                except Exception as e:
+                    app.logger.error(f"Erro na varredura do cache: {e}")
+    
+    def get_or_compute(self, key, compute, timeout=300, codec=None, lock_timeout=60,
+                       stale_ttl=0, early_refresh_beta=0):
+        """Obter do cache ou calcular uma única vez por chave (single-flight)
+        
+        No processo, chamadas concorrentes aguardam o mesmo Future; entre
+        processos/nós, só quem obtém a trava no Redis (com lease de
+        lock_timeout segundos) calcula, e os demais aguardam o valor aparecer.
+        Se o dono da trava falhar ou o lease expirar, um dos que aguardam
+        assume o cálculo.
+        
+        stale_ttl > 0: após timeout o valor antigo continua sendo servido por
+        mais stale_ttl segundos enquanto um único recálculo roda em segundo
+        plano. early_refresh_beta > 0: recálculo antecipado probabilístico
+        (XFetch), mais provável perto da expiração e para valores caros.
+        """
+        swr = stale_ttl > 0 or early_refresh_beta > 0
+        if swr:
+            entry = self._get_entry(key)
+            if _is_envelope(entry):
+                now = time.time()
+                refresh_args = (key, compute, timeout, codec, lock_timeout, stale_ttl)
+                if now < entry['e']:
+                    if early_refresh_beta > 0 and self._should_refresh_early(entry, now, early_refresh_beta):
+                        self._refresh_in_background(*refresh_args)
+                    return entry['v']
+                if now < entry['e'] + stale_ttl:
+                    self._refresh_in_background(*refresh_args)
+                    return entry['v']
+            elif entry is not None:
+                return entry
+        else:
+            value = self.get(key)
+            if value is not None:
+                return value
+        
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        
+        if not leader:
+            return future.result()
+        
+        try:
+            result = self._compute_once(key, compute, timeout, codec, lock_timeout, stale_ttl if swr else None)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+    
+    def _compute_once(self, key, compute, timeout, codec, lock_timeout, stale_ttl=None):
+        """Calcular sob a trava distribuída ou aguardar quem a detém"""
+        if not self.enabled:
+            return compute()
+        
+        lock_key = f"{LOCK_KEY_PREFIX}{key}"
+        token = os.urandom(16).hex()
+        deadline = time.monotonic() + lock_timeout
+        delay = 0.05
+        
+        while True:
+            try:
+                acquired = self.redis_client.set(lock_key, token, nx=True, px=int(lock_timeout * 1000))
+            except Exception as e:
+                current_app.logger.error(f"Erro ao obter trava do cache: {e}")
+                return compute()
+            
+            if acquired:
+                try:
+                    # Outro processo pode ter gravado o valor entre o get e a trava
+                    value = self.get(key)
+                    if value is not None:
+                        return value
+                    
+                    return self._compute_and_store(key, compute, timeout, codec, stale_ttl)
+                finally:
+                    self._release_lock(lock_key, token)
+            
+            # Aguardar o valor (polling com espera crescente)
+            while time.monotonic() < deadline:
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+                
+                value = self.get(key)
+                if value is not None:
+                    return value
+                if not self.redis_client.exists(lock_key):
+                    break  # Dono falhou sem gravar: tentar obter a trava
+            else:
+                # Lease esgotado sem valor: calcular aqui em vez de esperar mais
+                return compute()
+    
+    def _compute_and_store(self, key, compute, timeout, codec, stale_ttl=None):
+        """Calcular e gravar; com stale_ttl, grava envelope com expiração lógica"""
+        start = time.time()
+        result = compute()
+        
+        if stale_ttl is None:
+            self.set(key, result, timeout, codec=codec)
+        else:
+            now = time.time()
+            envelope = {ENVELOPE_MARKER: 1, 'v': result, 'e': now + timeout, 'd': now - start}
+            # Permanece no Redis durante a janela em que pode ser servido vencido
+            self.set(key, envelope, int(timeout + stale_ttl), codec=codec)
+        return result
+    
+    def _should_refresh_early(self, entry, now, beta):
+        """XFetch: now - d * beta * ln(rand) >= expiração"""
+        return now - entry['d'] * beta * math.log(1.0 - random.random()) >= entry['e']
+    
+    def _refresh_in_background(self, key, compute, timeout, codec, lock_timeout, stale_ttl):
+        """Agendar um único recálculo da chave (no processo e entre processos)"""
+        with self._inflight_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            
+            # Executor criado sob demanda para não herdar threads através do fork
+            if self._refresh_executor is None or self._refresh_pid != os.getpid():
+                self._refresh_executor = ThreadPoolExecutor(max_workers=self.refresh_workers,
+                                                            thread_name_prefix='aiapad-cache-refresh')
+                self._refresh_pid = os.getpid()
+        
+        app = current_app._get_current_object()
+        if has_request_context():
+            compute = copy_current_request_context(compute)
+        
+        def refresh():
+            lock_key = f"{LOCK_KEY_PREFIX}{key}"
+            token = os.urandom(16).hex()
+            with app.app_context():
+                try:
+                    # Trava ocupada: outro processo já está recalculando
+                    if self.redis_client.set(lock_key, token, nx=True, px=int(lock_timeout * 1000)):
+                        try:
+                            self._compute_and_store(key, compute, timeout, codec, stale_ttl)
+                        finally:
+                            self._release_lock(lock_key, token)
+                except Exception as e:
+                    app.logger.error(f"Erro ao recalcular cache {key}: {e}")
+                finally:
+                    with self._inflight_lock:
+                        self._refreshing.discard(key)
+        
+        try:
+            self._refresh_executor.submit(refresh)
+        except Exception:
+            with self._inflight_lock:
+                self._refreshing.discard(key)
+            raise
+    
+    def script(self, source):
+        """Script Lua registrado no cliente atual (EVALSHA, com EVAL se não carregado)"""
+        script = self._scripts.get(source)
+        if script is None or script.registered_client is not self.redis_client:
+            script = self._scripts[source] = self.redis_client.register_script(source)
+        return script
+    
+    def _release_lock(self, lock_key, token):
+        """Remover trava apenas se ainda pertencer a este cálculo (compare-and-delete)"""
+        try:
+            self.script(RELEASE_LOCK_SCRIPT)(keys=[lock_key], args=[token])
+        except Exception as e:
+            current_app.logger.error(f"Erro ao liberar trava do cache: {e}")
+    
     def exists(self, key):
         """Verificar se chave existe no cache"""
         if not self.enabled:
@@ -105,8 +1018,15 @@ class CacheManager:
 # Instância global do cache
 cache = CacheManager()
 
-def cached(timeout=300, key_prefix=None, unless=None):
-    """Decorator para cache de funções"""
+def cached(timeout=300, key_prefix=None, unless=None, codec=None, stale_ttl=0,
+           early_refresh_beta=0, vary_on=None):
+    """Decorator para cache de funções
+    
+    codec: ver CacheManager.set. stale_ttl/early_refresh_beta: ver
+    CacheManager.get_or_compute (servir valor vencido enquanto recalcula).
+    vary_on: dados da requisição que alteram o resultado, ex.
+    ['user', 'query'] para endpoints que dependem do usuário e da query string.
+    """
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
@@ -114,19 +1034,16 @@ def cached(timeout=300, key_prefix=None, unless=None):
             if unless and unless():
                 return f(*args, **kwargs)
             
-            # Gerar chave do cache
-            cache_key = _generate_cache_key(f, key_prefix, args, kwargs)
-            
-            # Tentar obter do cache
-            cached_result = cache.get(cache_key)
-            if cached_result is not None:
-                return cached_result
-            
-            # Executar função e cachear resultado
-            result = f(*args, **kwargs)
-            cache.set(cache_key, result, timeout)
+            # Gerar chave do cache (argumentos sem representação estável: sem cache)
+            try:
+                cache_key = _generate_cache_key(f, key_prefix, args, kwargs, vary_on)
+            except UncacheableArgument as e:
+                current_app.logger.warning(f"Cache ignorado em {f.__qualname__}: {e}")
+                return f(*args, **kwargs)
             
-            return result
+            # Obter do cache ou executar uma única vez entre requisições concorrentes
+            return cache.get_or_compute(cache_key, lambda: f(*args, **kwargs), timeout, codec=codec,
+                                        stale_ttl=stale_ttl, early_refresh_beta=early_refresh_beta)
         
         return decorated_function
     return decorator
@@ -136,16 +1053,10 @@ def cache_slide_metadata(slide_id, timeout=3600):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            cache_key = f"slide_metadata:{slide_id}"
+            cache_key = cache.tagged_key('slide_metadata', slide_id)
             
-            cached_result = cache.get(cache_key)
-            if cached_result is not None:
-                return cached_result
-            
-            result = f(*args, **kwargs)
-            cache.set(cache_key, result, timeout)
-            
-            return result
+            # Extração de metadados abre a lâmina: uma única leitura por expiração
+            return cache.get_or_compute(cache_key, lambda: f(*args, **kwargs), timeout)
         
         return decorated_function
     return decorator
@@ -155,7 +1066,7 @@ def cache_user_permissions(user_id, timeout=900):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            cache_key = f"user_permissions:{user_id}"
+            cache_key = cache.tagged_key('user_permissions', user_id)
             
             cached_result = cache.get(cache_key)
             if cached_result is not None:
@@ -169,111 +1080,360 @@ def cache_user_permissions(user_id, timeout=900):
         return decorated_function
     return decorator
 
-def cache_ai_analysis(slide_id, analysis_type, timeout=7200):
-    """Cache específico para análises de IA"""
+def cache_ai_analysis(slide_id, analysis_type, timeout=7200, codec='pickle'):
+    """Cache específico para análises de IA
+    
+    Resultados são gerados internamente e contêm tipos NumPy/datetime: pickle
+    preserva os tipos e evita o custo do JSON em resultados grandes.
+    """
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            cache_key = f"ai_analysis:{slide_id}:{analysis_type}"
+            cache_key = cache.tagged_key('ai_analysis', slide_id, analysis_type)
             
-            cached_result = cache.get(cache_key)
-            if cached_result is not None:
-                return cached_result
-            
-            result = f(*args, **kwargs)
-            cache.set(cache_key, result, timeout)
-            
-            return result
+            # Análises concorrentes da mesma lâmina/tipo aguardam a primeira
+            return cache.get_or_compute(cache_key, lambda: f(*args, **kwargs), timeout,
+                                        codec=codec, lock_timeout=600)
         
         return decorated_function
     return decorator
 
 def invalidate_slide_cache(slide_id):
-    """Invalidar cache relacionado a uma lâmina"""
-    patterns = [
-        f"slide_metadata:{slide_id}",
-        f"slide_tiles:{slide_id}:*",
-        f"ai_analysis:{slide_id}:*",
-        f"slide_annotations:{slide_id}"
-    ]
-    
-    for pattern in patterns:
-        cache.clear_pattern(pattern)
+    """Invalidar cache relacionado a uma lâmina (metadados, tiles, análises, anotações)"""
+    generation = cache.bump_generation(f"slide:{slide_id}")
+    # Tiles da geração anterior saem já, liberando a cota e o orçamento
+    TileCache.release_slide(slide_id)
+    return generation
 
 def invalidate_user_cache(user_id):
-    """Invalidar cache relacionado a um usuário"""
-    patterns = [
-        f"user_permissions:{user_id}",
-        f"user_slides:{user_id}",
-        f"user_stats:{user_id}"
-    ]
-    
-    for pattern in patterns:
-        cache.clear_pattern(pattern)
-
-def _generate_cache_key(func, key_prefix, args, kwargs):
-    """Gerar chave única para cache"""
-    # Nome da função
-    func_name = f"{func.__module__}.{func.__name__}"
-    
-    # Serializar argumentos
-    args_str = str(args) + str(sorted(kwargs.items()))
-    args_hash = hashlib.md5(args_str.encode()).hexdigest()[:8]
-    
-    # Incluir informações da requisição se disponível
-    request_info = ""
-    try:
-        if request:
-            request_info = f":{request.method}:{request.endpoint}"
-    except:
-        pass
-    
-    # Montar chave final
-    if key_prefix:
-        return f"{key_prefix}:{func_name}:{args_hash}{request_info}"
-    else:
-        return f"cache:{func_name}:{args_hash}{request_info}"
+    """Invalidar cache relacionado a um usuário (permissões, lâminas, estatísticas)"""
+    return cache.bump_generation(f"user:{user_id}")
+
+class UncacheableArgument(TypeError):
+    """Argumento sem representação estável: a chamada não usa o cache"""
+    pass
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _canonicalize(value):
+    """Representação estável (serializável em JSON) de um argumento
+    
+    Dicionários e conjuntos são ordenados, objetos do ORM viram
+    <tabela>:<chave primária> e arrays NumPy viram dtype/shape/digest do
+    conteúdo. Objetos sem representação estável levantam UncacheableArgument
+    (o repr padrão inclui o endereço de memória e nunca se repetiria).
+    """
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return {'float': repr(value)}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'bytes': _digest(bytes(value))}
+    if isinstance(value, (list, tuple)):
+        return [_canonicalize(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        items = [_canonicalize(item) for item in value]
+        return {'set': sorted(items, key=lambda item: json.dumps(item, sort_keys=True))}
+    if isinstance(value, dict):
+        items = [[_canonicalize(key), _canonicalize(item)] for key, item in value.items()]
+        return {'dict': sorted(items, key=lambda item: json.dumps(item[0], sort_keys=True))}
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value)
+        return {'ndarray': [str(data.dtype), list(data.shape), _digest(data.tobytes())]}
+    if isinstance(value, np.generic):
+        return _canonicalize(value.item())
+    if isinstance(value, (datetime, date)):
+        return {type(value).__name__: value.isoformat()}
+    if isinstance(value, (Decimal, UUID)):
+        return {type(value).__name__: str(value)}
+    if hasattr(value, 'cache_key') and callable(value.cache_key):
+        return {'key': value.cache_key()}
+    if hasattr(value, '__table__'):
+        identity = sa_inspect(value).identity
+        if identity is None:
+            raise UncacheableArgument(f"Objeto {type(value).__name__} ainda sem chave primária")
+        return {'model': f"{value.__table__.name}:{':'.join(str(part) for part in identity)}"}
+    
+    raise UncacheableArgument(f"Argumento sem representação estável para cache: {type(value).__name__}")
+
+def _vary_values(vary_on):
+    """Valores da requisição declarados em vary_on ('user', 'query', 'path', 'view_args' ou função)"""
+    values = []
+    for item in vary_on or ():
+        if callable(item):
+            values.append(item())
+        elif not has_request_context():
+            values.append(None)
+        elif item == 'user':
+            try:
+                values.append(get_jwt_identity())
+            except Exception:
+                values.append(None)
+        elif item == 'query':
+            values.append(sorted(request.args.items(multi=True)))
+        elif item == 'path':
+            values.append(request.path)
+        elif item == 'view_args':
+            values.append(request.view_args or {})
+        else:
+            raise ValueError(f"vary_on desconhecido: {item}")
+    return values
+
+def _generate_cache_key(func, key_prefix, args, kwargs, vary_on=None):
+    """Gerar chave única para cache
+    
+    Hash BLAKE2b (128 bits) da serialização canônica da função, argumentos e
+    valores de vary_on. Dados da requisição só entram quando declarados em
+    vary_on, então a mesma chamada gera a mesma chave em qualquer endpoint.
+    """
+    func_name = f"{func.__module__}.{func.__qualname__}"
+    
+    payload = json.dumps([
+        func_name,
+        _canonicalize(list(args)),
+        _canonicalize(kwargs),
+        _canonicalize(_vary_values(vary_on))
+    ], separators=(',', ':'), ensure_ascii=False)
+    
+    return f"{key_prefix or 'cache'}:{func_name}:{_digest(payload.encode('utf-8'))}"
 
 class TileCache:
-    """Cache específico para tiles de lâminas"""
+    """Cache específico para tiles de lâminas
+    
+    Um tile só é gravado no segundo pedido dentro da janela do doorkeeper
+    (varreduras completas de uma lâmina não ocupam o cache), cada lâmina tem
+    uma cota de bytes e, no orçamento global, sai primeiro o tile com menor
+    prioridade GDSF (poucos acessos por byte). Ver TILE_ADMIT_SCRIPT.
+    """
     
     @staticmethod
     def get_tile_key(slide_id, level, x, y, width, height):
-        """Gerar chave para tile"""
-        return f"slide_tiles:{slide_id}:{level}:{x}:{y}:{width}:{height}"
+        """Gerar chave para tile (inclui a geração da lâmina)"""
+        return cache.tagged_key('slide_tiles', slide_id, level, x, y, width, height)
+    
+    @staticmethod
+    def _doorkeeper_positions(key):
+        """Bits do tile no bitmap do doorkeeper"""
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8 * TILE_DOORKEEPER_HASHES).digest()
+        return [
+            int.from_bytes(digest[i * 8:(i + 1) * 8], 'little') % TILE_DOORKEEPER_BITS
+            for i in range(TILE_DOORKEEPER_HASHES)
+        ]
+    
+    @staticmethod
+    def _admit(slide_id, key, tile_data, timeout, client=None, force=False):
+        """Executar o script de admissão (client: pipeline opcional; force: sem doorkeeper)"""
+        now = time.time()
+        window = 0 if force else cache.tile_doorkeeper_window
+        window_id = int(now // window) if window > 0 else 0
+        
+        keys = [key, TILE_INDEX_KEY, f"{TILE_SLIDE_INDEX_PREFIX}{slide_id}", TILE_EXPIRY_KEY,
+                TILE_META_KEY, TILE_USAGE_KEY,
+                f"{TILE_SEEN_PREFIX}{window_id}", f"{TILE_SEEN_PREFIX}{window_id - 1}"]
+        args = [tile_data, int(timeout), len(tile_data), slide_id, cache.tile_slide_quota,
+                cache.tile_budget, int(now), window * 2, TILE_EXPIRY_BATCH, TILE_MAX_EVICTIONS]
+        if window > 0:
+            args += TileCache._doorkeeper_positions(key)
+        return cache.script(TILE_ADMIT_SCRIPT)(keys=keys, args=args, client=client)
+    
+    @staticmethod
+    def _unlink(keys):
+        """Apagar dados de tiles já retirados dos índices pelos scripts"""
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            cache.redis_client.unlink(*keys[i:i + 500])
+    
+    @staticmethod
+    def _record_admission(key, result, start, size):
+        """Métricas da admissão: ok (gravado) ou rejected, e tiles removidos"""
+        status, evicted = int(result[0]), int(result[1])
+        if evicted:
+            TileCache._unlink(result[2:])
+        cache.record_metric('set', key, 'ok' if status == 1 else 'rejected', start, size)
+        if evicted and cache.metrics is not None:
+            cache.metrics.count(key, 'evictions', evicted)
+        return status == 1
     
     @staticmethod
     def cache_tile(slide_id, level, x, y, width, height, tile_data, timeout=3600):
-        """Cachear tile"""
-        key = TileCache.get_tile_key(slide_id, level, x, y, width, height)
+        """Cachear tile, se admitido (ver TileCache)"""
+        key = f"{TileCache.get_tile_key(slide_id, level, x, y, width, height)}:binary"
         
-        # Para tiles, usar cache binário se possível
         if cache.enabled:
+            start = time.perf_counter()
             try:
-                cache.redis_client.setex(f"{key}:binary", timeout, tile_data)
-                return True
-            except:
+                result = TileCache._admit(slide_id, key, tile_data, timeout)
+                return TileCache._record_admission(key, result, start, len(tile_data))
+            except Exception:
+                cache.record_metric('set', key, 'error', start)
                 return False
         
         return False
     
+    @staticmethod
+    def _touch(slide_id, keys):
+        """Ler tiles e registrar o acesso (prioridade GDSF e lâmina recente) em uma ida ao Redis"""
+        return cache.script(TILE_TOUCH_SCRIPT)(
+            keys=[TILE_INDEX_KEY, TILE_META_KEY, TILE_USAGE_KEY, f"{TILE_SLIDE_INDEX_PREFIX}{slide_id}",
+                  RECENT_SLIDES_KEY] + list(keys),
+            args=[slide_id, int(time.time()), RECENT_SLIDES_MAX]
+        )
+    
     @staticmethod
     def get_tile(slide_id, level, x, y, width, height):
         """Obter tile do cache"""
-        key = TileCache.get_tile_key(slide_id, level, x, y, width, height)
+        key = f"{TileCache.get_tile_key(slide_id, level, x, y, width, height)}:binary"
         
         if cache.enabled:
+            start = time.perf_counter()
             try:
-                return cache.redis_client.get(f"{key}:binary")
-            except:
+                tile = TileCache._touch(slide_id, [key])[0]
+                cache.record_metric('get', key, 'hit' if tile is not None else 'miss', start,
+                                    len(tile) if tile is not None else None)
+                return tile
+            except Exception:
+                cache.record_metric('get', key, 'error', start)
                 return None
         
         return None
     
+    @staticmethod
+    def _batch_keys(slide_id, tiles):
+        """Chaves binárias de vários tiles (uma única consulta da geração da lâmina)"""
+        base = cache.tagged_key('slide_tiles', slide_id)
+        return {
+            tuple(tile): f"{base}:{':'.join(str(part) for part in tile)}:binary"
+            for tile in tiles
+        }
+    
+    @staticmethod
+    def get_tiles(slide_id, tiles):
+        """Obter vários tiles (level, x, y, width, height) em uma ida ao Redis
+        
+        Retorna (encontrados {tile: bytes}, tiles ausentes) para que os
+        ausentes sejam gerados e gravados com cache_tiles.
+        """
+        tiles = [tuple(tile) for tile in tiles]
+        if not cache.enabled or not tiles:
+            return {}, tiles
+        
+        keys = TileCache._batch_keys(slide_id, tiles)
+        start = time.perf_counter()
+        try:
+            values = TileCache._touch(slide_id, keys.values())
+        except Exception:
+            return {}, tiles
+        
+        hits = {}
+        for tile, value in zip(keys, values):
+            cache.record_metric('get', keys[tile], 'hit' if value is not None else 'miss', start,
+                                len(value) if value is not None else None)
+            if value is not None:
+                hits[tile] = value
+        return hits, [tile for tile in keys if tile not in hits]
+    
+    @staticmethod
+    def cache_tiles(slide_id, tile_data, timeout=3600, force=False):
+        """Cachear vários tiles ({(level, x, y, width, height): bytes}) em um pipeline
+        
+        force ignora o doorkeeper (aquecimento do cache); cota e orçamento
+        continuam valendo. Retorna o número de tiles admitidos.
+        """
+        if not cache.enabled or not tile_data:
+            return 0
+        
+        keys = TileCache._batch_keys(slide_id, tile_data.keys())
+        try:
+            pipe = cache.redis_client.pipeline(transaction=False)
+            start = time.perf_counter()
+            for tile, data in tile_data.items():
+                TileCache._admit(slide_id, keys[tuple(tile)], data, timeout, client=pipe, force=force)
+            results = pipe.execute()
+            return sum(
+                TileCache._record_admission(keys[tuple(tile)], result, start, len(data))
+                for (tile, data), result in zip(tile_data.items(), results)
+            )
+        except Exception:
+            return 0
+    
+    @staticmethod
+    def get_thumbnail(slide_id):
+        """Obter thumbnail (JPEG) da lâmina do cache"""
+        if not cache.enabled:
+            return None
+        
+        key = f"{cache.tagged_key('slide_thumbnail', slide_id)}:binary"
+        start = time.perf_counter()
+        try:
+            thumbnail = cache.redis_client.get(key)
+            cache.record_metric('get', key, 'hit' if thumbnail is not None else 'miss', start,
+                                len(thumbnail) if thumbnail is not None else None)
+            return thumbnail
+        except Exception:
+            cache.record_metric('get', key, 'error', start)
+            return None
+    
+    @staticmethod
+    def cache_thumbnail(slide_id, thumbnail, timeout=86400):
+        """Cachear thumbnail (pequeno e usado em toda listagem: sem admissão)"""
+        if not cache.enabled:
+            return False
+        
+        key = f"{cache.tagged_key('slide_thumbnail', slide_id)}:binary"
+        start = time.perf_counter()
+        try:
+            cache.redis_client.setex(key, timeout, thumbnail)
+            cache.record_metric('set', key, 'ok', start, len(thumbnail))
+            return True
+        except Exception:
+            cache.record_metric('set', key, 'error', start)
+            return False
+    
+    @staticmethod
+    def release_slide(slide_id):
+        """Remover todos os tiles da lâmina do cache e da contagem de bytes"""
+        if not cache.enabled:
+            return 0
+        
+        try:
+            released = cache.script(TILE_RELEASE_SCRIPT)(
+                keys=[TILE_INDEX_KEY, f"{TILE_SLIDE_INDEX_PREFIX}{slide_id}", TILE_EXPIRY_KEY,
+                      TILE_META_KEY, TILE_USAGE_KEY],
+                args=[slide_id]
+            )
+            TileCache._unlink(released)
+            return len(released)
+        except Exception as e:
+            current_app.logger.error(f"Erro ao liberar tiles da lâmina {slide_id}: {e}")
+            return 0
+    
+    @staticmethod
+    def get_usage():
+        """Bytes de tiles em cache (total e por lâmina) frente ao orçamento"""
+        usage = {'enabled': cache.enabled, 'budget_bytes': cache.tile_budget,
+                 'slide_quota_bytes': cache.tile_slide_quota, 'total_bytes': 0,
+                 'tiles': 0, 'slides': {}}
+        if not cache.enabled:
+            return usage
+        
+        pipe = cache.redis_client.pipeline(transaction=False)
+        pipe.hgetall(TILE_USAGE_KEY)
+        pipe.zcard(TILE_INDEX_KEY)
+        fields, usage['tiles'] = pipe.execute()
+        
+        for field, value in fields.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            if field == 'total':
+                usage['total_bytes'] = int(value)
+            elif field != 'clock' and int(value) > 0:
+                usage['slides'][field] = int(value)
+        return usage
+    
     @staticmethod
     def invalidate_slide_tiles(slide_id):
-        """Invalidar todos os tiles de uma lâmina"""
-        cache.clear_pattern(f"slide_tiles:{slide_id}:*")
+        """Invalidar todos os tiles de uma lâmina (junto com o restante do cache da lâmina)"""
+        return invalidate_slide_cache(slide_id)
 
 class SessionCache:
     """Cache para sessões de usuário"""
@@ -314,12 +1474,25 @@ class StatsCache:
     @staticmethod
     def cache_user_stats(user_id, stats, timeout=900):
         """Cachear estatísticas do usuário"""
-        key = f"user_stats:{user_id}"
+        key = cache.tagged_key('user_stats', user_id)
         return cache.set(key, stats, timeout)
     
     @staticmethod
     def get_user_stats(user_id):
         """Obter estatísticas do usuário"""
-        key = f"user_stats:{user_id}"
+        key = cache.tagged_key('user_stats', user_id)
         return cache.get(key)
+    
+    @staticmethod
+    def get_or_compute_system_stats(compute, timeout=300, stale_ttl=900, early_refresh_beta=1.0):
+        """Estatísticas do sistema; após expirar, o valor anterior é servido enquanto recalcula"""
+        return cache.get_or_compute("system_stats", compute, timeout, stale_ttl=stale_ttl,
+                                    early_refresh_beta=early_refresh_beta)
+    
+    @staticmethod
+    def get_or_compute_user_stats(user_id, compute, timeout=900, stale_ttl=1800, early_refresh_beta=1.0):
+        """Estatísticas do usuário com recálculo em segundo plano (ver get_or_compute_system_stats)"""
+        key = cache.tagged_key('user_stats', user_id)
+        return cache.get_or_compute(key, compute, timeout, stale_ttl=stale_ttl,
+                                    early_refresh_beta=early_refresh_beta)
 
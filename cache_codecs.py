@@ -0,0 +1,112 @@
+import json
+import zlib
+import pickle
+from typing import Any, Callable, Dict, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Formato dos valores: [id do codec][id da compressão][dados]
+# O primeiro byte de valores gravados em JSON puro (versões anteriores) nunca é
+# um byte de controle, então valores sem cabeçalho continuam legíveis.
+HEADER_SIZE = 2
+
+class CacheCodecError(ValueError):
+    """Valor do cache com codec ou compressão indisponível neste processo"""
+    pass
+
+def _json_dumps(value: Any) -> bytes:
+    return json.dumps(value, default=str).encode('utf-8')
+
+def _json_loads(data: bytes) -> Any:
+    return json.loads(data.decode('utf-8'))
+
+def _pickle_dumps(value: Any) -> bytes:
+    # Protocolo 5: buffers grandes (ex.: arrays NumPy) sem cópias intermediárias
+    return pickle.dumps(value, protocol=5)
+
+# nome -> (id, serializar, desserializar)
+CODECS: Dict[str, Tuple[int, Callable[[Any], bytes], Callable[[bytes], Any]]] = {
+    'json': (1, _json_dumps, _json_loads),
+    # Apenas para dados internos confiáveis: desserializar pickle executa código
+    'pickle': (2, _pickle_dumps, pickle.loads),
+}
+
+if msgpack is not None:
+    CODECS['msgpack'] = (3, lambda value: msgpack.packb(value, use_bin_type=True),
+                         lambda data: msgpack.unpackb(data, raw=False))
+
+# nome -> (id, comprimir, descomprimir)
+COMPRESSORS: Dict[str, Tuple[int, Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    'zlib': (1, lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+
+if zstandard is not None:
+    COMPRESSORS['zstd'] = (2, lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                           lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+if lz4 is not None:
+    COMPRESSORS['lz4'] = (3, lz4.frame.compress, lz4.frame.decompress)
+
+CODECS_BY_ID = {codec_id: (name, loads) for name, (codec_id, _, loads) in CODECS.items()}
+COMPRESSORS_BY_ID = {comp_id: (name, decompress) for name, (comp_id, _, decompress) in COMPRESSORS.items()}
+
+def default_compression() -> str:
+    """Compressão mais rápida disponível (zstd > lz4 > zlib)"""
+    for name in ('zstd', 'lz4', 'zlib'):
+        if name in COMPRESSORS:
+            return name
+    return None
+
+def encode_value(value: Any, codec: str = 'json', compression: str = None,
+                 compress_threshold: int = 4096) -> bytes:
+    """Serializar valor com cabeçalho de codec/compressão
+    
+    Comprime apenas acima de compress_threshold bytes e só mantém a versão
+    comprimida se ela for menor.
+    """
+    if codec not in CODECS:
+        raise CacheCodecError(f'Codec de cache indisponível: {codec}')
+    
+    codec_id, dumps, _ = CODECS[codec]
+    data = dumps(value)
+    
+    compression_id = 0
+    if compression and len(data) >= compress_threshold:
+        if compression not in COMPRESSORS:
+            raise CacheCodecError(f'Compressão de cache indisponível: {compression}')
+        compression_id, compress, _ = COMPRESSORS[compression]
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            data = compressed
+        else:
+            compression_id = 0
+    
+    return bytes((codec_id, compression_id)) + data
+
+def decode_value(raw: bytes) -> Any:
+    """Desserializar valor gravado por encode_value (ou JSON sem cabeçalho)"""
+    if not raw or raw[0] not in CODECS_BY_ID:
+        return json.loads(raw.decode('utf-8'))
+    
+    codec_id, compression_id = raw[0], raw[1]
+    data = raw[HEADER_SIZE:]
+    
+    if compression_id:
+        if compression_id not in COMPRESSORS_BY_ID:
+            raise CacheCodecError(f'Compressão {compression_id} indisponível neste processo')
+        data = COMPRESSORS_BY_ID[compression_id][1](data)
+    
+    return CODECS_BY_ID[codec_id][1](data)
@@ -0,0 +1,149 @@
+import time
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+# Limites dos histogramas de latência (s) e tamanho de valor (bytes)
+CACHE_LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1]
+CACHE_SIZE_BUCKETS = [2 ** p for p in range(6, 26, 2)]  # 64B .. 16MB
+
+METRICS_KEY_PREFIX = 'cache_metrics:'
+METRICS_PREFIXES_KEY = 'cache_metrics:prefixes'
+TOP_HITS_KEY = 'cache_metrics:top_access'
+TOP_SIZES_KEY = 'cache_metrics:top_size'
+
+def key_prefix(key: str) -> str:
+    """Prefixo da chave usado como label (ex.: 'slide_tiles', 'cache')"""
+    return key.split(':', 1)[0] or 'unknown'
+
+def _bucket_field(name: str, buckets: List[float], value: float) -> str:
+    """Campo do bucket (não cumulativo) em que o valor cai"""
+    index = bisect_left(buckets, value)
+    bound = buckets[index] if index < len(buckets) else '+Inf'
+    return f"{name}_le_{bound}"
+
+class CacheMetrics:
+    """Contadores do cache por prefixo de chave, agregados entre workers via Redis
+
+    Cada processo acumula localmente e soma no Redis a cada flush_interval
+    segundos (um pipeline). Acessos e tamanhos por chave alimentam rankings
+    limitados a top_keys entradas.
+    """
+
+    def __init__(self, flush_interval: float = 10.0, top_keys: int = 1000,
+                 keys_per_flush: int = 200):
+        self.flush_interval = flush_interval
+        self.max_top_keys = top_keys
+        self.keys_per_flush = keys_per_flush
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._key_access = Counter()
+        self._key_sizes = {}
+        # Totais do processo quando não há Redis para agregar
+        self._totals = defaultdict(float)
+        self._last_flush = time.monotonic()
+
+    def record(self, op: str, key: str, result: str, elapsed: float, size: Optional[int] = None):
+        """Registrar uma operação (op: get/set/...; result: hit/miss/ok/error)"""
+        prefix = key_prefix(key)
+        with self._lock:
+            counters = self._counters
+            counters[(prefix, f"{op}_{result}")] += 1
+            counters[(prefix, f"{op}_latency_sum")] += elapsed
+            counters[(prefix, f"{op}_latency_count")] += 1
+            counters[(prefix, _bucket_field(f"{op}_latency", CACHE_LATENCY_BUCKETS, elapsed))] += 1
+
+            if size is not None:
+                counters[(prefix, 'size_sum')] += size
+                counters[(prefix, 'size_count')] += 1
+                counters[(prefix, _bucket_field('size', CACHE_SIZE_BUCKETS, size))] += 1
+                self._key_sizes[key] = size
+
+            if op == 'get':
+                self._key_access[key] += 1
+
+    def count(self, key: str, field: str, amount: int = 1):
+        """Incrementar um contador simples (ex.: acertos no L1)"""
+        with self._lock:
+            self._counters[(key_prefix(key), field)] += amount
+
+    def maybe_flush(self, client):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush(client)
+
+    def flush(self, client):
+        """Somar contadores acumulados no Redis (ou nos totais locais)"""
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(float)
+            key_access, self._key_access = self._key_access, Counter()
+            key_sizes, self._key_sizes = self._key_sizes, {}
+            self._last_flush = time.monotonic()
+
+        if client is None:
+            with self._lock:
+                for field, value in counters.items():
+                    self._totals[field] += value
+            return
+
+        pipe = client.pipeline(transaction=False)
+        prefixes = set()
+        for (prefix, field), value in counters.items():
+            prefixes.add(prefix)
+            if float(value).is_integer():
+                pipe.hincrby(f"{METRICS_KEY_PREFIX}{prefix}", field, int(value))
+            else:
+                pipe.hincrbyfloat(f"{METRICS_KEY_PREFIX}{prefix}", field, value)
+        if prefixes:
+            pipe.sadd(METRICS_PREFIXES_KEY, *prefixes)
+
+        for key, hits in key_access.most_common(self.keys_per_flush):
+            pipe.zincrby(TOP_HITS_KEY, hits, key)
+        largest = sorted(key_sizes.items(), key=lambda item: item[1], reverse=True)[:self.keys_per_flush]
+        if largest:
+            pipe.zadd(TOP_SIZES_KEY, dict(largest))
+
+        # Manter apenas as maiores entradas dos rankings
+        pipe.zremrangebyrank(TOP_HITS_KEY, 0, -(self.max_top_keys + 1))
+        pipe.zremrangebyrank(TOP_SIZES_KEY, 0, -(self.max_top_keys + 1))
+        pipe.execute()
+
+    def snapshot(self, client) -> Dict[str, Dict[str, float]]:
+        """Contadores agregados por prefixo: {prefixo: {campo: valor}}"""
+        self.flush(client)
+
+        if client is None:
+            result = defaultdict(dict)
+            with self._lock:
+                for (prefix, field), value in self._totals.items():
+                    result[prefix][field] = value
+            return dict(result)
+
+        prefixes = sorted(p.decode() if isinstance(p, bytes) else p
+                          for p in client.smembers(METRICS_PREFIXES_KEY))
+        pipe = client.pipeline(transaction=False)
+        for prefix in prefixes:
+            pipe.hgetall(f"{METRICS_KEY_PREFIX}{prefix}")
+
+        result = {}
+        for prefix, fields in zip(prefixes, pipe.execute()):
+            result[prefix] = {
+                (field.decode() if isinstance(field, bytes) else field): float(value)
+                for field, value in fields.items()
+            }
+        return result
+
+    def top_keys(self, client, limit: int = 50) -> Dict[str, List[Dict]]:
+        """Chaves mais acessadas e maiores valores observados"""
+        if client is None:
+            return {'by_access': [], 'by_size': []}
+
+        self.flush(client)
+
+        def ranking(key, field):
+            return [
+                {'key': member.decode('utf-8', 'replace'), field: int(score)}
+                for member, score in client.zrevrange(key, 0, limit - 1, withscores=True)
+            ]
+
+        return {'by_access': ranking(TOP_HITS_KEY, 'accesses'), 'by_size': ranking(TOP_SIZES_KEY, 'bytes')}
@@ -0,0 +1,228 @@
+import io
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+import click
+from flask import current_app
+import openslide
+from src.models.slide import Slide, db
+from src.utils.cache import cache, TileCache, RECENT_SLIDES_KEY
+from src.utils.slide_processor import SlideProcessor
+
+# Lâminas aquecidas por execução completa (após deploy/restart do Redis)
+WARMUP_SLIDES = int(os.environ.get('CACHE_WARMUP_SLIDES', 50))
+# Tiles dos níveis mais reduzidos da pirâmide por lâmina
+WARMUP_TILES_PER_SLIDE = int(os.environ.get('CACHE_WARMUP_TILES_PER_SLIDE', 64))
+# Itens gravados por segundo (não competir com o tráfego real)
+WARMUP_RATE = float(os.environ.get('CACHE_WARMUP_RATE', 20))
+# Executar ao iniciar a aplicação (uma vez entre todos os workers)
+WARMUP_ON_START = os.environ.get('CACHE_WARMUP_ON_START', '0') == '1'
+
+# Formato servido pelas rotas de tile/thumbnail
+WARMUP_TILE_SIZE = 256
+WARMUP_JPEG_QUALITY = 85
+THUMBNAIL_SIZE = (300, 300)
+
+# TTL igual ao das rotas de tile
+TILE_TIMEOUT = 3600
+
+# Trava da execução completa: apenas um processo aquece por vez
+WARMUP_LOCK_KEY = 'cache_warmup:lock'
+WARMUP_LOCK_TTL = 1800
+
+class Throttle:
+    """Limita a taxa de itens processados (dorme entre itens)"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self.interval
+
+def get_recent_slide_ids(limit: int = WARMUP_SLIDES) -> List[int]:
+    """Lâminas visualizadas recentemente; completa com as últimas lâminas prontas"""
+    slide_ids = []
+    if cache.enabled:
+        try:
+            slide_ids = [int(member) for member in cache.redis_client.zrevrange(RECENT_SLIDES_KEY, 0, limit - 1)]
+        except Exception:
+            slide_ids = []
+
+    if len(slide_ids) < limit:
+        query = Slide.query.filter_by(status='ready')
+        if slide_ids:
+            query = query.filter(~Slide.id.in_(slide_ids))
+        latest = query.order_by(Slide.upload_date.desc()).limit(limit - len(slide_ids)).all()
+        slide_ids += [slide.id for slide in latest]
+
+    return slide_ids
+
+def _encode_jpeg(image) -> bytes:
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, 'JPEG', quality=WARMUP_JPEG_QUALITY)
+    return buffer.getvalue()
+
+def top_level_tiles(slide_obj, max_tiles: int = WARMUP_TILES_PER_SLIDE) -> List[tuple]:
+    """Tiles (level, x, y, width, height) dos níveis mais reduzidos que cabem em max_tiles
+
+    x/y em coordenadas do nível 0, como nas rotas de tile.
+    """
+    tiles = []
+    for level in range(slide_obj.level_count - 1, -1, -1):
+        width, height = slide_obj.level_dimensions[level]
+        downsample = slide_obj.level_downsamples[level]
+        count = -(-width // WARMUP_TILE_SIZE) * -(-height // WARMUP_TILE_SIZE)
+        if len(tiles) + count > max_tiles:
+            break
+
+        for y in range(0, height, WARMUP_TILE_SIZE):
+            for x in range(0, width, WARMUP_TILE_SIZE):
+                tiles.append((level, int(x * downsample), int(y * downsample),
+                              min(WARMUP_TILE_SIZE, width - x), min(WARMUP_TILE_SIZE, height - y)))
+    return tiles
+
+def _missing_tiles(slide_id: int, tiles: List[tuple]) -> List[tuple]:
+    """Tiles ainda fora do cache (EXISTS não conta como acesso na prioridade)"""
+    keys = TileCache._batch_keys(slide_id, tiles)
+    pipe = cache.redis_client.pipeline(transaction=False)
+    for key in keys.values():
+        pipe.exists(key)
+    return [tile for tile, exists in zip(keys, pipe.execute()) if not exists]
+
+class CacheWarmer:
+    """Pré-carrega no cache thumbnails e tiles dos níveis superiores das lâminas
+
+    Entradas de decorators (slide_metadata, user_permissions) não são
+    aquecidas: o valor é o que a função decorada produz, e gravá-lo daqui
+    exigiria reproduzir esse formato.
+    """
+
+    def __init__(self, rate: float = None):
+        self.rate = WARMUP_RATE if rate is None else rate
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Um único worker: execuções em fila, nunca em paralelo com elas mesmas
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aiapad-warmup')
+            return self._executor
+
+    def submit(self, app, slide_ids: Optional[List[int]] = None):
+        """Agendar aquecimento em segundo plano (sem ids: lâminas recentes)"""
+        return self._get_executor().submit(self._run, app, slide_ids)
+
+    def _run(self, app, slide_ids):
+        with app.app_context():
+            try:
+                if slide_ids is None:
+                    stats = self.warm_recent()
+                else:
+                    stats = self.warm(slide_ids)
+                app.logger.info(f"Aquecimento do cache: {stats}")
+            except Exception as e:
+                app.logger.error(f"Erro no aquecimento do cache: {e}")
+            finally:
+                db.session.remove()
+
+    def warm_recent(self, slides: int = WARMUP_SLIDES) -> Dict:
+        """Aquecer lâminas recentes (uma execução por vez entre processos)"""
+        if not cache.enabled:
+            return {'skipped': 'cache indisponível'}
+
+        token = f"{os.getpid()}:{time.time()}"
+        if not cache.redis_client.set(WARMUP_LOCK_KEY, token, nx=True, ex=WARMUP_LOCK_TTL):
+            return {'skipped': 'aquecimento já em andamento'}
+
+        try:
+            return self.warm(get_recent_slide_ids(slides))
+        finally:
+            cache._release_lock(WARMUP_LOCK_KEY, token)
+
+    def warm(self, slide_ids: Iterable[int]) -> Dict:
+        """Aquecer as lâminas indicadas; itens já em cache são pulados"""
+        stats = {'slides': 0, 'thumbnails': 0, 'tiles': 0, 'cached': 0, 'errors': 0}
+        if not cache.enabled:
+            return stats
+
+        started = time.monotonic()
+        throttle = Throttle(self.rate)
+
+        for slide_id in slide_ids:
+            slide = Slide.query.get(slide_id)
+            if slide is None or slide.status != 'ready':
+                continue
+            try:
+                self.warm_slide(slide, throttle, stats)
+                stats['slides'] += 1
+            except Exception as e:
+                stats['errors'] += 1
+                current_app.logger.warning(f"Aquecimento da lâmina {slide_id} falhou: {e}")
+
+        stats['elapsed'] = round(time.monotonic() - started, 2)
+        return stats
+
+    def warm_slide(self, slide: Slide, throttle: Throttle, stats: Dict):
+        """Thumbnail e tiles dos níveis mais reduzidos de uma lâmina"""
+        if TileCache.get_thumbnail(slide.id) is not None:
+            stats['cached'] += 1
+        else:
+            throttle.wait()
+            thumbnail = SlideProcessor().get_thumbnail(slide.file_path, max_size=THUMBNAIL_SIZE)
+            if TileCache.cache_thumbnail(slide.id, _encode_jpeg(thumbnail)):
+                stats['thumbnails'] += 1
+
+        slide_obj = openslide.OpenSlide(slide.file_path)
+        try:
+            tiles = top_level_tiles(slide_obj)
+            missing = _missing_tiles(slide.id, tiles)
+            stats['cached'] += len(tiles) - len(missing)
+
+            for tile in missing:
+                throttle.wait()
+                level, x, y, width, height = tile
+                region = slide_obj.read_region((x, y), level, (width, height))
+                # Um tile por vez: a admissão é avaliada a cada gravação
+                stats['tiles'] += TileCache.cache_tiles(slide.id, {tile: _encode_jpeg(region)},
+                                                        TILE_TIMEOUT, force=True)
+        finally:
+            slide_obj.close()
+
+# Instância global
+cache_warmer = CacheWarmer()
+
+def init_warmup(app):
+    """Registrar o comando `flask cache-warmup` e o aquecimento ao iniciar"""
+
+    @app.cli.command('cache-warmup')
+    @click.option('--slides', default=WARMUP_SLIDES, show_default=True, help='Lâminas recentes a aquecer')
+    @click.option('--slide-id', 'slide_ids', multiple=True, type=int, help='Aquecer apenas estas lâminas')
+    @click.option('--rate', default=WARMUP_RATE, show_default=True, help='Itens por segundo (0 sem limite)')
+    def cache_warmup_command(slides, slide_ids, rate):
+        """Pré-carregar o cache (após deploy ou restart do Redis)"""
+        warmer = CacheWarmer(rate)
+        if slide_ids:
+            stats = warmer.warm(slide_ids)
+        else:
+            stats = warmer.warm_recent(slides)
+        click.echo(stats)
+
+    if WARMUP_ON_START and cache.enabled:
+        started = {'pid': None}
+
+        # Na primeira requisição de cada worker (após o fork); a trava no Redis
+        # garante uma única execução entre os workers
+        @app.before_request
+        def start_cache_warmup():
+            if started['pid'] != os.getpid():
+                started['pid'] = os.getpid()
+                cache_warmer.submit(app)
@@ -1,26 +1,172 @@
 import os
-import hashlib
 import json
+import errno
+import math
+import shutil
+import hashlib
 import time
-from typing import Dict, Optional, Tuple
+import random
+import logging
+import threading
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
 from werkzeug.datastructures import FileStorage
 from flask import current_app
+from src.utils.upload_store import ACCEPTING_STATUSES, UploadSessionStore
+from src.utils.cache import cache
+from src.utils.tiff_parser import (
+    TiffFormatError, TiffNeedMoreData, buffer_reader, parse_tiff_structure,
+    summarize_tiff_structure, validate_tiff_structure
+)
+
+# Folhas da árvore de hash: blocos fixos de 1MB, independentes do tamanho do chunk
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_ALGORITHM = 'sha256-tree-1mb'
+
+# Status em que o arquivo pré-alocado ainda está no diretório do upload
+PARTIAL_DATA_STATUSES = ACCEPTING_STATUSES + ('queued', 'assembling')
+
+logger = logging.getLogger(__name__)
+
+# Formatos baseados em TIFF cuja estrutura é validada enquanto os chunks chegam
+# (NDPI usa offsets fora do padrão acima de 4GB e fica apenas com o cabeçalho)
+TIFF_STRUCTURE_EXTENSIONS = {'.svs', '.tif', '.tiff', '.scn'}
+# Formatos que precisam ser organizados em tiles para abrir como lâmina
+TIFF_TILED_EXTENSIONS = {'.svs', '.tif', '.tiff'}
+
+def merkle_root(leaf_digests: List[bytes]) -> str:
+    """Raiz da árvore de hash (SHA-256, pares concatenados, nó ímpar promovido)"""
+    if not leaf_digests:
+        return hashlib.sha256(b'').hexdigest()
+    
+    level = list(leaf_digests)
+    while len(level) > 1:
+        next_level = []
+        for i in range(0, len(level) - 1, 2):
+            next_level.append(hashlib.sha256(level[i] + level[i + 1]).digest())
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    
+    return level[0].hex()
+
+def compute_tree_hash(file_path: str) -> str:
+    """Calcular a raiz da árvore de hash de um arquivo (mesmo valor aceito em file_hash)"""
+    leaves = []
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            leaves.append(hashlib.sha256(block).digest())
+    return merkle_root(leaves)
 
 class ChunkedUploadManager:
     """Gerenciador de upload de arquivos grandes com chunking"""
     
     def __init__(self, upload_dir: str = 'uploads/chunks'):
         self.upload_dir = upload_dir
-        self.chunk_size = 1024 * 1024  # 1MB chunks
+        # Limites do tamanho de chunk escolhido por upload (múltiplos de HASH_BLOCK_SIZE)
+        self.min_chunk_size = int(os.environ.get('UPLOAD_MIN_CHUNK_SIZE', 1024 * 1024))  # 1MB
+        self.max_chunk_size = int(os.environ.get('UPLOAD_MAX_CHUNK_SIZE', 64 * 1024 * 1024))  # 64MB
+        # Sem medida de throughput do cliente, chunks não passam deste tamanho
+        self.default_max_chunk_size = int(os.environ.get('UPLOAD_DEFAULT_MAX_CHUNK_SIZE', 16 * 1024 * 1024))
+        self.target_chunks = 64  # Chunks desejados por arquivo (overhead por requisição desprezível)
+        self.target_chunk_seconds = 10  # Duração desejada de um chunk por conexão (limita reenvio e timeout)
         self.max_file_size = 5 * 1024 * 1024 * 1024  # 5GB
         self.cleanup_interval = 3600  # 1 hora para limpeza de chunks órfãos
+        # Sessão sem novos chunks por mais que isto expira e tem os dados removidos
+        self.session_ttl = int(os.environ.get('UPLOAD_SESSION_TTL', self.cleanup_interval))
+        # Sessões encerradas (ou em ingestão) são mantidas para consulta por este tempo
+        self.session_retention = int(os.environ.get('UPLOAD_SESSION_RETENTION', 7 * 24 * 3600))
+        # Remoção periódica de sessões vencidas (0 desativa a thread)
+        self.reaper_interval = int(os.environ.get('UPLOAD_REAPER_INTERVAL', 300))
+        self.reaper_batch_size = 100
+        self.reaper_max_batches = 10  # Por execução; o restante fica para a próxima
+        self.reaper_lease = 600  # Sessões reservadas voltam a vencer se a remoção falhar
+        self._reaper = None
+        self._reaper_pid = None
+        self._reaper_lock = threading.Lock()
+        self.write_buffer_size = 1024 * 1024  # Bloco de leitura do corpo da requisição
+        # Chunks enviados simultaneamente por sessão (anunciado ao cliente)
+        self.max_parallel_chunks = int(os.environ.get('UPLOAD_MAX_PARALLEL_CHUNKS', 4))
+        self._store = None
+    
+    @property
+    def store(self) -> UploadSessionStore:
+        """Banco de sessões de upload (sessions.db dentro de upload_dir)"""
+        db_path = os.path.join(self.upload_dir, 'sessions.db')
+        if self._store is None or self._store.db_path != db_path:
+            self._store = UploadSessionStore(db_path, expiry=self._expiry_policy())
+        return self._store
+    
+    def _expiry_policy(self) -> Dict[str, Optional[float]]:
+        """Tempo até expirar por status (uploads ativos expiram por inatividade)"""
+        policy = {status: self.session_ttl for status in ACCEPTING_STATUSES}
+        for status in ('queued', 'assembling', 'assembled', 'completed', 'failed',
+                       'cancelled', 'rejected'):
+            policy[status] = self.session_retention
+        return policy
+    
+    def _get_session(self, upload_id: str) -> Dict:
+        """Obter sessão ou falhar com 'Upload não encontrado'"""
+        session = self.store.get_session(upload_id)
+        if session is None:
+            raise ValueError("Upload não encontrado")
+        return session
+    
+    def _data_path(self, upload_id: str) -> str:
+        """Arquivo de destino pré-alocado onde os chunks são gravados"""
+        return os.path.join(self.upload_dir, upload_id, 'data.partial')
+    
+    def _expected_chunk_size(self, metadata: Dict, chunk_index: int) -> int:
+        """Tamanho esperado de um chunk (o último pode ser menor)"""
+        offset = chunk_index * metadata['chunk_size']
+        return min(metadata['chunk_size'], metadata['file_size'] - offset)
+    
+    def choose_chunk_size(self, file_size: int, client_throughput: float = None) -> int:
+        """Escolher tamanho de chunk pelo tamanho do arquivo e throughput do cliente
+
+        Visa ~target_chunks requisições por arquivo; com throughput conhecido
+        (bytes/s, agregado), cada chunk leva no máximo ~target_chunk_seconds por
+        conexão. O resultado é uma potência de 2 vezes HASH_BLOCK_SIZE dentro de
+        [min_chunk_size, max_chunk_size].
+        """
+        min_blocks = max(1, self.min_chunk_size // HASH_BLOCK_SIZE)
+        max_blocks = max(min_blocks, self.max_chunk_size // HASH_BLOCK_SIZE)
+        
+        size = file_size / self.target_chunks
+        if client_throughput and client_throughput > 0:
+            per_connection = client_throughput / max(1, self.max_parallel_chunks)
+            size = min(size, per_connection * self.target_chunk_seconds)
+        else:
+            size = min(size, self.default_max_chunk_size)
         
-    def init_upload(self, filename: str, file_size: int, file_hash: str = None) -> Dict:
+        # Maior potência de 2 (em folhas) que não ultrapassa o tamanho desejado
+        blocks = max(1, int(size // HASH_BLOCK_SIZE))
+        blocks = 1 << (blocks.bit_length() - 1)
+        
+        return min(max(blocks, min_blocks), max_blocks) * HASH_BLOCK_SIZE
+    
+    def _write_at(self, fd: int, data: bytes, offset: int):
+        """Escrita posicional (sem compartilhar posição do arquivo entre requisições)"""
+        if hasattr(os, 'pwrite'):
+            while data:
+                written = os.pwrite(fd, data, offset)
+                data = data[written:]
+                offset += written
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
+        
+    def init_upload(self, filename: str, file_size: int, file_hash: str = None,
+                    client_throughput: float = None) -> Dict:
         """Inicializar upload chunked"""
         
         if file_size > self.max_file_size:
             raise ValueError(f"Arquivo muito grande. Máximo permitido: {self.max_file_size} bytes")
         
+        # Múltiplo de HASH_BLOCK_SIZE: folhas da árvore de hash alinhadas aos chunks
+        chunk_size = self.choose_chunk_size(file_size, client_throughput)
+        
         # Gerar ID único para o upload
         upload_id = hashlib.md5(f"{filename}_{file_size}_{time.time()}".encode()).hexdigest()
         
@@ -29,151 +175,394 @@ class ChunkedUploadManager:
         os.makedirs(chunk_dir, exist_ok=True)
         
         # Calcular número total de chunks
-        total_chunks = (file_size + self.chunk_size - 1) // self.chunk_size
+        total_chunks = (file_size + chunk_size - 1) // chunk_size
         
-        # Salvar metadados do upload
+        # Metadados do upload
         metadata = {
             'upload_id': upload_id,
             'filename': filename,
             'file_size': file_size,
             'file_hash': file_hash,
             'total_chunks': total_chunks,
-            'chunk_size': self.chunk_size,
-            'uploaded_chunks': [],
+            'chunk_size': chunk_size,
+            'hash_algorithm': HASH_ALGORITHM,
             'created_at': time.time(),
-            'status': 'initialized'
+            'status': 'initialized',
+            # Validação da estrutura começa pelo cabeçalho (offset 0)
+            'format_status': 'pending' if self._checks_structure(filename) else 'skipped',
+            'format_pending_offset': 0,
+            'format_pending_length': 16
         }
         
-        metadata_path = os.path.join(chunk_dir, 'metadata.json')
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f)
-        
-        return metadata
+        # Pré-alocar arquivo de destino com o tamanho final
+        fd = os.open(self._data_path(upload_id), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            try:
+                os.posix_fallocate(fd, 0, file_size)
+            except (AttributeError, OSError):
+                # Sistemas de arquivos sem fallocate: arquivo esparso
+                os.ftruncate(fd, file_size)
+        finally:
+            os.close(fd)
+        
+        session = self.store.create_session(metadata)
+        session['max_parallel_chunks'] = self.max_parallel_chunks
+        
+        self.start_reaper()
+        return session
     
-    def upload_chunk(self, upload_id: str, chunk_index: int, chunk_data: bytes) -> Dict:
-        """Upload de um chunk específico"""
+    def upload_chunk(self, upload_id: str, chunk_index: int, chunk_data: Union[bytes, BinaryIO],
+                     chunk_hash: str = None) -> Dict:
+        """Upload de um chunk específico
+
+        chunk_data pode ser bytes ou um stream (ex.: corpo da requisição); o
+        conteúdo é gravado diretamente na posição do chunk no arquivo final e
+        seus hashes são calculados durante a escrita. Se chunk_hash (SHA-256 do
+        chunk) for informado e não conferir, o chunk é rejeitado e pode ser
+        reenviado.
+
+        Chunks da mesma sessão podem ser enviados em paralelo e fora de ordem:
+        cada um escreve em sua própria faixa do arquivo e o registro no banco
+        de sessões é atômico.
+        """
         
-        chunk_dir = os.path.join(self.upload_dir, upload_id)
-        metadata_path = os.path.join(chunk_dir, 'metadata.json')
+        metadata = self._get_session(upload_id)
         
-        if not os.path.exists(metadata_path):
-            raise ValueError("Upload não encontrado")
+        if metadata['status'] == 'rejected':
+            raise ValueError(f"Upload rejeitado: {self._format_error(metadata)}")
         
-        # Carregar metadados
-        with open(metadata_path, 'r') as f:
-            metadata = json.load(f)
+        if metadata['status'] not in ('initialized', 'uploading', 'ready_for_assembly'):
+            raise ValueError("Upload não aceita mais chunks")
         
         # Validar chunk
-        if chunk_index >= metadata['total_chunks']:
+        if chunk_index < 0 or chunk_index >= metadata['total_chunks']:
             raise ValueError("Índice de chunk inválido")
         
-        if chunk_index in metadata['uploaded_chunks']:
-            return {'status': 'chunk_already_exists', 'chunk_index': chunk_index}
+        if self.store.has_chunk(upload_id, chunk_index):
+            return {'status': 'chunk_already_exists', 'chunk_index': chunk_index, 'bytes_written': 0}
         
-        # Salvar chunk
-        chunk_path = os.path.join(chunk_dir, f'chunk_{chunk_index:06d}')
-        with open(chunk_path, 'wb') as f:
-            f.write(chunk_data)
+        # Gravar chunk diretamente no offset do arquivo de destino
+        expected_size = self._expected_chunk_size(metadata, chunk_index)
+        bytes_written, chunk_digest, leaf_digests = self._stream_to_offset(
+            chunk_data, self._data_path(upload_id),
+            chunk_index * metadata['chunk_size'], expected_size
+        )
         
-        # Atualizar metadados
-        metadata['uploaded_chunks'].append(chunk_index)
-        metadata['uploaded_chunks'].sort()
+        if chunk_hash and chunk_hash.lower() != chunk_digest:
+            raise ValueError(f"Hash do chunk {chunk_index} não confere; reenvie o chunk")
         
-        # Verificar se upload está completo
-        if len(metadata['uploaded_chunks']) == metadata['total_chunks']:
-            metadata['status'] = 'ready_for_assembly'
-        else:
-            metadata['status'] = 'uploading'
+        # Registro atômico: envios concorrentes do mesmo chunk contam uma única vez
+        inserted, metadata = self.store.mark_chunk(
+            upload_id, chunk_index, chunk_digest, leaf_digests, bytes_written
+        )
         
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f)
+        if not inserted:
+            return {'status': 'chunk_already_exists', 'chunk_index': chunk_index, 'bytes_written': 0}
         
-        return {
+        # Validar a estrutura assim que o trecho necessário chegar (rejeita cedo)
+        if self._covers_pending_format(metadata, chunk_index):
+            metadata = self._check_format(metadata)
+        
+        result = {
             'status': metadata['status'],
             'chunk_index': chunk_index,
-            'uploaded_chunks': len(metadata['uploaded_chunks']),
+            'bytes_written': bytes_written,
+            'chunk_hash': chunk_digest,
+            'uploaded_chunks': metadata['uploaded_count'],
             'total_chunks': metadata['total_chunks'],
-            'progress': len(metadata['uploaded_chunks']) / metadata['total_chunks'] * 100
+            'progress': metadata['uploaded_count'] / metadata['total_chunks'] * 100,
+            'format_status': metadata['format_status']
         }
+        
+        # Chunk de que a validação depende: o cliente pode enviá-lo antes dos demais
+        if metadata['format_status'] == 'pending' and metadata['format_pending_offset'] is not None:
+            result['format_pending_chunk'] = metadata['format_pending_offset'] // metadata['chunk_size']
+        
+        return result
+    
+    def _checks_structure(self, filename: str) -> bool:
+        return os.path.splitext(filename)[1].lower() in TIFF_STRUCTURE_EXTENSIONS
+    
+    def _format_error(self, metadata: Dict) -> str:
+        info = json.loads(metadata['format_info']) if metadata.get('format_info') else {}
+        return info.get('error', 'formato inválido')
     
-    def assemble_file(self, upload_id: str, output_path: str) -> Dict:
-        """Montar arquivo final a partir dos chunks"""
+    def _covers_pending_format(self, metadata: Dict, chunk_index: int) -> bool:
+        """Verificar se o chunk contém parte do trecho aguardado pela validação"""
+        if metadata.get('format_status') not in ('pending', 'valid'):
+            return False
+        if metadata.get('format_pending_offset') is None:
+            return False
+        
+        start = chunk_index * metadata['chunk_size']
+        end = start + self._expected_chunk_size(metadata, chunk_index)
+        pending_start = metadata['format_pending_offset']
+        pending_end = pending_start + max(1, metadata['format_pending_length'] or 1)
+        return start < pending_end and pending_start < end
+    
+    def _chunk_reader(self, metadata: Dict):
+        """Leitor posicional que só expõe faixas já gravadas por chunks registrados"""
+        upload_id = metadata['upload_id']
+        data_path = self._data_path(upload_id)
+        chunk_size = metadata['chunk_size']
+        
+        def read_at(offset: int, length: int) -> bytes:
+            if offset < 0 or length < 0 or offset + length > metadata['file_size']:
+                raise TiffFormatError(f'Offset {offset} fora do arquivo')
+            
+            first = offset // chunk_size
+            last = (offset + max(length, 1) - 1) // chunk_size
+            for index in range(first, last + 1):
+                if not self.store.has_chunk(upload_id, index):
+                    raise TiffNeedMoreData(offset, length)
+            
+            with open(data_path, 'rb') as f:
+                f.seek(offset)
+                return f.read(length)
         
-        chunk_dir = os.path.join(self.upload_dir, upload_id)
-        metadata_path = os.path.join(chunk_dir, 'metadata.json')
+        return read_at
+    
+    def _check_format(self, metadata: Dict) -> Dict:
+        """Analisar cabeçalho e IFDs com os chunks disponíveis
+        
+        Rejeita o upload (status 'rejected', dados descartados) se a estrutura
+        não for utilizável; caso falte um trecho, registra o offset aguardado
+        e a análise continua quando o chunk correspondente chegar.
+        """
+        upload_id = metadata['upload_id']
+        extension = os.path.splitext(metadata['filename'])[1].lower()
+        
+        try:
+            info = parse_tiff_structure(self._chunk_reader(metadata))
+        except TiffNeedMoreData as e:
+            self.store.update_session(upload_id, format_pending_offset=e.offset,
+                                      format_pending_length=e.length)
+            return self.store.get_session(upload_id)
+        except TiffFormatError as e:
+            return self._reject_format(upload_id, str(e))
+        
+        error = validate_tiff_structure(info, require_tiled=extension in TIFF_TILED_EXTENSIONS)
+        if error:
+            return self._reject_format(upload_id, error)
+        
+        self.store.update_session(
+            upload_id,
+            format_status='valid' if info['ifds'] else 'pending',
+            format_info=json.dumps(summarize_tiff_structure(info)),
+            format_pending_offset=info['pending_offset'],
+            format_pending_length=info['pending_length']
+        )
+        return self.store.get_session(upload_id)
+    
+    def _reject_format(self, upload_id: str, error: str):
+        """Recusar o restante da transferência e liberar o espaço pré-alocado"""
+        self.store.update_session(upload_id, status='rejected', format_status='invalid',
+                                  format_info=json.dumps({'error': error}),
+                                  format_pending_offset=None, format_pending_length=None)
+        self.cleanup_chunks(upload_id)
+        raise ValueError(f"Arquivo rejeitado: {error}")
+    
+    def _stream_to_offset(self, chunk_data: Union[bytes, BinaryIO], data_path: str,
+                          offset: int, expected_size: int) -> Tuple[int, str, List[bytes]]:
+        """Copiar chunk para o arquivo de destino em blocos, validando o tamanho
+
+        Retorna (bytes gravados, SHA-256 do chunk, digests das folhas de 1MB).
+        """
+        if isinstance(chunk_data, (bytes, bytearray, memoryview)):
+            if len(chunk_data) != expected_size:
+                raise ValueError(f"Tamanho do chunk inválido: esperado {expected_size} bytes")
+            reader = iter([bytes(chunk_data)])
+        else:
+            # Ler no máximo expected_size + 1 para detectar chunks maiores que o esperado
+            def read_blocks():
+                remaining = expected_size + 1
+                while remaining > 0:
+                    block = chunk_data.read(min(self.write_buffer_size, remaining))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    yield block
+            reader = read_blocks()
+        
+        chunk_hasher = hashlib.sha256()
+        leaf_hasher = hashlib.sha256()
+        leaf_filled = 0
+        leaf_digests = []
+        
+        fd = os.open(data_path, os.O_WRONLY)
+        written = 0
+        try:
+            for block in reader:
+                if written + len(block) > expected_size:
+                    raise ValueError(f"Tamanho do chunk inválido: esperado {expected_size} bytes")
+                self._write_at(fd, block, offset + written)
+                written += len(block)
+                
+                # Hashes calculados enquanto os dados passam, sem releitura
+                chunk_hasher.update(block)
+                view = memoryview(block)
+                while view:
+                    take = min(HASH_BLOCK_SIZE - leaf_filled, len(view))
+                    leaf_hasher.update(view[:take])
+                    leaf_filled += take
+                    view = view[take:]
+                    if leaf_filled == HASH_BLOCK_SIZE:
+                        leaf_digests.append(leaf_hasher.digest())
+                        leaf_hasher = hashlib.sha256()
+                        leaf_filled = 0
+        finally:
+            os.close(fd)
+        
+        if written != expected_size:
+            raise ValueError(f"Tamanho do chunk inválido: esperado {expected_size} bytes, recebido {written}")
+        
+        if leaf_filled:
+            leaf_digests.append(leaf_hasher.digest())
+        
+        return written, chunk_hasher.hexdigest(), leaf_digests
+    
+    def claim_for_ingest(self, upload_id: str) -> bool:
+        """Reservar upload completo para o pipeline de ingestão (apenas uma vez)"""
+        return self.store.transition_status(upload_id, 'ready_for_assembly', 'queued')
+    
+    def assemble_file(self, upload_id: str, output_path: str, resume: bool = False) -> Dict:
+        """Montar arquivo final a partir dos chunks
         
-        if not os.path.exists(metadata_path):
-            raise ValueError("Upload não encontrado")
+        Idempotente: se o arquivo já foi montado em output_path, apenas retorna.
+        A integridade é conferida em seguida por verify_file.
+        Com resume=True (chamador detém o lease da ingestão), retoma uma montagem
+        interrompida em 'assembling' por um worker encerrado.
+        """
         
-        # Carregar metadados
-        with open(metadata_path, 'r') as f:
-            metadata = json.load(f)
+        metadata = self._get_session(upload_id)
         
-        if metadata['status'] != 'ready_for_assembly':
+        if (metadata['status'] in ('assembled', 'completed') and
+                metadata['output_path'] == output_path and os.path.exists(output_path)):
+            return {
+                'status': metadata['status'],
+                'output_path': output_path,
+                'file_size': os.path.getsize(output_path)
+            }
+        
+        # Apenas uma requisição monta o arquivo, mesmo com chamadas concorrentes
+        from_statuses = ('ready_for_assembly', 'queued', 'assembling') if resume else ('ready_for_assembly', 'queued')
+        if not self.store.transition_status(upload_id, from_statuses, 'assembling'):
             raise ValueError("Upload não está pronto para montagem")
         
-        # Criar diretório de saída se não existir
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        previous_status = 'queued' if metadata['status'] == 'assembling' else metadata['status']
+        try:
+            data_path = self._data_path(upload_id)
+            if not os.path.exists(data_path):
+                # Worker encerrado após o rename: arquivo já está no destino
+                if resume and os.path.exists(output_path):
+                    self.store.update_session(upload_id, status='assembled', output_path=output_path)
+                    return {
+                        'status': 'assembled',
+                        'output_path': output_path,
+                        'file_size': os.path.getsize(output_path)
+                    }
+                raise ValueError("Dados do upload não encontrados")
+            
+            # Criar diretório de saída se não existir
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            
+            # Arquivo já está completo: mover para o destino final (rename atômico)
+            try:
+                os.replace(data_path, output_path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Destino em outro sistema de arquivos: cópia inevitável
+                shutil.move(data_path, output_path)
+        except Exception:
+            # Voltar ao status anterior para permitir nova tentativa
+            self.store.update_session(upload_id, status=previous_status)
+            raise
+        
+        self.store.update_session(upload_id, status='assembled', output_path=output_path)
+        
+        return {
+            'status': 'assembled',
+            'output_path': output_path,
+            'file_size': os.path.getsize(output_path)
+        }
+    
+    def verify_file(self, upload_id: str) -> Dict:
+        """Conferir integridade do arquivo montado e concluir o upload"""
         
-        # Montar arquivo
-        with open(output_path, 'wb') as output_file:
-            for chunk_index in range(metadata['total_chunks']):
-                chunk_path = os.path.join(chunk_dir, f'chunk_{chunk_index:06d}')
-                
-                if not os.path.exists(chunk_path):
-                    raise ValueError(f"Chunk {chunk_index} não encontrado")
-                
-                with open(chunk_path, 'rb') as chunk_file:
-                    output_file.write(chunk_file.read())
+        metadata = self._get_session(upload_id)
+        
+        if metadata['status'] == 'completed':
+            return {'status': 'completed', 'content_hash': metadata['content_hash']}
+        
+        if metadata['status'] != 'assembled':
+            raise ValueError("Upload não foi montado")
+        
+        # Raiz da árvore de hash a partir dos digests gravados por chunk (sem reler o arquivo)
+        content_hash = self.get_tree_hash(upload_id, metadata['total_chunks'])
         
         # Verificar integridade se hash foi fornecido
         if metadata.get('file_hash'):
-            file_hash = self.calculate_file_hash(output_path)
-            if file_hash != metadata['file_hash']:
-                os.remove(output_path)
+            expected_hash = metadata['file_hash'].lower()
+            if len(expected_hash) == 32:
+                # Clientes antigos enviam MD5 do arquivo inteiro: exige releitura
+                file_hash = self.calculate_file_hash(metadata['output_path'])
+            else:
+                file_hash = content_hash
+            
+            if file_hash != expected_hash:
+                self.store.update_session(upload_id, status='failed')
                 raise ValueError("Falha na verificação de integridade do arquivo")
         
-        # Atualizar metadados
-        metadata['status'] = 'completed'
-        metadata['output_path'] = output_path
-        metadata['completed_at'] = time.time()
-        
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f)
+        # Atualizar sessão
+        self.store.update_session(
+            upload_id,
+            status='completed',
+            content_hash=content_hash,
+            completed_at=time.time()
+        )
         
         # Limpar chunks
         self.cleanup_chunks(upload_id)
         
-        return {
-            'status': 'completed',
-            'output_path': output_path,
-            'file_size': os.path.getsize(output_path)
-        }
+        return {'status': 'completed', 'content_hash': content_hash}
+    
+    def get_tree_hash(self, upload_id: str, total_chunks: int) -> str:
+        """Combinar digests das folhas de todos os chunks na raiz da árvore"""
+        chunks = self.store.leaf_digests(upload_id)
+        
+        if [chunk_index for chunk_index, _ in chunks] != list(range(total_chunks)):
+            raise ValueError("Hashes de chunks incompletos")
+        
+        leaves = []
+        for _, chunk_leaves in chunks:
+            leaves.extend(chunk_leaves)
+        
+        return merkle_root(leaves)
     
     def get_upload_status(self, upload_id: str) -> Dict:
         """Obter status do upload"""
         
-        chunk_dir = os.path.join(self.upload_dir, upload_id)
-        metadata_path = os.path.join(chunk_dir, 'metadata.json')
+        metadata = self.store.get_session(upload_id)
         
-        if not os.path.exists(metadata_path):
+        if metadata is None:
             return {'status': 'not_found'}
         
-        with open(metadata_path, 'r') as f:
-            metadata = json.load(f)
-        
         progress = 0
         if metadata['total_chunks'] > 0:
-            progress = len(metadata['uploaded_chunks']) / metadata['total_chunks'] * 100
+            progress = metadata['uploaded_count'] / metadata['total_chunks'] * 100
         
         return {
             'upload_id': upload_id,
             'status': metadata['status'],
             'filename': metadata['filename'],
             'file_size': metadata['file_size'],
-            'uploaded_chunks': len(metadata['uploaded_chunks']),
+            'uploaded_chunks': metadata['uploaded_count'],
             'total_chunks': metadata['total_chunks'],
             'progress': progress,
+            'max_parallel_chunks': self.max_parallel_chunks,
+            'format_status': metadata['format_status'],
+            'format': json.loads(metadata['format_info']) if metadata['format_info'] else None,
             'created_at': metadata['created_at']
         }
     
@@ -188,48 +577,132 @@ class ChunkedUploadManager:
         if status['status'] == 'completed':
             return status
         
-        # Verificar chunks existentes
+        # Chunks gravados ficam registrados no banco de sessões; o cliente
+        # reenvia apenas os que faltam
+        uploaded = set(self.store.uploaded_chunks(upload_id))
+        status['missing_chunks'] = [
+            chunk_index for chunk_index in range(status['total_chunks'])
+            if chunk_index not in uploaded
+        ]
+        
+        return status
+    
+    def _remove_upload_dir(self, upload_id: str) -> int:
+        """Remover diretório do upload; retorna bytes ocupados em disco liberados"""
         chunk_dir = os.path.join(self.upload_dir, upload_id)
-        existing_chunks = []
+        if not os.path.isdir(chunk_dir):
+            return 0
         
-        for i in range(status['total_chunks']):
-            chunk_path = os.path.join(chunk_dir, f'chunk_{i:06d}')
-            if os.path.exists(chunk_path):
-                existing_chunks.append(i)
+        freed = 0
+        for filename in os.listdir(chunk_dir):
+            try:
+                stat = os.stat(os.path.join(chunk_dir, filename))
+                # Blocos alocados: arquivo pré-alocado ocupa o tamanho final
+                freed += getattr(stat, 'st_blocks', 0) * 512 or stat.st_size
+            except OSError:
+                pass
+        
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+        return freed
+    
+    def cleanup_chunks(self, upload_id: str):
+        """Limpar dados parciais do upload (após montagem ou cancelamento)
         
-        # Atualizar metadados com chunks encontrados
-        metadata_path = os.path.join(chunk_dir, 'metadata.json')
-        with open(metadata_path, 'r') as f:
-            metadata = json.load(f)
+        Remove o diretório do upload e os digests dos chunks; a sessão fica
+        registrada até expirar (consulta de status) e então é removida pelo
+        reaper.
+        """
         
-        metadata['uploaded_chunks'] = existing_chunks
+        self._remove_upload_dir(upload_id)
         
-        if len(existing_chunks) == metadata['total_chunks']:
-            metadata['status'] = 'ready_for_assembly'
-        else:
-            metadata['status'] = 'uploading'
+        # Uploads não concluídos ficam marcados como cancelados (rejeitados mantêm o motivo)
+        session = self.store.get_session(upload_id)
+        if session is not None:
+            self.store.delete_chunks(upload_id)
+            if session['status'] not in ('completed', 'rejected'):
+                self.store.update_session(upload_id, status='cancelled')
+    
+    def reap_expired_sessions(self, max_batches: int = None) -> Dict:
+        """Remover sessões vencidas e seus diretórios, em lotes
+        
+        Custo proporcional às sessões vencidas (índice por expires_at), não ao
+        total de uploads. Seguro com vários processos: cada lote é reservado
+        atomicamente no banco de sessões.
+        """
+        max_batches = max_batches or self.reaper_max_batches
+        removed = 0
+        bytes_freed = 0
+        
+        for _ in range(max_batches):
+            upload_ids = self.store.claim_expired(time.time(), self.reaper_batch_size, self.reaper_lease)
+            
+            for upload_id in upload_ids:
+                bytes_freed += self._remove_upload_dir(upload_id)
+                self.store.delete_session(upload_id)
+                removed += 1
+            
+            if len(upload_ids) < self.reaper_batch_size:
+                break
         
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f)
+        return {'removed_sessions': removed, 'bytes_freed': bytes_freed}
+    
+    def start_reaper(self):
+        """Iniciar thread de remoção periódica neste processo (uma vez por processo)"""
+        if self.reaper_interval <= 0:
+            return
         
-        return self.get_upload_status(upload_id)
+        with self._reaper_lock:
+            # Threads não sobrevivem ao fork do gunicorn: recriar no processo filho
+            if self._reaper is not None and self._reaper_pid == os.getpid() and self._reaper.is_alive():
+                return
+            
+            self._reaper = threading.Thread(target=self._reaper_loop, name='aiapad-upload-reaper',
+                                            daemon=True)
+            self._reaper_pid = os.getpid()
+            self._reaper.start()
     
-    def cleanup_chunks(self, upload_id: str):
-        """Limpar chunks após montagem"""
+    def _reaper_loop(self):
+        while True:
+            # Intervalo com variação: workers não disputam o banco ao mesmo tempo
+            time.sleep(self.reaper_interval * random.uniform(0.8, 1.2))
+            try:
+                result = self.reap_expired_sessions()
+                if result['removed_sessions']:
+                    logger.info("Sessões de upload expiradas removidas: %s", result)
+            except Exception:
+                logger.exception("Erro na remoção de sessões de upload expiradas")
+    
+    def get_disk_usage(self) -> Dict:
+        """Uso de disco dos uploads em andamento e espaço livre no volume"""
+        by_status = self.store.usage_by_status()
+        partial_bytes = sum(
+            usage['bytes'] for status, usage in by_status.items() if status in PARTIAL_DATA_STATUSES
+        )
+        
+        usage = {
+            'sessions_by_status': by_status,
+            'partial_bytes': partial_bytes,
+            'active_sessions': sum(by_status.get(status, {}).get('sessions', 0) for status in ACCEPTING_STATUSES)
+        }
         
-        chunk_dir = os.path.join(self.upload_dir, upload_id)
+        if os.path.exists(self.upload_dir):
+            disk = shutil.disk_usage(self.upload_dir)
+            usage.update({'disk_total': disk.total, 'disk_free': disk.free})
         
-        if os.path.exists(chunk_dir):
-            # Remover chunks individuais
-            for filename in os.listdir(chunk_dir):
-                if filename.startswith('chunk_'):
-                    os.remove(os.path.join(chunk_dir, filename))
+        return usage
     
-    def cleanup_orphaned_uploads(self):
-        """Limpar uploads órfãos antigos"""
+    def cleanup_orphaned_uploads(self) -> Dict:
+        """Remover sessões vencidas e diretórios sem sessão registrada
+        
+        Além do reaper, percorre o diretório de uploads (restam apenas uploads
+        em andamento) para remover diretórios de sessões que nunca foram
+        registradas, por exemplo após uma falha no init.
+        """
+        
+        result = self.reap_expired_sessions(max_batches=1000)
         
         if not os.path.exists(self.upload_dir):
-            return
+            return result
         
         current_time = time.time()
         
@@ -239,28 +712,12 @@ class ChunkedUploadManager:
             if not os.path.isdir(upload_path):
                 continue
             
-            metadata_path = os.path.join(upload_path, 'metadata.json')
-            
-            if not os.path.exists(metadata_path):
-                # Diretório sem metadados, remover
-                import shutil
-                shutil.rmtree(upload_path)
-                continue
-            
-            try:
-                with open(metadata_path, 'r') as f:
-                    metadata = json.load(f)
-                
-                # Remover uploads antigos não completados
-                if (current_time - metadata['created_at'] > self.cleanup_interval and 
-                    metadata['status'] not in ['completed']):
-                    import shutil
-                    shutil.rmtree(upload_path)
-                    
-            except (json.JSONDecodeError, KeyError):
-                # Metadados corrompidos, remover
-                import shutil
-                shutil.rmtree(upload_path)
+            # Diretório recém-criado pode estar aguardando o registro da sessão
+            if (self.store.get_session(upload_id) is None and
+                    current_time - os.path.getmtime(upload_path) > self.cleanup_interval):
+                result['bytes_freed'] += self._remove_upload_dir(upload_id)
+        
+        return result
     
     def calculate_file_hash(self, file_path: str, algorithm: str = 'md5') -> str:
         """Calcular hash do arquivo"""
@@ -315,54 +772,196 @@ class ChunkedUploadManager:
             'detected_format': detected_format,
             'extension': file_ext
         }
+    
+    def inspect_structure(self, filename: str, file_data: bytes) -> Dict:
+        """Analisar a estrutura TIFF a partir do início do arquivo
+        
+        Retorna 'structure' (níveis, tiles, compressão) e 'error' se a estrutura
+        não for utilizável. Com dados insuficientes, 'needs_more_data' indica o
+        offset necessário (ex.: IFD gravado no fim do arquivo).
+        """
+        file_ext = os.path.splitext(filename)[1].lower()
+        if file_ext not in TIFF_STRUCTURE_EXTENSIONS:
+            return {'checked': False}
+        
+        try:
+            info = parse_tiff_structure(buffer_reader(file_data))
+        except TiffNeedMoreData as e:
+            return {'checked': False, 'needs_more_data': {'offset': e.offset, 'length': e.length}}
+        except TiffFormatError as e:
+            return {'checked': True, 'error': str(e)}
+        
+        result = {
+            'checked': bool(info['ifds']),
+            'structure': summarize_tiff_structure(info),
+            'error': validate_tiff_structure(info, require_tiled=file_ext in TIFF_TILED_EXTENSIONS)
+        }
+        if info['pending_offset'] is not None:
+            result['needs_more_data'] = {'offset': info['pending_offset'], 'length': info['pending_length']}
+        return result
+
+# Constante de tempo (s) da média móvel exponencial da taxa de upload
+PROGRESS_EWMA_TAU = float(os.environ.get('UPLOAD_PROGRESS_EWMA_TAU', 10))
+# Progresso sem atualização por mais tempo que isto expira (upload abandonado)
+PROGRESS_TTL = int(os.environ.get('UPLOAD_PROGRESS_TTL', 24 * 3600))
+
+PROGRESS_KEY_PREFIX = 'upload_progress:'
+PROGRESS_ACTIVE_KEY = 'upload_progress:active'
+
+# Atualização atômica por chunk: soma bytes e atualiza a taxa (EWMA ponderada
+# pelo intervalo desde a última atualização de qualquer worker)
+UPDATE_PROGRESS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bytes = tonumber(ARGV[1])
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_update'))
+local speed = tonumber(redis.call('HGET', KEYS[1], 'speed')) or 0
+local uploaded = redis.call('HINCRBY', KEYS[1], 'uploaded_size', bytes)
+local dt = now - last
+if dt > 0 and bytes > 0 then
+    if speed == 0 then
+        speed = bytes / dt
+    else
+        local alpha = 1 - math.exp(-dt / tonumber(ARGV[2]))
+        speed = speed + alpha * (bytes / dt - speed)
+    end
+end
+redis.call('HMSET', KEYS[1], 'speed', tostring(speed), 'last_update', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('ZADD', KEYS[2], now, ARGV[4])
+return uploaded
+"""
+
+START_PROGRESS_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('DEL', KEYS[1])
+redis.call('HMSET', KEYS[1], 'total_size', ARGV[1], 'uploaded_size', ARGV[2],
+           'start_time', tostring(now), 'last_update', tostring(now), 'speed', '0')
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('ZADD', KEYS[2], now, ARGV[4])
+return 1
+"""
 
 class UploadProgressTracker:
-    """Rastreador de progresso de upload em tempo real"""
+    """Rastreador de progresso de upload em tempo real
+
+    Estado compartilhado entre workers/nós via Redis quando o cache está
+    disponível; caso contrário, mantido em memória no processo.
+    """
     
     def __init__(self):
         self.active_uploads = {}
+        self._lock = threading.Lock()
+        self._scripts = None
+    
+    def _redis(self):
+        """Cliente Redis do cache (None se indisponível)"""
+        if not cache.enabled:
+            return None
+        if self._scripts is None or self._scripts[0] is not cache.redis_client:
+            self._scripts = (
+                cache.redis_client,
+                cache.redis_client.register_script(START_PROGRESS_SCRIPT),
+                cache.redis_client.register_script(UPDATE_PROGRESS_SCRIPT)
+            )
+        return cache.redis_client
+    
+    def _redis_now(self, client) -> float:
+        seconds, microseconds = client.time()
+        return seconds + microseconds / 1e6
     
-    def start_tracking(self, upload_id: str, total_size: int):
+    def start_tracking(self, upload_id: str, total_size: int, uploaded_size: int = 0):
         """Iniciar rastreamento de upload"""
-        self.active_uploads[upload_id] = {
-            'total_size': total_size,
-            'uploaded_size': 0,
-            'start_time': time.time(),
-            'last_update': time.time(),
-            'speed': 0
-        }
+        client = self._redis()
+        if client is not None:
+            try:
+                self._scripts[1](
+                    keys=[PROGRESS_KEY_PREFIX + upload_id, PROGRESS_ACTIVE_KEY],
+                    args=[total_size, uploaded_size, PROGRESS_TTL, upload_id]
+                )
+                return
+            except Exception as e:
+                current_app.logger.warning(f"Progresso no Redis indisponível: {e}")
+        
+        now = time.time()
+        with self._lock:
+            self.active_uploads[upload_id] = {
+                'total_size': total_size,
+                'uploaded_size': uploaded_size,
+                'start_time': now,
+                'last_update': now,
+                'speed': 0
+            }
     
     def update_progress(self, upload_id: str, chunk_size: int):
-        """Atualizar progresso do upload"""
-        if upload_id not in self.active_uploads:
-            return
-        
-        upload_info = self.active_uploads[upload_id]
-        current_time = time.time()
-        
-        upload_info['uploaded_size'] += chunk_size
-        
-        # Calcular velocidade
-        time_diff = current_time - upload_info['last_update']
-        if time_diff > 0:
-            upload_info['speed'] = chunk_size / time_diff
-        
-        upload_info['last_update'] = current_time
+        """Atualizar progresso do upload (uma operação atômica por chunk)"""
+        client = self._redis()
+        if client is not None:
+            try:
+                self._scripts[2](
+                    keys=[PROGRESS_KEY_PREFIX + upload_id, PROGRESS_ACTIVE_KEY],
+                    args=[chunk_size, PROGRESS_EWMA_TAU, PROGRESS_TTL, upload_id]
+                )
+                return
+            except Exception as e:
+                current_app.logger.warning(f"Progresso no Redis indisponível: {e}")
+        
+        with self._lock:
+            if upload_id not in self.active_uploads:
+                return
+            
+            upload_info = self.active_uploads[upload_id]
+            current_time = time.time()
+            
+            upload_info['uploaded_size'] += chunk_size
+            
+            # Taxa suavizada (EWMA ponderada pelo intervalo entre atualizações)
+            time_diff = current_time - upload_info['last_update']
+            if time_diff > 0 and chunk_size > 0:
+                rate = chunk_size / time_diff
+                if upload_info['speed'] == 0:
+                    upload_info['speed'] = rate
+                else:
+                    alpha = 1 - math.exp(-time_diff / PROGRESS_EWMA_TAU)
+                    upload_info['speed'] += alpha * (rate - upload_info['speed'])
+            
+            upload_info['last_update'] = current_time
+    
+    def _load(self, upload_id: str) -> Tuple[Optional[Dict], float]:
+        """Estado do upload e instante atual no mesmo relógio"""
+        client = self._redis()
+        if client is not None:
+            try:
+                data = client.hgetall(PROGRESS_KEY_PREFIX + upload_id)
+                if not data:
+                    return None, 0
+                upload_info = {key.decode(): float(value) for key, value in data.items()}
+                return upload_info, self._redis_now(client)
+            except Exception as e:
+                current_app.logger.warning(f"Progresso no Redis indisponível: {e}")
+        
+        with self._lock:
+            upload_info = self.active_uploads.get(upload_id)
+            return (dict(upload_info) if upload_info else None), time.time()
     
     def get_progress(self, upload_id: str) -> Dict:
         """Obter progresso atual"""
-        if upload_id not in self.active_uploads:
+        upload_info, current_time = self._load(upload_id)
+        if upload_info is None:
             return {'status': 'not_found'}
         
-        upload_info = self.active_uploads[upload_id]
-        current_time = time.time()
-        
-        progress_percent = (upload_info['uploaded_size'] / upload_info['total_size']) * 100
+        progress_percent = 0
+        if upload_info['total_size'] > 0:
+            progress_percent = (upload_info['uploaded_size'] / upload_info['total_size']) * 100
         elapsed_time = current_time - upload_info['start_time']
         
         # Estimar tempo restante
         if upload_info['speed'] > 0:
-            remaining_bytes = upload_info['total_size'] - upload_info['uploaded_size']
+            remaining_bytes = max(0, upload_info['total_size'] - upload_info['uploaded_size'])
             eta = remaining_bytes / upload_info['speed']
         else:
             eta = 0
@@ -370,15 +969,49 @@ class UploadProgressTracker:
         return {
             'upload_id': upload_id,
             'progress_percent': progress_percent,
-            'uploaded_size': upload_info['uploaded_size'],
-            'total_size': upload_info['total_size'],
+            'uploaded_size': int(upload_info['uploaded_size']),
+            'total_size': int(upload_info['total_size']),
             'speed': upload_info['speed'],
             'elapsed_time': elapsed_time,
             'eta': eta
         }
     
+    def get_stats(self) -> Dict:
+        """Uploads ativos (em todos os workers) e taxa agregada"""
+        client = self._redis()
+        if client is not None:
+            try:
+                # Remover uploads abandonados do índice de ativos
+                now = self._redis_now(client)
+                client.zremrangebyscore(PROGRESS_ACTIVE_KEY, '-inf', now - PROGRESS_TTL)
+                upload_ids = client.zrange(PROGRESS_ACTIVE_KEY, 0, -1)
+                
+                pipe = client.pipeline(transaction=False)
+                for upload_id in upload_ids:
+                    pipe.hget(PROGRESS_KEY_PREFIX + upload_id.decode(), 'speed')
+                speeds = [float(speed) for speed in pipe.execute() if speed is not None]
+                
+                return {'active_uploads': len(speeds), 'total_speed': sum(speeds)}
+            except Exception as e:
+                current_app.logger.warning(f"Progresso no Redis indisponível: {e}")
+        
+        with self._lock:
+            return {
+                'active_uploads': len(self.active_uploads),
+                'total_speed': sum(info['speed'] for info in self.active_uploads.values())
+            }
+    
     def finish_tracking(self, upload_id: str):
         """Finalizar rastreamento"""
-        if upload_id in self.active_uploads:
-            del self.active_uploads[upload_id]
-
+        client = self._redis()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                pipe.delete(PROGRESS_KEY_PREFIX + upload_id)
+                pipe.zrem(PROGRESS_ACTIVE_KEY, upload_id)
+                pipe.execute()
+            except Exception as e:
+                current_app.logger.warning(f"Progresso no Redis indisponível: {e}")
+        
+        with self._lock:
+            self.active_uploads.pop(upload_id, None)
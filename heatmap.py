@@ -0,0 +1,62 @@
+import io
+from functools import lru_cache
+from typing import Dict, Tuple
+import numpy as np
+import cv2
+import openslide
+
+# Opacidade das células com tecido no overlay
+HEATMAP_ALPHA = 160
+# Maior tile de overlay aceito (pixels por lado)
+MAX_OVERLAY_TILE_SIZE = 4096
+
+@lru_cache(maxsize=256)
+def get_slide_levels(slide_path: str) -> Dict:
+    """Dimensões e downsamples dos níveis da lâmina (cache por processo)"""
+    slide = openslide.OpenSlide(slide_path)
+    try:
+        return {
+            'dimensions': slide.dimensions,
+            'level_dimensions': slide.level_dimensions,
+            'level_downsamples': slide.level_downsamples
+        }
+    finally:
+        slide.close()
+
+def heatmap_from_bytes(data: bytes, width: int, height: int) -> np.ndarray:
+    """Reconstruir grade uint8 do heatmap gravado na análise"""
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, width)
+
+def render_heatmap_tile(grid: np.ndarray, tile_size: int, x: int, y: int, width: int, height: int,
+                        downsample: float, slide_dimensions: Tuple[int, int]) -> np.ndarray:
+    """Renderizar tile RGBA do heatmap alinhado ao tile da lâmina
+
+    x, y são coordenadas do nível 0 (como em read_region); width e height são
+    medidos no nível pedido. Cada pixel de saída recebe o score da célula que
+    contém seu centro (vizinho mais próximo), então o resultado é nítido em
+    qualquer zoom.
+    """
+    slide_width, slide_height = slide_dimensions
+    
+    # Centro de cada pixel de saída em coordenadas do nível 0
+    xs = x + (np.arange(width, dtype=np.float64) + 0.5) * downsample
+    ys = y + (np.arange(height, dtype=np.float64) + 0.5) * downsample
+    
+    cols = np.clip((xs // tile_size).astype(np.int64), 0, grid.shape[1] - 1)
+    rows = np.clip((ys // tile_size).astype(np.int64), 0, grid.shape[0] - 1)
+    scores = grid[rows[:, None], cols[None, :]]
+    
+    # Fora da lâmina fica transparente
+    inside = (ys < slide_height)[:, None] & (xs < slide_width)[None, :]
+    scores = np.where(inside, scores, 0).astype(np.uint8)
+    
+    colored = cv2.applyColorMap(scores, cv2.COLORMAP_JET)  # BGR
+    alpha = np.where(scores > 0, HEATMAP_ALPHA, 0).astype(np.uint8)
+    return np.dstack([colored, alpha])  # BGRA
+
+def encode_png(bgra: np.ndarray) -> io.BytesIO:
+    """Codificar tile BGRA como PNG"""
+    ok, encoded = cv2.imencode('.png', bgra, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+    if not ok:
+        raise ValueError('Falha ao codificar tile do heatmap')
+    return io.BytesIO(encoded.tobytes())
@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from src.models.slide import Slide, SlideIngestStage, db
+from src.utils.slide_processor import SlideProcessor
+from src.utils.slide_storage import store_blob
+from src.utils.cache_warmup import cache_warmer
+
+# Estágios da ingestão após o upload, na ordem de execução
+INGEST_STAGES = ['assemble', 'verify', 'store', 'validate', 'metadata', 'derivatives']
+
+# Lease da ingestão: o worker renova heartbeat_at dos estágios a cada intervalo;
+# lâmina em 'processing' sem heartbeat há mais que INGEST_STALE_SECONDS ficou
+# órfã (worker reciclado ou morto) e pode ser retomada
+INGEST_HEARTBEAT_INTERVAL = int(os.environ.get('INGEST_HEARTBEAT_INTERVAL', 60))
+INGEST_STALE_SECONDS = int(os.environ.get('INGEST_STALE_SECONDS', 600))
+# Tentativas de um estágio interrompido antes de marcá-lo como falha
+INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', 3))
+
+def create_ingest_stages(slide: Slide, upload_id: str) -> List[SlideIngestStage]:
+    """Criar registros pendentes de todos os estágios para uma lâmina"""
+    stages = []
+    for position, name in enumerate(INGEST_STAGES):
+        stage = SlideIngestStage(slide_id=slide.id, upload_id=upload_id,
+                                 stage=name, position=position, status='pending',
+                                 heartbeat_at=datetime.utcnow())
+        db.session.add(stage)
+        stages.append(stage)
+    return stages
+
+def get_ingest_stages(upload_id: str) -> List[SlideIngestStage]:
+    """Estágios de ingestão de um upload, em ordem"""
+    return SlideIngestStage.query.filter_by(upload_id=upload_id).order_by(SlideIngestStage.position).all()
+
+def _lease_time(stage: SlideIngestStage) -> Optional[datetime]:
+    return stage.heartbeat_at or stage.started_at
+
+def is_ingest_running(stages: List[SlideIngestStage]) -> bool:
+    """Verificar se a ingestão está com um worker (lease renovado recentemente)"""
+    if not stages or stages[0].slide.status != 'processing':
+        return False
+    stale_before = datetime.utcnow() - timedelta(seconds=INGEST_STALE_SECONDS)
+    return any(_lease_time(stage) and _lease_time(stage) > stale_before for stage in stages)
+
+def claim_ingest(slide: Slide, stages: List[SlideIngestStage]) -> bool:
+    """Reservar a ingestão para um novo worker (retry ou retomada de órfã)
+
+    UPDATE condicional: lâmina fora de 'processing', ou em 'processing' com
+    lease vencido. Com chamadas concorrentes, apenas uma reserva.
+    """
+    now = datetime.utcnow()
+    if slide.status != 'processing':
+        claimed = Slide.query.filter(Slide.id == slide.id, Slide.status != 'processing') \
+            .update({Slide.status: 'processing'}, synchronize_session=False)
+    else:
+        stale_before = now - timedelta(seconds=INGEST_STALE_SECONDS)
+        lease = db.func.coalesce(SlideIngestStage.heartbeat_at, SlideIngestStage.started_at)
+        claimed = SlideIngestStage.query.filter(
+            SlideIngestStage.slide_id == slide.id,
+            db.or_(lease.is_(None), lease < stale_before)
+        ).update({SlideIngestStage.heartbeat_at: now}, synchronize_session=False) == len(stages)
+
+    if not claimed:
+        db.session.rollback()
+        return False
+
+    SlideIngestStage.query.filter_by(slide_id=slide.id) \
+        .update({SlideIngestStage.heartbeat_at: now}, synchronize_session=False)
+    db.session.commit()
+    db.session.refresh(slide)
+    return True
+
+def get_resume_stage(stages: List[SlideIngestStage]) -> Optional[str]:
+    """Estágio onde retomar: o que falhou/foi interrompido, ou o primeiro pendente"""
+    for status in (('failed', 'running'), ('pending',)):
+        for stage in stages:
+            if stage.status in status:
+                return stage.stage
+    return None
+
+def _stage_assemble(slide: Slide, manager, upload_id: str, processor: SlideProcessor) -> Dict:
+    # resume: a ingestão tem o lease, então pode retomar uma montagem interrompida
+    result = manager.assemble_file(upload_id, slide.file_path, resume=True)
+    slide.file_size = result['file_size']
+    return {'file_size': result['file_size']}
+
+def _stage_verify(slide: Slide, manager, upload_id: str, processor: SlideProcessor) -> Dict:
+    result = manager.verify_file(upload_id)
+    slide.content_hash = result['content_hash']
+    return {'content_hash': result['content_hash']}
+
+def _stage_store(slide: Slide, manager, upload_id: str, processor: SlideProcessor) -> Dict:
+    # Conteúdo já conhecido: metadados e derivados do blob existente são reaproveitados
+    details = store_blob(slide, os.path.splitext(slide.original_filename)[1])
+    if details['deduplicated']:
+        details['skip_remaining'] = True
+    return details
+
+def _stage_validate(slide: Slide, manager, upload_id: str, processor: SlideProcessor) -> Dict:
+    # Cabeçalho primeiro (barato), depois abertura pelo OpenSlide
+    with open(slide.file_path, 'rb') as f:
+        file_header = f.read(1024)
+
+    validation = manager.validate_file_format(slide.original_filename, file_header)
+    if not validation['valid']:
+        raise ValueError(validation['error'])
+
+    slide_validation = processor.validate_slide(slide.file_path)
+    if not slide_validation['valid']:
+        raise ValueError(slide_validation['error'])
+
+    return {'detected_format': validation.get('detected_format'), 'format': slide_validation['format']}
+
+def _stage_metadata(slide: Slide, manager, upload_id: str, processor: SlideProcessor) -> Dict:
+    slide_metadata = processor.extract_metadata(slide.file_path)
+
+    slide.scanner_type = slide_metadata.get('scanner_type')
+    slide.stain_type = slide_metadata.get('stain_type')
+    slide.width = slide_metadata.get('width')
+    slide.height = slide_metadata.get('height')
+    slide.levels = slide_metadata.get('levels')
+    slide.mpp_x = slide_metadata.get('mpp_x')
+    slide.mpp_y = slide_metadata.get('mpp_y')
+
+    return {
+        'objective_power': slide_metadata.get('objective_power'),
+        'vendor': slide_metadata.get('vendor')
+    }
+
+def _stage_derivatives(slide: Slide, manager, upload_id: str, processor: SlideProcessor) -> Dict:
+    return processor.generate_derivatives(slide.file_path)
+
+STAGE_HANDLERS = {
+    'assemble': _stage_assemble,
+    'verify': _stage_verify,
+    'store': _stage_store,
+    'validate': _stage_validate,
+    'metadata': _stage_metadata,
+    'derivatives': _stage_derivatives
+}
+
+def run_ingest(slide: Slide, manager, start_stage: Optional[str] = None) -> bool:
+    """Executar estágios pendentes (ou a partir de start_stage) e atualizar status
+
+    Estágios já concluídos são pulados, exceto start_stage, que é sempre
+    reexecutado. Para no primeiro estágio com falha, deixando a lâmina em
+    'error'; retorna True se todos os estágios foram concluídos.
+    """
+    processor = SlideProcessor()
+    stages = SlideIngestStage.query.filter_by(slide_id=slide.id).order_by(SlideIngestStage.position).all()
+
+    names = [stage.stage for stage in stages]
+    start = names.index(start_stage) if start_stage in names else 0
+
+    skip_remaining = False
+    for stage in stages[start:]:
+        if skip_remaining:
+            stage.status = 'skipped'
+            stage.details = json.dumps({'reason': 'deduplicated'})
+            continue
+
+        if stage.status in ('completed', 'skipped') and stage.stage != start_stage:
+            continue
+
+        stage.status = 'running'
+        stage.attempts = (stage.attempts or 0) + 1
+        stage.error = None
+        stage.started_at = datetime.utcnow()
+        stage.heartbeat_at = stage.started_at
+        stage.finished_at = None
+        db.session.commit()
+
+        try:
+            details = STAGE_HANDLERS[stage.stage](slide, manager, stage.upload_id, processor)
+            skip_remaining = bool(details and details.pop('skip_remaining', False))
+            stage.details = json.dumps(details) if details else None
+            stage.status = 'completed'
+        except Exception as e:
+            # Descartar alterações parciais do estágio (ex.: violação de chave única)
+            db.session.rollback()
+            stage.status = 'failed'
+            stage.error = str(e)
+            slide.status = 'error'
+        finally:
+            stage.finished_at = datetime.utcnow()
+            db.session.commit()
+
+        if stage.status == 'failed':
+            return False
+
+    slide.status = 'ready'
+    db.session.commit()
+    return True
+
+class IngestWorkerPool:
+    """Pool de workers para ingestão de lâminas em segundo plano"""
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or int(os.environ.get('INGEST_WORKERS', 2))
+        self._executor = None
+        self._lock = threading.Lock()
+        # Lâminas na fila ou em ingestão neste processo (recebem heartbeat)
+        self._inflight = set()
+        self._heartbeat = None
+        self._heartbeat_pid = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Criado sob demanda para não herdar threads através do fork do gunicorn
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='aiapad-ingest')
+            return self._executor
+
+    def submit(self, app, slide_id: int, manager, start_stage: str = None):
+        """Agendar ingestão de uma lâmina (status processing)"""
+        with self._lock:
+            self._inflight.add(slide_id)
+        self._start_heartbeat(app, manager)
+        return self._get_executor().submit(self._run, app, slide_id, manager, start_stage)
+
+    def _start_heartbeat(self, app, manager):
+        with self._lock:
+            # Threads não sobrevivem ao fork do gunicorn: recriar no processo filho
+            if self._heartbeat is not None and self._heartbeat_pid == os.getpid() and self._heartbeat.is_alive():
+                return
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, args=(app, manager),
+                                               name='aiapad-ingest-heartbeat', daemon=True)
+            self._heartbeat_pid = os.getpid()
+            self._heartbeat.start()
+
+    def _heartbeat_loop(self, app, manager):
+        while True:
+            time.sleep(INGEST_HEARTBEAT_INTERVAL)
+            with app.app_context():
+                try:
+                    with self._lock:
+                        slide_ids = list(self._inflight)
+                    if slide_ids:
+                        SlideIngestStage.query.filter(SlideIngestStage.slide_id.in_(slide_ids)) \
+                            .update({SlideIngestStage.heartbeat_at: datetime.utcnow()}, synchronize_session=False)
+                        db.session.commit()
+                    self.recover_stale(app, manager)
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Erro no heartbeat da ingestão: {e}")
+                finally:
+                    db.session.remove()
+
+    def recover_stale(self, app, manager, limit: int = 50) -> List[int]:
+        """Retomar neste processo ingestões órfãs (lease vencido)
+
+        O estágio interrompido é reexecutado; após INGEST_MAX_ATTEMPTS ele é
+        marcado como falha e a lâmina fica em 'error' (retry manual).
+        Retorna as lâminas reagendadas.
+        """
+        stale_before = datetime.utcnow() - timedelta(seconds=INGEST_STALE_SECONDS)
+        lease = db.func.max(db.func.coalesce(SlideIngestStage.heartbeat_at, SlideIngestStage.started_at))
+        slide_ids = [
+            slide_id for slide_id, in db.session.query(SlideIngestStage.slide_id)
+            .join(Slide, Slide.id == SlideIngestStage.slide_id)
+            .filter(Slide.status == 'processing')
+            .group_by(SlideIngestStage.slide_id)
+            .having(db.or_(lease.is_(None), lease < stale_before))
+            .limit(limit)
+        ]
+
+        resumed = []
+        for slide_id in slide_ids:
+            slide = Slide.query.get(slide_id)
+            stages = SlideIngestStage.query.filter_by(slide_id=slide_id).order_by(SlideIngestStage.position).all()
+            if slide is None or not claim_ingest(slide, stages):
+                continue
+
+            interrupted = next((stage for stage in stages if stage.status == 'running'), None)
+            if interrupted is not None and (interrupted.attempts or 0) >= INGEST_MAX_ATTEMPTS:
+                interrupted.status = 'failed'
+                interrupted.error = f'Estágio interrompido (worker encerrado) após {interrupted.attempts} tentativas'
+                interrupted.finished_at = datetime.utcnow()
+                slide.status = 'error'
+                db.session.commit()
+                continue
+
+            self.submit(app, slide_id, manager, start_stage=get_resume_stage(stages))
+            resumed.append(slide_id)
+
+        if slide_ids:
+            app.logger.warning(f"Ingestões órfãs: {len(resumed)} retomadas de {len(slide_ids)}")
+        return resumed
+
+    def _run(self, app, slide_id: int, manager, start_stage: str = None):
+        with app.app_context():
+            try:
+                slide = Slide.query.get(slide_id)
+                if not slide:
+                    return
+
+                if run_ingest(slide, manager, start_stage):
+                    # Primeira visualização já encontra thumbnail e tiles em cache
+                    cache_warmer.submit(app, slide_ids=[slide_id])
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Erro na ingestão da lâmina {slide_id}: {e}")
+            finally:
+                with self._lock:
+                    self._inflight.discard(slide_id)
+                db.session.remove()
+
+# Instância global do pool
+ingest_pool = IngestWorkerPool()
@@ -6,13 +6,16 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 from flask import Flask, send_from_directory
 from flask_cors import CORS
 from src.models.user import db
+from src.models.slide import migrate_schema
 from src.routes.user import user_bp
 from src.routes.slide import slide_bp
 from src.routes.auth import auth_bp, init_jwt
 from src.routes.upload import upload_bp
+from src.routes.analysis import analysis_bp
 from src.utils.monitoring import monitoring_bp
 from src.utils.rate_limiting import init_rate_limiter
 from src.utils.cache import cache
+from src.utils.cache_warmup import init_warmup
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'asdf#FGSgvasgf$5$WGT')
@@ -30,11 +33,15 @@ limiter = init_rate_limiter(app)
 # Inicializar cache
 cache.init_app(app)
 
+# Aquecimento do cache (comando `flask cache-warmup` e CACHE_WARMUP_ON_START)
+init_warmup(app)
+
 # Registrar blueprints
 app.register_blueprint(user_bp, url_prefix='/api')
 app.register_blueprint(slide_bp, url_prefix='/api')
 app.register_blueprint(auth_bp, url_prefix='/api/auth')
 app.register_blueprint(upload_bp, url_prefix='/api')
+app.register_blueprint(analysis_bp, url_prefix='/api')
 app.register_blueprint(monitoring_bp, url_prefix='/api')
 
 # Configurar banco de dados
@@ -59,6 +66,8 @@ with app.app_context():
     os.makedirs(os.environ.get('LOG_DIR', '/tmp/aiapad/logs'), exist_ok=True)
     
     db.create_all()
+    # Colunas novas em tabelas criadas por versões anteriores
+    migrate_schema()
     
     # Criar usuário admin padrão se não existir
     from src.models.user import User
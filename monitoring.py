@@ -3,13 +3,51 @@ import time
 import psutil
 import sqlite3
 from datetime import datetime
-from flask import Blueprint, jsonify, current_app
-from flask_jwt_extended import jwt_required
+from flask import Blueprint, jsonify, current_app, request
+from flask_jwt_extended import jwt_required, get_jwt_identity
 from src.models.user import User
 from src.models.slide import Slide
+from src.utils.profiling import STAGE_SECONDS_BUCKETS, BYTES_BUCKETS, analysis_metrics
+from src.utils.cache import cache, TileCache
+from src.utils.cache_metrics import CACHE_LATENCY_BUCKETS, CACHE_SIZE_BUCKETS
 
 monitoring_bp = Blueprint('monitoring', __name__)
 
+def _escape_label(value):
+    """Escapar valor de label para o formato de exposição do Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_bucket_histogram(name, help_text, buckets, series):
+    """Formatar histograma já agregado em buckets (contagens não cumulativas)
+
+    series: dict {tupla de labels: {'buckets': {limite: contagem}, 'sum', 'count'}}
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    
+    for labels, data in sorted(series.items()):
+        label_text = ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels)
+        prefix = f"{label_text}," if label_text else ""
+        
+        cumulative = 0
+        for bound in buckets:
+            cumulative += data['buckets'].get(bound, 0)
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {int(cumulative)}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {int(data["count"])}')
+        lines.append(f'{name}_sum{{{label_text}}} {data["sum"]}')
+        lines.append(f'{name}_count{{{label_text}}} {int(data["count"])}')
+    
+    return '\n'.join(lines) + '\n'
+
+def _bucket_series(fields, name, buckets):
+    """Extrair histograma '<name>_le_<limite>' dos campos agregados de um prefixo"""
+    if not fields.get(f"{name}_count"):
+        return None
+    return {
+        'buckets': {bound: fields.get(f"{name}_le_{bound}", 0) for bound in buckets},
+        'sum': fields.get(f"{name}_sum", 0),
+        'count': fields.get(f"{name}_count", 0)
+    }
+
 class SystemMonitor:
     """Monitor de sistema para AIAPad"""
     
@@ -114,6 +152,101 @@ class SystemMonitor:
         except Exception as e:
             return {'error': str(e)}
     
+    @staticmethod
+    def get_analysis_metrics():
+        """Histogramas de tempo por estágio, bytes lidos e pico de memória das análises"""
+        fields = analysis_metrics.snapshot(cache.redis_client if cache.enabled else None)
+        
+        # Séries agregadas: '<métrica>|<labels>_count' identifica cada combinação de labels
+        series = {'stage_seconds': {}, 'bytes_read': {}, 'peak_memory': {}}
+        for field in fields:
+            if not field.endswith('_count'):
+                continue
+            name = field[:-len('_count')]
+            parts = name.split('|')
+            if parts[0] == 'stage_seconds' and len(parts) == 3:
+                labels = (('stage', parts[1]), ('scanner', parts[2]))
+                buckets = STAGE_SECONDS_BUCKETS
+            elif parts[0] in ('bytes_read', 'peak_memory') and len(parts) == 2:
+                labels = (('scanner', parts[1]),)
+                buckets = BYTES_BUCKETS
+            else:
+                continue
+            series[parts[0]][labels] = _bucket_series(fields, name, buckets)
+        
+        return ''.join([
+            _format_bucket_histogram('aiapad_analysis_stage_seconds',
+                                     'Time spent in each analysis stage',
+                                     STAGE_SECONDS_BUCKETS, series['stage_seconds']),
+            _format_bucket_histogram('aiapad_analysis_bytes_read',
+                                     'Decoded slide bytes read per analysis',
+                                     BYTES_BUCKETS, series['bytes_read']),
+            _format_bucket_histogram('aiapad_analysis_peak_memory_bytes',
+                                     'Peak worker RSS sampled during each analysis',
+                                     BYTES_BUCKETS, series['peak_memory'])
+        ])
+    
+    @staticmethod
+    def get_cache_metrics():
+        """Acertos/falhas, latência e tamanho dos valores do cache por prefixo de chave"""
+        if cache.metrics is None:
+            return ''
+        
+        snapshot = cache.metrics.snapshot(cache.redis_client if cache.enabled else None)
+        
+        lines = [
+            "# HELP aiapad_cache_requests_total Cache operations by key prefix and result",
+            "# TYPE aiapad_cache_requests_total counter"
+        ]
+        latency_series = {}
+        size_series = {}
+        
+        for prefix, fields in sorted(snapshot.items()):
+            # Prefixo vem da chave (key_prefix de cached/tagged_key): escapar como label
+            label = _escape_label(prefix)
+            for op, results in (('get', ('hit', 'miss', 'error')), ('set', ('ok', 'rejected', 'error'))):
+                for result in results:
+                    value = fields.get(f"{op}_{result}")
+                    if value:
+                        lines.append(f'aiapad_cache_requests_total{{prefix="{label}",op="{op}",result="{result}"}} {int(value)}')
+                
+                latency = _bucket_series(fields, f"{op}_latency", CACHE_LATENCY_BUCKETS)
+                if latency:
+                    latency_series[(('prefix', prefix), ('op', op))] = latency
+            
+            if fields.get('l1_hit'):
+                lines.append(f'aiapad_cache_requests_total{{prefix="{label}",op="get",result="l1_hit"}} {int(fields["l1_hit"])}')
+            
+            if fields.get('evictions'):
+                lines.append(f'aiapad_cache_requests_total{{prefix="{label}",op="evict",result="ok"}} {int(fields["evictions"])}')
+            
+            size = _bucket_series(fields, 'size', CACHE_SIZE_BUCKETS)
+            if size:
+                size_series[(('prefix', prefix),)] = size
+        
+        if cache.enabled:
+            try:
+                tiles = TileCache.get_usage()
+                lines += [
+                    "# HELP aiapad_tile_cache_bytes Bytes of tiles held in the cache",
+                    "# TYPE aiapad_tile_cache_bytes gauge",
+                    f"aiapad_tile_cache_bytes {tiles['total_bytes']}",
+                    "# HELP aiapad_tile_cache_budget_bytes Byte budget of the tile cache",
+                    "# TYPE aiapad_tile_cache_budget_bytes gauge",
+                    f"aiapad_tile_cache_budget_bytes {tiles['budget_bytes']}"
+                ]
+            except Exception:
+                pass
+        
+        return '\n'.join(lines) + '\n' + ''.join([
+            _format_bucket_histogram('aiapad_cache_latency_seconds',
+                                     'Cache operation latency',
+                                     CACHE_LATENCY_BUCKETS, latency_series),
+            _format_bucket_histogram('aiapad_cache_value_bytes',
+                                     'Size of cached values read or written',
+                                     CACHE_SIZE_BUCKETS, size_series)
+        ])
+    
     @staticmethod
     def check_health():
         """Verificação de saúde do sistema"""
@@ -255,12 +388,33 @@ aiapad_uploads_size_bytes {app_info.get('storage', {}).get('uploads_size', 0)}
 # HELP aiapad_database_size_bytes Database size in bytes
 # TYPE aiapad_database_size_bytes gauge
 aiapad_database_size_bytes {app_info.get('storage', {}).get('database_size', 0)}
+
 """
+        metrics_text += SystemMonitor.get_analysis_metrics()
+        metrics_text += SystemMonitor.get_cache_metrics()
         
         return metrics_text, 200, {'Content-Type': 'text/plain; charset=utf-8'}
     except Exception as e:
         return f"# Error generating metrics: {str(e)}", 500, {'Content-Type': 'text/plain; charset=utf-8'}
 
+@monitoring_bp.route('/metrics/cache/keys', methods=['GET'])
+@jwt_required()
+def cache_top_keys():
+    """Chaves do cache mais acessadas e maiores valores (diagnóstico, apenas admins)"""
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id) if current_user_id else None
+    if not current_user or not current_user.has_permission('system_config'):
+        return jsonify({'error': 'Permissão insuficiente'}), 403
+    
+    if cache.metrics is None:
+        return jsonify({'error': 'Métricas do cache desativadas'}), 404
+    
+    try:
+        limit = min(int(request.args.get('limit', 50)), 1000)
+        return jsonify(cache.metrics.top_keys(cache.redis_client if cache.enabled else None, limit)), 200
+    except Exception as e:
+        return jsonify({'error': f'Erro ao obter chaves do cache: {str(e)}'}), 500
+
 @monitoring_bp.route('/status', methods=['GET'])
 def status():
     """Endpoint de status simples"""
@@ -0,0 +1,173 @@
+import re
+import time
+import threading
+import psutil
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# Estágios instrumentados na análise de lâminas, na ordem em que ocorrem
+ANALYSIS_STAGES = [
+    'slide_open',
+    'region_read',
+    'color_conversion',
+    'stain_detection',
+    'texture',
+    'roi',
+    'heatmap',
+    'serialization'
+]
+
+# Buckets dos histogramas de análise
+STAGE_SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+BYTES_BUCKETS = [2 ** p for p in range(20, 36, 2)]  # 1MB .. 16GB
+
+# Hash no Redis com os histogramas agregados entre workers
+ANALYSIS_METRICS_KEY = 'analysis_metrics'
+
+# Valores de label vindos dos metadados da lâmina (texto livre do fabricante)
+METRIC_LABEL_MAX_LENGTH = 64
+_LABEL_UNSAFE = re.compile(r'[|\x00-\x1f\x7f]+')
+
+def metric_label(value: Optional[str], default: str = 'Unknown') -> str:
+    """Normalizar texto livre para uso como label
+
+    '|' separa labels nos campos do hash de métricas e caracteres de
+    controle não têm lugar na exposição; o tamanho é limitado.
+    """
+    value = _LABEL_UNSAFE.sub(' ', value or '').strip()[:METRIC_LABEL_MAX_LENGTH].strip()
+    return value or default
+
+class StageTimer:
+    """Cronômetro por estágio para análises de IA"""
+
+    def __init__(self, trace_memory: bool = True):
+        self.stages = {}
+        self.bytes_read = 0
+        self.peak_memory = None
+        self.trace_memory = trace_memory
+        self._process = psutil.Process() if trace_memory else None
+        self._start = None
+        self._end = None
+
+    def start(self):
+        """Iniciar medição (tempo total e pico de memória)"""
+        self._start = time.perf_counter()
+        self._sample_memory()
+        return self
+
+    def _sample_memory(self):
+        """Amostrar o RSS do processo (pico = maior amostra entre estágios)
+
+        Sem estado global: análises concorrentes não interferem entre si, e o
+        valor é o RSS do worker, que inclui o que outras threads alocaram.
+        """
+        if self._process is None:
+            return
+        try:
+            rss = self._process.memory_info().rss
+        except psutil.Error:
+            return
+        if self.peak_memory is None or rss > self.peak_memory:
+            self.peak_memory = rss
+
+    def stop(self):
+        """Finalizar medição"""
+        if self._start is None:
+            return self
+
+        self._end = time.perf_counter()
+        self._sample_memory()
+        return self
+
+    @contextmanager
+    def stage(self, name: str):
+        """Medir um estágio (tempos de estágios repetidos são somados)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start)
+            self._sample_memory()
+
+    def add_bytes_read(self, num_bytes: int):
+        """Registrar bytes lidos/decodificados da lâmina"""
+        self.bytes_read += int(num_bytes)
+
+    def total_time(self) -> float:
+        """Tempo total medido (ou soma dos estágios se start() não foi chamado)"""
+        if self._start is None:
+            return sum(self.stages.values())
+        end = self._end if self._end is not None else time.perf_counter()
+        return end - self._start
+
+    def to_dict(self) -> Dict:
+        return {
+            'stages': {name: round(value, 6) for name, value in self.stages.items()},
+            'total': round(self.total_time(), 6),
+            'bytes_read': self.bytes_read,
+            'peak_memory': self.peak_memory
+        }
+
+class AnalysisMetrics:
+    """Histogramas das análises atualizados ao concluir cada análise
+
+    Campos '<métrica>|<labels>_le_<limite>' (contagens não cumulativas),
+    '_sum' e '_count', somados no Redis (ou localmente sem Redis). Assim o
+    /metrics lê um único hash em vez de percorrer todas as análises.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = defaultdict(float)
+
+    @staticmethod
+    def _observe(fields: Dict, name: str, buckets, value: float):
+        index = bisect_left(buckets, value)
+        bound = buckets[index] if index < len(buckets) else '+Inf'
+        fields[f"{name}_le_{bound}"] += 1
+        fields[f"{name}_sum"] += value
+        fields[f"{name}_count"] += 1
+
+    def record(self, client, timings: Dict, scanner: Optional[str]):
+        """Registrar uma análise concluída (timings: StageTimer.to_dict())"""
+        scanner = metric_label(scanner)
+        fields = defaultdict(float)
+
+        for stage in ANALYSIS_STAGES:
+            if stage in timings['stages']:
+                self._observe(fields, f"stage_seconds|{stage}|{scanner}", STAGE_SECONDS_BUCKETS,
+                              timings['stages'][stage])
+        if timings.get('bytes_read') is not None:
+            self._observe(fields, f"bytes_read|{scanner}", BYTES_BUCKETS, timings['bytes_read'])
+        if timings.get('peak_memory') is not None:
+            self._observe(fields, f"peak_memory|{scanner}", BYTES_BUCKETS, timings['peak_memory'])
+
+        if client is None:
+            with self._lock:
+                for field, value in fields.items():
+                    self._totals[field] += value
+            return
+
+        pipe = client.pipeline(transaction=False)
+        for field, value in fields.items():
+            if float(value).is_integer():
+                pipe.hincrby(ANALYSIS_METRICS_KEY, field, int(value))
+            else:
+                pipe.hincrbyfloat(ANALYSIS_METRICS_KEY, field, value)
+        pipe.execute()
+
+    def snapshot(self, client) -> Dict[str, float]:
+        """Campos agregados {campo: valor}"""
+        if client is None:
+            with self._lock:
+                return dict(self._totals)
+
+        return {
+            (field.decode() if isinstance(field, bytes) else field): float(value)
+            for field, value in client.hgetall(ANALYSIS_METRICS_KEY).items()
+        }
+
+# Instância global
+analysis_metrics = AnalysisMetrics()
@@ -83,14 +83,16 @@ RATE_LIMIT_CONFIG = {
     
     # Upload
     'upload.init_upload': upload_rate_limit(),
-    'upload.upload_chunk': "1000 per hour",  # Muitos chunks por upload
+    'upload.upload_chunk': "20000 per hour",  # Muitos chunks por upload, enviados em paralelo
     'upload.complete_upload': upload_rate_limit(),
+    'upload.link_duplicate': upload_rate_limit(),
     
     # Slides
     'slide.upload_slide': upload_rate_limit(),
     'slide.get_slides': api_rate_limit(),
     'slide.get_slide': api_rate_limit(),
     'slide.analyze_slide': "5 per minute",  # IA é custosa
+    'analysis.create_batch': "5 per minute",  # Um lote agenda muitas análises
     
     # Admin
     'auth.list_users': admin_rate_limit(),
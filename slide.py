@@ -1,5 +1,8 @@
+import json
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
 from src.models.user import db
 
 class Slide(db.Model):
@@ -8,6 +11,7 @@ class Slide(db.Model):
     original_filename = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(500), nullable=False)
     file_size = db.Column(db.BigInteger, nullable=False)
+    content_hash = db.Column(db.String(64), index=True)  # hash tree root of the file (blob key)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     scanner_type = db.Column(db.String(100))
     stain_type = db.Column(db.String(100))
@@ -22,6 +26,7 @@ class Slide(db.Model):
     # Relacionamentos
     annotations = db.relationship('Annotation', backref='slide', lazy=True, cascade='all, delete-orphan')
     ai_analyses = db.relationship('AIAnalysis', backref='slide', lazy=True, cascade='all, delete-orphan')
+    ingest_stages = db.relationship('SlideIngestStage', backref='slide', lazy=True, cascade='all, delete-orphan')
 
     def __repr__(self):
         return f'<Slide {self.filename}>'
@@ -32,6 +37,7 @@ class Slide(db.Model):
             'filename': self.filename,
             'original_filename': self.original_filename,
             'file_size': self.file_size,
+            'content_hash': self.content_hash,
             'upload_date': self.upload_date.isoformat() if self.upload_date else None,
             'scanner_type': self.scanner_type,
             'stain_type': self.stain_type,
@@ -85,8 +91,17 @@ class AIAnalysis(db.Model):
     confidence = db.Column(db.Float)
     result = db.Column(db.Text)  # JSON string with detailed results
     processing_time = db.Column(db.Float)
+    stage_timings = db.Column(db.Text)  # JSON with per-stage timings (slide_open, region_read, ...)
+    bytes_read = db.Column(db.BigInteger)
+    peak_memory = db.Column(db.BigInteger)
+    heatmap = db.Column(db.LargeBinary)  # uint8 score per tile, row-major
+    heatmap_width = db.Column(db.Integer)  # tiles per row
+    heatmap_height = db.Column(db.Integer)  # tiles per column
+    heatmap_tile_size = db.Column(db.Integer)  # level 0 pixels per tile
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
-    status = db.Column(db.String(50), default='pending')  # pending, completed, failed
+    status = db.Column(db.String(50), default='pending')  # pending, processing, completed, failed
+    attempts = db.Column(db.Integer, default=0)
+    heartbeat_at = db.Column(db.DateTime, index=True)  # refreshed while queued/running in a worker
     
     def __repr__(self):
         return f'<AIAnalysis {self.id} for Slide {self.slide_id}>'
@@ -100,7 +115,145 @@ class AIAnalysis(db.Model):
             'confidence': self.confidence,
             'result': self.result,
             'processing_time': self.processing_time,
+            'stage_timings': json.loads(self.stage_timings) if self.stage_timings else None,
+            'bytes_read': self.bytes_read,
+            'peak_memory': self.peak_memory,
+            'has_heatmap': self.heatmap is not None,
             'created_date': self.created_date.isoformat() if self.created_date else None,
-            'status': self.status
+            'status': self.status,
+            'attempts': self.attempts
         }
 
+
+class AnalysisBatch(db.Model):
+    """Batch of identical analyses submitted over many slides"""
+    id = db.Column(db.Integer, primary_key=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    analysis_type = db.Column(db.String(100), nullable=False)
+    model_name = db.Column(db.String(100), nullable=False)
+    slide_filter = db.Column(db.Text)  # JSON with the filter used to select slides, if any
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    items = db.relationship('AnalysisBatchItem', backref='batch', lazy=True, cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return f'<AnalysisBatch {self.id}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'created_by': self.created_by,
+            'analysis_type': self.analysis_type,
+            'model_name': self.model_name,
+            'slide_filter': json.loads(self.slide_filter) if self.slide_filter else None,
+            'created_date': self.created_date.isoformat() if self.created_date else None,
+            'total': len(self.items)
+        }
+
+class AnalysisBatchItem(db.Model):
+    """Slide of a batch and the analysis that answers it (new or deduplicated)"""
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.Integer, db.ForeignKey('analysis_batch.id'), nullable=False, index=True)
+    slide_id = db.Column(db.Integer, db.ForeignKey('slide.id'), nullable=False)
+    analysis_id = db.Column(db.Integer, db.ForeignKey('ai_analysis.id'), nullable=False)
+    deduplicated = db.Column(db.Boolean, default=False)
+    
+    analysis = db.relationship('AIAnalysis')
+
+    def __repr__(self):
+        return f'<AnalysisBatchItem {self.batch_id}:{self.slide_id}>'
+
+    def to_dict(self):
+        return {
+            'slide_id': self.slide_id,
+            'analysis_id': self.analysis_id,
+            'deduplicated': self.deduplicated,
+            'status': self.analysis.status if self.analysis else None
+        }
+
+class SlideBlob(db.Model):
+    """Content-addressed slide file shared by every Slide with the same content"""
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), unique=True, nullable=False)
+    file_path = db.Column(db.String(500), nullable=False)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<SlideBlob {self.content_hash[:12]}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'content_hash': self.content_hash,
+            'file_size': self.file_size,
+            'ref_count': self.ref_count,
+            'created_date': self.created_date.isoformat() if self.created_date else None
+        }
+
+class SlideIngestStage(db.Model):
+    """One stage of the post-upload ingest pipeline for a slide"""
+    id = db.Column(db.Integer, primary_key=True)
+    slide_id = db.Column(db.Integer, db.ForeignKey('slide.id'), nullable=False, index=True)
+    upload_id = db.Column(db.String(64), nullable=False, index=True)
+    stage = db.Column(db.String(50), nullable=False)  # assemble, verify, store, validate, metadata, derivatives
+    position = db.Column(db.Integer, nullable=False)  # execution order
+    status = db.Column(db.String(50), default='pending')  # pending, running, completed, failed, skipped
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    details = db.Column(db.Text)  # JSON with stage output (hash, paths, ...)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # lease: refreshed while the ingest is queued/running in a worker
+
+    def __repr__(self):
+        return f'<SlideIngestStage {self.slide_id}:{self.stage}>'
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'details': json.loads(self.details) if self.details else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration': (self.finished_at - self.started_at).total_seconds()
+                        if self.started_at and self.finished_at else None
+        }
+
+# Colunas adicionadas a tabelas já existentes (db.create_all não altera tabelas)
+COLUMN_MIGRATIONS = {
+    'slide': ['content_hash'],
+    'ai_analysis': ['stage_timings', 'bytes_read', 'peak_memory', 'heatmap', 'heatmap_width',
+                    'heatmap_height', 'heatmap_tile_size', 'attempts', 'heartbeat_at'],
+}
+
+def migrate_schema():
+    """Adicionar colunas novas (e seus índices) em bancos criados por versões anteriores
+
+    Idempotente: chamar após db.create_all(), dentro do app context. O tipo
+    de cada coluna vem do modelo, compilado para o dialeto do banco em uso.
+    """
+    tables = db.Model.metadata.tables
+    inspector = inspect(db.engine)
+    for table_name, columns in COLUMN_MIGRATIONS.items():
+        table = tables[table_name]
+        existing = {column['name'] for column in inspector.get_columns(table_name)}
+        for name in columns:
+            if name in existing:
+                continue
+            column_type = table.c[name].type.compile(dialect=db.engine.dialect)
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {name} {column_type}'))
+            except (OperationalError, ProgrammingError):
+                # Outro processo adicionou a coluna ao mesmo tempo
+                pass
+
+        # Índices das colunas migradas (index=True no modelo)
+        with db.engine.begin() as conn:
+            for index in table.indexes:
+                if any(column.name in columns for column in index.columns):
+                    index.create(bind=conn, checkfirst=True)
@@ -1,7 +1,144 @@
 import openslide
 import os
 import re
-from typing import Dict, Optional
+import math
+import numpy as np
+import cv2
+from PIL import Image
+from typing import Dict, Optional, Tuple
+
+# Orçamento padrão de pixels para leituras da imagem inteira
+DEFAULT_MAX_MEGAPIXELS = float(os.environ.get('SLIDE_READ_MAX_MEGAPIXELS', 16))
+# Limite de pixels lidos na origem (nível escolhido) antes de recusar a leitura
+MAX_SOURCE_MEGAPIXELS = float(os.environ.get('SLIDE_READ_MAX_SOURCE_MEGAPIXELS', 8192))
+# Lado do bloco lido por vez quando o nível não cabe no orçamento
+READ_TILE_SIZE = 4096
+# Pixels mais escuros que este nível de cinza são considerados tecido
+TISSUE_GRAY_THRESHOLD = 220
+
+def get_derived_dir(slide_path: str) -> str:
+    """Diretório de arquivos derivados (thumbnail, máscara) de uma lâmina"""
+    stem = os.path.splitext(os.path.basename(slide_path))[0]
+    return os.path.join(os.path.dirname(slide_path), 'derived', stem)
+
+class SlideReadBudgetError(ValueError):
+    """Leitura recusada por exceder o orçamento de memória"""
+    pass
+
+def read_image_within_budget(slide: openslide.OpenSlide, max_megapixels: float = None,
+                             max_size: Optional[Tuple[int, int]] = None,
+                             timer=None) -> Tuple[np.ndarray, Dict]:
+    """Ler a lâmina inteira com no máximo max_megapixels (e opcionalmente max_size)
+
+    Usa o nível mais detalhado que cabe no orçamento (sem upsampling quando
+    max_size é pedido). Se nem o nível mais reduzido couber, ele é lido em blocos
+    e reduzido progressivamente para um buffer de saída pré-alocado, mantendo a
+    memória limitada a saída + um bloco. Retorna (array RGB uint8, informações).
+    """
+    max_pixels = (max_megapixels or DEFAULT_MAX_MEGAPIXELS) * 1e6
+    width, height = slide.dimensions
+    
+    if width <= 0 or height <= 0:
+        raise SlideReadBudgetError('Dimensões inválidas')
+    
+    # Redução mínima pedida pelo tamanho máximo de saída
+    target_downsample = 1.0
+    if max_size:
+        target_downsample = max(1.0, width / max_size[0], height / max_size[1])
+    
+    # Nível mais detalhado sem upsampling; subir na pirâmide até caber no orçamento
+    level = slide.get_best_level_for_downsample(target_downsample)
+    while (level < slide.level_count - 1 and
+           slide.level_dimensions[level][0] * slide.level_dimensions[level][1] > max_pixels):
+        level += 1
+    
+    level_width, level_height = slide.level_dimensions[level]
+    level_downsample = slide.level_downsamples[level]
+    level_pixels = level_width * level_height
+    
+    # Redução final em relação ao nível 0
+    downsample = max(target_downsample, level_downsample)
+    if level_pixels > max_pixels:
+        downsample = max(downsample, level_downsample * math.sqrt(level_pixels / max_pixels))
+    
+    if downsample == level_downsample:
+        out_width, out_height = level_width, level_height
+    else:
+        out_width = max(1, min(level_width, int(width / downsample)))
+        out_height = max(1, min(level_height, int(height / downsample)))
+    
+    info = {
+        'level': level,
+        'level_dimensions': (level_width, level_height),
+        'level_downsample': level_downsample,
+        'output_dimensions': (out_width, out_height),
+        'downsample': width / out_width,
+        'tiled_read': False
+    }
+    
+    if level_pixels <= max_pixels:
+        # Nível cabe no orçamento: leitura direta
+        region = _read_level_region(slide, level, 0, 0, level_width, level_height, level_downsample, timer)
+        if (level_width, level_height) != (out_width, out_height):
+            region = _timed_resize(region, out_width, out_height, timer)
+        return region, info
+    
+    # Nem o nível mais reduzido cabe (ex.: TIFF de nível único): leitura em blocos
+    if level_pixels > MAX_SOURCE_MEGAPIXELS * 1e6:
+        raise SlideReadBudgetError(
+            f'Nível {level} tem {level_width}x{level_height} pixels; '
+            f'limite de leitura é {MAX_SOURCE_MEGAPIXELS:.0f} megapixels'
+        )
+    
+    info['tiled_read'] = True
+    output = np.empty((out_height, out_width, 3), dtype=np.uint8)
+    scale_x = out_width / level_width
+    scale_y = out_height / level_height
+    
+    # Bloco grande o suficiente para que cada um gere ao menos 1 pixel de saída
+    tile = max(READ_TILE_SIZE, int(math.ceil(1 / min(scale_x, scale_y))))
+    
+    for tile_y in range(0, level_height, tile):
+        tile_h = min(tile, level_height - tile_y)
+        y0 = int(round(tile_y * scale_y))
+        y1 = out_height if tile_y + tile_h >= level_height else int(round((tile_y + tile_h) * scale_y))
+        if y1 <= y0:
+            continue
+        
+        for tile_x in range(0, level_width, tile):
+            tile_w = min(tile, level_width - tile_x)
+            x0 = int(round(tile_x * scale_x))
+            x1 = out_width if tile_x + tile_w >= level_width else int(round((tile_x + tile_w) * scale_x))
+            if x1 <= x0:
+                continue
+            
+            region = _read_level_region(slide, level, tile_x, tile_y, tile_w, tile_h, level_downsample, timer)
+            output[y0:y1, x0:x1] = _timed_resize(region, x1 - x0, y1 - y0, timer)
+    
+    return output, info
+
+def _read_level_region(slide, level, x, y, width, height, downsample, timer=None) -> np.ndarray:
+    """Ler região (coordenadas do nível) e converter para RGB"""
+    location = (int(x * downsample), int(y * downsample))
+    
+    if timer is None:
+        region = slide.read_region(location, level, (width, height))
+        return np.asarray(region.convert('RGB'))
+    
+    with timer.stage('region_read'):
+        region = slide.read_region(location, level, (width, height))
+    timer.add_bytes_read(width * height * 4)  # RGBA decodificado
+    
+    with timer.stage('color_conversion'):
+        return np.asarray(region.convert('RGB'))
+
+def _timed_resize(region: np.ndarray, width: int, height: int, timer=None) -> np.ndarray:
+    """Reduzir bloco com interpolação por área"""
+    if timer is None:
+        return cv2.resize(region, (width, height), interpolation=cv2.INTER_AREA)
+    
+    with timer.stage('color_conversion'):
+        return cv2.resize(region, (width, height), interpolation=cv2.INTER_AREA)
 
 class SlideProcessor:
     """Classe para processamento e extração de metadados de lâminas digitais"""
@@ -191,6 +328,50 @@ class SlideProcessor:
             print(f"Erro ao gerar coordenadas de tiles: {e}")
             return []
     
+    def get_thumbnail(self, slide_path: str, max_size: Tuple[int, int] = (300, 300)) -> Image.Image:
+        """Gerar thumbnail respeitando o orçamento de memória"""
+        slide = openslide.OpenSlide(slide_path)
+        
+        try:
+            img_array, _ = read_image_within_budget(slide, max_size=max_size)
+        finally:
+            slide.close()
+        
+        return Image.fromarray(img_array)
+    
+    def generate_derivatives(self, slide_path: str, output_dir: str = None,
+                             thumbnail_size: Tuple[int, int] = (300, 300),
+                             mask_size: Tuple[int, int] = (1024, 1024)) -> Dict:
+        """Gerar thumbnail e máscara de tecido a partir de uma única leitura reduzida"""
+        output_dir = output_dir or get_derived_dir(slide_path)
+        os.makedirs(output_dir, exist_ok=True)
+        
+        slide = openslide.OpenSlide(slide_path)
+        try:
+            img_array, info = read_image_within_budget(slide, max_size=mask_size)
+        finally:
+            slide.close()
+        
+        # Máscara de tecido: fundo claro (vidro) descartado, ruído removido por abertura
+        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        mask = np.where(gray < TISSUE_GRAY_THRESHOLD, 255, 0).astype(np.uint8)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+        
+        mask_path = os.path.join(output_dir, 'tissue_mask.png')
+        Image.fromarray(mask).save(mask_path)
+        
+        thumbnail = Image.fromarray(img_array)
+        thumbnail.thumbnail(thumbnail_size, Image.LANCZOS)
+        thumbnail_path = os.path.join(output_dir, 'thumbnail.png')
+        thumbnail.save(thumbnail_path)
+        
+        return {
+            'thumbnail': thumbnail_path,
+            'tissue_mask': mask_path,
+            'mask_downsample': info['downsample'],
+            'tissue_fraction': float(np.count_nonzero(mask)) / mask.size
+        }
+    
     def validate_slide(self, slide_path: str) -> Dict:
         """Validar se o arquivo é uma lâmina válida"""
         result = {
@@ -0,0 +1,191 @@
+import os
+import shutil
+import hashlib
+import secrets
+from typing import Dict, Optional, Tuple
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from src.models.slide import Slide, SlideBlob, db
+from src.utils.slide_processor import get_derived_dir
+
+# Compartilhar um único arquivo (blob) entre lâminas com o mesmo conteúdo.
+# Desativado por padrão: só é seguro quando a exclusão de lâminas chama
+# release_slide_blob; a rota DELETE /slides/<id> ainda remove slide.file_path
+# diretamente, o que apagaria o arquivo de todas as lâminas que o usam
+DEDUP_ENABLED = os.environ.get('SLIDE_DEDUP_ENABLED', '0') == '1'
+
+# Trecho do arquivo que o cliente precisa provar que possui para reaproveitar um blob
+DEDUP_CHALLENGE_SIZE = 64 * 1024
+DEDUP_CHALLENGE_MAX_AGE = 600  # segundos
+
+# Campos copiados da lâmina de referência ao reaproveitar um blob
+SLIDE_METADATA_FIELDS = ['scanner_type', 'stain_type', 'width', 'height', 'levels', 'mpp_x', 'mpp_y']
+
+def is_content_hash(value: str) -> bool:
+    """Verificar se o valor é uma raiz de árvore de hash (SHA-256 em hex)"""
+    if not value or len(value) != 64:
+        return False
+    try:
+        int(value, 16)
+        return True
+    except ValueError:
+        return False
+
+def get_blob_path(slides_dir: str, content_hash: str, extension: str) -> str:
+    """Caminho do blob: <slides>/blobs/<h[:2]>/<h><ext>"""
+    return os.path.join(slides_dir, 'blobs', content_hash[:2], f"{content_hash}{extension.lower()}")
+
+def find_blob(content_hash: str) -> Tuple[Optional[SlideBlob], Optional[Slide]]:
+    """Blob disponível e uma lâmina pronta que o usa (fonte dos metadados)"""
+    if not DEDUP_ENABLED:
+        return None, None
+
+    content_hash = content_hash.lower()
+    blob = SlideBlob.query.filter_by(content_hash=content_hash).first()
+    if blob is None or blob.ref_count <= 0 or not os.path.exists(blob.file_path):
+        return None, None
+
+    reference = Slide.query.filter_by(content_hash=content_hash, status='ready') \
+        .order_by(Slide.id).first()
+    if reference is None:
+        return None, None
+
+    return blob, reference
+
+def acquire_blob(blob: SlideBlob) -> bool:
+    """Incrementar referências (atômico); False se o blob foi liberado nesse meio tempo"""
+    updated = SlideBlob.query.filter(SlideBlob.id == blob.id, SlideBlob.ref_count > 0) \
+        .update({SlideBlob.ref_count: SlideBlob.ref_count + 1}, synchronize_session=False)
+    return updated == 1
+
+def copy_slide_metadata(slide: Slide, reference: Slide):
+    """Copiar metadados extraídos de outra lâmina com o mesmo conteúdo"""
+    for field in SLIDE_METADATA_FIELDS:
+        setattr(slide, field, getattr(reference, field))
+
+def store_blob(slide: Slide, extension: str) -> Dict:
+    """Guardar o arquivo da lâmina como blob, ou reaproveitar um blob existente
+
+    O arquivo montado é movido para o caminho do blob; se o conteúdo já
+    existe, a cópia nova é removida e a lâmina passa a apontar para o blob.
+    O registro só é reaproveitado quando não tem referências; um blob em uso
+    é adquirido (ou a ingestão falha e pode ser repetida).
+    """
+    existing = SlideBlob.query.filter_by(content_hash=slide.content_hash).first()
+    if existing is not None and existing.file_path == slide.file_path:
+        # Lâmina já aponta para o blob (nova tentativa do estágio)
+        return {'deduplicated': False, 'blob': slide.file_path}
+
+    if not DEDUP_ENABLED:
+        # Sem compartilhamento: a lâmina mantém o próprio arquivo
+        return {'deduplicated': False, 'blob': None}
+
+    blob, reference = find_blob(slide.content_hash)
+    if blob is not None and acquire_blob(blob):
+        os.remove(slide.file_path)
+        slide.file_path = blob.file_path
+        copy_slide_metadata(slide, reference)
+        return {'deduplicated': True, 'blob': blob.file_path, 'reference_slide_id': reference.id}
+
+    blob_path = get_blob_path(os.path.dirname(slide.file_path), slide.content_hash, extension)
+    if existing is None:
+        db.session.add(SlideBlob(content_hash=slide.content_hash, file_path=blob_path,
+                                 file_size=slide.file_size, ref_count=1))
+    elif existing.ref_count > 0 and os.path.exists(existing.file_path):
+        # Blob em uso sem lâmina pronta (ex.: outra ingestão do mesmo conteúdo
+        # em andamento): compartilhar o arquivo, sem copiar metadados
+        if not acquire_blob(existing):
+            raise RuntimeError("Blob liberado durante a ingestão; tente novamente")
+        os.remove(slide.file_path)
+        slide.file_path = existing.file_path
+        return {'deduplicated': False, 'blob': existing.file_path, 'shared': True}
+    elif existing.ref_count > 0:
+        # Arquivo do blob sumiu, mas há lâminas apontando para ele: restaurar
+        # no mesmo caminho, mantendo as referências
+        blob_path = existing.file_path
+        if not acquire_blob(existing):
+            raise RuntimeError("Blob liberado durante a ingestão; tente novamente")
+    else:
+        # Blob sem referências: reaproveitar o registro, desde que ninguém o
+        # tenha adquirido ou removido nesse meio tempo
+        updated = SlideBlob.query.filter(SlideBlob.id == existing.id, SlideBlob.ref_count <= 0) \
+            .update({SlideBlob.file_path: blob_path, SlideBlob.ref_count: 1}, synchronize_session=False)
+        if updated != 1:
+            raise RuntimeError("Blob alterado durante a ingestão; tente novamente")
+    # Registro gravado antes de mover: ingestões concorrentes do mesmo conteúdo
+    # falham aqui (chave única) e reaproveitam o blob na nova tentativa
+    db.session.flush()
+
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    os.replace(slide.file_path, blob_path)
+    slide.file_path = blob_path
+
+    return {'deduplicated': False, 'blob': blob_path}
+
+def release_slide_blob(slide: Slide) -> bool:
+    """Liberar a referência da lâmina ao blob (usar ao excluir a lâmina)
+
+    Remove arquivo e derivados quando não restam referências. Retorna False
+    se a lâmina não usa blob (lâminas antigas: o arquivo é da própria lâmina).
+    """
+    if not slide.content_hash:
+        return False
+
+    blob = SlideBlob.query.filter_by(content_hash=slide.content_hash).first()
+    if blob is None or blob.file_path != slide.file_path:
+        return False
+
+    blob_id, blob_path = blob.id, blob.file_path
+    SlideBlob.query.filter(SlideBlob.id == blob_id, SlideBlob.ref_count > 0) \
+        .update({SlideBlob.ref_count: SlideBlob.ref_count - 1}, synchronize_session=False)
+
+    # Só remove se ninguém adquiriu o blob entre o decremento e a exclusão
+    deleted = SlideBlob.query.filter(SlideBlob.id == blob_id, SlideBlob.ref_count <= 0) \
+        .delete(synchronize_session=False)
+    if deleted:
+        if os.path.exists(blob_path):
+            os.remove(blob_path)
+        shutil.rmtree(get_derived_dir(blob_path), ignore_errors=True)
+
+    return True
+
+def _challenge_serializer() -> URLSafeTimedSerializer:
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='upload-dedup')
+
+def create_dedup_challenge(blob: SlideBlob, user_id: int, filename: str) -> Dict:
+    """Desafio de posse: o cliente envia o SHA-256 de um trecho aleatório do arquivo
+
+    Evita que alguém que conheça apenas o hash obtenha acesso à lâmina.
+    """
+    length = min(DEDUP_CHALLENGE_SIZE, blob.file_size)
+    offset = secrets.randbelow(blob.file_size - length + 1)
+
+    token = _challenge_serializer().dumps({
+        'h': blob.content_hash, 'u': user_id, 'f': filename, 'o': offset, 'l': length
+    })
+    return {'token': token, 'offset': offset, 'length': length}
+
+def verify_dedup_challenge(token: str, range_hash: str, user_id: int) -> Tuple[Dict, SlideBlob, Slide]:
+    """Validar resposta ao desafio; retorna (dados do desafio, blob, lâmina de referência)"""
+    try:
+        challenge = _challenge_serializer().loads(token, max_age=DEDUP_CHALLENGE_MAX_AGE)
+    except SignatureExpired:
+        raise ValueError("Desafio expirado; inicie o upload novamente")
+    except BadSignature:
+        raise ValueError("Desafio inválido")
+
+    if challenge['u'] != user_id:
+        raise ValueError("Desafio inválido")
+
+    blob, reference = find_blob(challenge['h'])
+    if blob is None:
+        raise LookupError("Arquivo não está mais disponível; envie o arquivo normalmente")
+
+    with open(blob.file_path, 'rb') as f:
+        f.seek(challenge['o'])
+        expected = hashlib.sha256(f.read(challenge['l'])).hexdigest()
+
+    if not range_hash or range_hash.lower() != expected:
+        raise ValueError("Resposta ao desafio não confere")
+
+    return challenge, blob, reference
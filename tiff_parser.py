@@ -0,0 +1,214 @@
+import struct
+from typing import Callable, Dict, List, Optional
+
+# Tags usadas na validação estrutural
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+
+# Tamanho em bytes de cada tipo TIFF
+TYPE_SIZES = {
+    1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4,
+    10: 8, 11: 4, 12: 8, 13: 4, 16: 8, 17: 8, 18: 8
+}
+
+# Tipos inteiros e formato struct correspondente
+INTEGER_FORMATS = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 13: 'I', 16: 'Q', 17: 'q', 18: 'Q'}
+
+# Compressões que o OpenSlide decodifica
+COMPRESSION_NAMES = {
+    1: 'none',
+    5: 'lzw',
+    7: 'jpeg',
+    8: 'deflate',
+    32946: 'deflate',
+    33003: 'jpeg2000',  # Aperio YCbCr
+    33005: 'jpeg2000',  # Aperio RGB
+}
+
+# Limite de diretórios percorridos (protege contra cadeias enormes ou cíclicas)
+MAX_IFDS = 64
+
+class TiffNeedMoreData(Exception):
+    """Trecho necessário para continuar a análise ainda não está disponível"""
+
+    def __init__(self, offset: int, length: int):
+        super().__init__(f'Dados necessários em {offset} (+{length} bytes)')
+        self.offset = offset
+        self.length = length
+
+class TiffFormatError(ValueError):
+    """Estrutura TIFF inválida"""
+    pass
+
+def buffer_reader(data: bytes) -> Callable[[int, int], bytes]:
+    """Leitor sobre um buffer com o início do arquivo"""
+    def read_at(offset: int, length: int) -> bytes:
+        if offset + length > len(data):
+            raise TiffNeedMoreData(offset, length)
+        return data[offset:offset + length]
+    return read_at
+
+def parse_tiff_structure(read_at: Callable[[int, int], bytes], max_ifds: int = MAX_IFDS) -> Dict:
+    """Ler cabeçalho e cadeia de IFDs de um TIFF/BigTIFF
+
+    read_at(offset, length) retorna bytes ou levanta TiffNeedMoreData quando o
+    trecho ainda não chegou. Nesse caso a análise para e o resultado parcial
+    informa pending_offset: basta chamar de novo quando esse trecho existir.
+    """
+    header = read_at(0, 8)
+    if header[:2] == b'II':
+        order = '<'
+    elif header[:2] == b'MM':
+        order = '>'
+    else:
+        raise TiffFormatError('Arquivo não é um TIFF válido')
+
+    version = struct.unpack(order + 'H', header[2:4])[0]
+    if version == 42:
+        bigtiff = False
+        first_ifd = struct.unpack(order + 'I', header[4:8])[0]
+    elif version == 43:
+        bigtiff = True
+        offset_size, reserved = struct.unpack(order + 'HH', header[4:8])
+        if offset_size != 8 or reserved != 0:
+            raise TiffFormatError('Cabeçalho BigTIFF inválido')
+        first_ifd = struct.unpack(order + 'Q', read_at(8, 8))[0]
+    else:
+        raise TiffFormatError(f'Versão TIFF desconhecida: {version}')
+
+    result = {
+        'byte_order': 'little' if order == '<' else 'big',
+        'bigtiff': bigtiff,
+        'ifds': [],
+        'complete': False,
+        'pending_offset': None,
+        'pending_length': None
+    }
+
+    visited = set()
+    ifd_offset = first_ifd
+    try:
+        while ifd_offset:
+            if ifd_offset in visited:
+                raise TiffFormatError('Cadeia de IFDs cíclica')
+            if len(visited) >= max_ifds:
+                raise TiffFormatError(f'Mais de {max_ifds} IFDs')
+            visited.add(ifd_offset)
+
+            ifd, ifd_offset = _parse_ifd(read_at, ifd_offset, order, bigtiff)
+            result['ifds'].append(ifd)
+
+        result['complete'] = True
+    except TiffNeedMoreData as e:
+        if not result['ifds'] and e.offset < 16:
+            raise
+        result['pending_offset'] = e.offset
+        result['pending_length'] = e.length
+
+    result['levels'] = [
+        {'width': ifd['width'], 'height': ifd['height'],
+         'tile_width': ifd['tile_width'], 'tile_height': ifd['tile_height'],
+         'compression': ifd['compression_name']}
+        for ifd in result['ifds'] if ifd['tiled']
+    ]
+    return result
+
+def _parse_ifd(read_at, offset: int, order: str, bigtiff: bool):
+    """Ler um IFD; retorna (informações, offset do próximo IFD)"""
+    if bigtiff:
+        count_size, entry_size, next_format, next_size = 8, 20, 'Q', 8
+    else:
+        count_size, entry_size, next_format, next_size = 2, 12, 'I', 4
+
+    count = struct.unpack(order + ('Q' if bigtiff else 'H'), read_at(offset, count_size))[0]
+    if count == 0 or count > 4096:
+        raise TiffFormatError(f'IFD em {offset} com {count} entradas')
+
+    entries_data = read_at(offset + count_size, count * entry_size + next_size)
+    value_size = 8 if bigtiff else 4
+
+    tags = {}
+    for i in range(count):
+        entry = entries_data[i * entry_size:(i + 1) * entry_size]
+        tag, tag_type = struct.unpack(order + 'HH', entry[:4])
+        value_count = struct.unpack(order + ('Q' if bigtiff else 'I'), entry[4:4 + value_size])[0]
+        value_field = entry[4 + value_size:]
+
+        value = None
+        type_size = TYPE_SIZES.get(tag_type)
+        # Apenas valores escalares armazenados no próprio IFD são decodificados
+        if tag_type in INTEGER_FORMATS and type_size * value_count <= value_size and value_count >= 1:
+            value = struct.unpack(order + INTEGER_FORMATS[tag_type], value_field[:type_size])[0]
+        tags[tag] = {'value': value, 'count': value_count}
+
+    next_ifd = struct.unpack(order + next_format, entries_data[count * entry_size:])[0]
+
+    def value(tag, default=None):
+        return tags[tag]['value'] if tag in tags and tags[tag]['value'] is not None else default
+
+    compression = value(TAG_COMPRESSION, 1)
+    tiled = TAG_TILE_WIDTH in tags and TAG_TILE_OFFSETS in tags
+
+    ifd = {
+        'offset': offset,
+        'width': value(TAG_IMAGE_WIDTH),
+        'height': value(TAG_IMAGE_LENGTH),
+        'tiled': tiled,
+        'tile_width': value(TAG_TILE_WIDTH) if tiled else None,
+        'tile_height': value(TAG_TILE_LENGTH) if tiled else None,
+        'tile_count': tags[TAG_TILE_OFFSETS]['count'] if tiled else None,
+        'compression': compression,
+        'compression_name': COMPRESSION_NAMES.get(compression, f'unknown ({compression})'),
+        'samples_per_pixel': value(TAG_SAMPLES_PER_PIXEL, 1),
+        'photometric': value(TAG_PHOTOMETRIC),
+        'reduced_resolution': bool(value(TAG_NEW_SUBFILE_TYPE, 0) & 1),
+        'has_strips': TAG_STRIP_OFFSETS in tags
+    }
+    return ifd, next_ifd
+
+def validate_tiff_structure(info: Dict, require_tiled: bool = True) -> Optional[str]:
+    """Verificar se a estrutura é utilizável como lâmina; retorna erro ou None
+
+    A decisão usa apenas o primeiro IFD (nível 0), que em geral está no início
+    do arquivo; os demais níveis são informativos.
+    """
+    if not info['ifds']:
+        return None
+
+    base = info['ifds'][0]
+    if not base['width'] or not base['height']:
+        return 'Dimensões do nível 0 inválidas'
+
+    if require_tiled and not base['tiled']:
+        return 'TIFF não é organizado em tiles (não piramidal); converta para TIFF tiled/piramidal'
+
+    if base['compression'] not in COMPRESSION_NAMES:
+        return f"Compressão não suportada: {base['compression_name']}"
+
+    if base['tiled'] and (not base['tile_width'] or not base['tile_height']):
+        return 'Tamanho de tile inválido'
+
+    return None
+
+def summarize_tiff_structure(info: Dict) -> Dict:
+    """Resumo para respostas da API (níveis, tiles, compressão)"""
+    base = info['ifds'][0] if info['ifds'] else {}
+    return {
+        'bigtiff': info['bigtiff'],
+        'byte_order': info['byte_order'],
+        'width': base.get('width'),
+        'height': base.get('height'),
+        'tiled': base.get('tiled'),
+        'compression': base.get('compression_name'),
+        'levels': info['levels'],
+        'ifd_count': len(info['ifds']),
+        'complete': info['complete']
+    }
@@ -5,7 +5,14 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from src.models.user import User
 from src.models.slide import Slide, db
 from src.utils.file_upload import ChunkedUploadManager, UploadProgressTracker
-from src.utils.slide_processor import SlideProcessor
+from src.utils.slide_storage import (
+    copy_slide_metadata, acquire_blob, create_dedup_challenge, find_blob,
+    is_content_hash, verify_dedup_challenge
+)
+from src.utils.ingest_pipeline import (
+    INGEST_STAGES, claim_ingest, create_ingest_stages, get_ingest_stages, get_resume_stage, ingest_pool,
+    is_ingest_running
+)
 
 upload_bp = Blueprint('upload', __name__)
 
@@ -13,11 +20,22 @@ upload_bp = Blueprint('upload', __name__)
 upload_manager = ChunkedUploadManager()
 progress_tracker = UploadProgressTracker()
 
+# Bytes lidos em /upload/validate para analisar a estrutura TIFF
+VALIDATE_HEADER_SIZE = 1024 * 1024
+
 def get_current_user():
     """Obter usuário atual autenticado"""
     current_user_id = get_jwt_identity()
     return User.query.get(current_user_id) if current_user_id else None
 
+def _parse_throughput(value):
+    """Throughput informado pelo cliente (bytes/s); ignorado se inválido"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
 @upload_bp.route('/upload/init', methods=['POST'])
 @jwt_required()
 def init_upload():
@@ -34,12 +52,24 @@ def init_upload():
         if not data.get(field):
             return jsonify({'error': f'Campo {field} é obrigatório'}), 400
     
+    # Conteúdo já armazenado: dispensar o upload após prova de posse (ver /upload/link)
+    file_hash = data.get('file_hash')
+    if is_content_hash(file_hash) and data.get('deduplicate', True):
+        blob, _ = find_blob(file_hash)
+        if blob is not None:
+            return jsonify({
+                'status': 'duplicate',
+                'content_hash': blob.content_hash,
+                'dedup_challenge': create_dedup_challenge(blob, current_user.id, data['filename'])
+            }), 200
+    
     try:
         # Inicializar upload
         metadata = upload_manager.init_upload(
             filename=data['filename'],
             file_size=data['file_size'],
-            file_hash=data.get('file_hash')
+            file_hash=data.get('file_hash'),
+            client_throughput=_parse_throughput(data.get('client_throughput'))
         )
         
         # Iniciar rastreamento de progresso
@@ -49,6 +79,8 @@ def init_upload():
             'upload_id': metadata['upload_id'],
             'chunk_size': metadata['chunk_size'],
             'total_chunks': metadata['total_chunks'],
+            'hash_algorithm': metadata['hash_algorithm'],
+            'max_parallel_chunks': metadata['max_parallel_chunks'],
             'status': 'initialized'
         }), 201
         
@@ -57,6 +89,55 @@ def init_upload():
     except Exception as e:
         return jsonify({'error': f'Erro ao inicializar upload: {str(e)}'}), 500
 
+@upload_bp.route('/upload/link', methods=['POST'])
+@jwt_required()
+def link_duplicate():
+    """Criar lâmina a partir de conteúdo já armazenado (resposta ao desafio do init)"""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({'error': 'Usuário não encontrado'}), 404
+    
+    data = request.json or {}
+    
+    try:
+        challenge, blob, reference = verify_dedup_challenge(
+            data.get('token'), data.get('range_hash'), current_user.id
+        )
+        
+        if not acquire_blob(blob):
+            raise LookupError("Arquivo não está mais disponível; envie o arquivo normalmente")
+        
+        # Nova lâmina aponta para o mesmo blob (arquivo, metadados e derivados)
+        slide = Slide(
+            filename=os.path.basename(blob.file_path),
+            original_filename=challenge['f'],
+            file_path=blob.file_path,
+            file_size=blob.file_size,
+            content_hash=blob.content_hash,
+            uploaded_by=current_user.id,
+            status='ready'
+        )
+        copy_slide_metadata(slide, reference)
+        
+        db.session.add(slide)
+        db.session.commit()
+        
+        return jsonify({
+            'message': 'Upload completado com sucesso',
+            'slide': slide.to_dict(),
+            'deduplicated': True,
+            'file_size': blob.file_size
+        }), 201
+        
+    except LookupError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Erro ao reaproveitar arquivo: {str(e)}'}), 500
+
 @upload_bp.route('/upload/<upload_id>/chunk/<int:chunk_index>', methods=['POST'])
 @jwt_required()
 def upload_chunk(upload_id, chunk_index):
@@ -65,22 +146,32 @@ def upload_chunk(upload_id, chunk_index):
     if not current_user:
         return jsonify({'error': 'Usuário não encontrado'}), 404
     
-    if 'chunk' not in request.files:
+    # Corpo binário é gravado direto no arquivo de destino, sem passar pela memória;
+    # multipart (campo 'chunk') continua aceito por compatibilidade
+    if request.mimetype == 'application/octet-stream':
+        chunk_stream = request.stream
+    elif 'chunk' in request.files:
+        chunk_stream = request.files['chunk'].stream
+    else:
         return jsonify({'error': 'Chunk não encontrado'}), 400
     
-    chunk_file = request.files['chunk']
-    chunk_data = chunk_file.read()
-    
     try:
         # Upload do chunk
-        result = upload_manager.upload_chunk(upload_id, chunk_index, chunk_data)
+        result = upload_manager.upload_chunk(
+            upload_id, chunk_index, chunk_stream,
+            chunk_hash=request.headers.get('X-Chunk-SHA256') or request.form.get('chunk_hash')
+        )
         
         # Atualizar progresso
-        progress_tracker.update_progress(upload_id, len(chunk_data))
+        progress_tracker.update_progress(upload_id, result['bytes_written'])
         
         return jsonify(result), 200
         
     except ValueError as e:
+        # Estrutura inválida detectada nos primeiros chunks: o cliente deve parar
+        if upload_manager.get_upload_status(upload_id).get('status') == 'rejected':
+            progress_tracker.finish_tracking(upload_id)
+            return jsonify({'error': str(e), 'status': 'rejected'}), 422
         return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': f'Erro no upload do chunk: {str(e)}'}), 500
@@ -88,7 +179,12 @@ def upload_chunk(upload_id, chunk_index):
 @upload_bp.route('/upload/<upload_id>/complete', methods=['POST'])
 @jwt_required()
 def complete_upload(upload_id):
-    """Completar upload e processar arquivo"""
+    """Completar upload e agendar processamento do arquivo
+    
+    Retorna 202 com a lâmina em 'processing'; montagem, verificação,
+    validação, metadados e derivados rodam em segundo plano
+    (ver /upload/<upload_id>/ingest).
+    """
     current_user = get_current_user()
     if not current_user:
         return jsonify({'error': 'Usuário não encontrado'}), 404
@@ -100,6 +196,10 @@ def complete_upload(upload_id):
         if status['status'] != 'ready_for_assembly':
             return jsonify({'error': 'Upload não está pronto para montagem'}), 400
         
+        # Apenas uma chamada de complete cria a lâmina
+        if not upload_manager.claim_for_ingest(upload_id):
+            return jsonify({'error': 'Upload não está pronto para montagem'}), 400
+        
         # Gerar nome único para o arquivo final
         file_extension = os.path.splitext(status['filename'])[1]
         unique_filename = f"{uuid.uuid4()}{file_extension}"
@@ -109,59 +209,116 @@ def complete_upload(upload_id):
         os.makedirs(upload_path, exist_ok=True)
         output_path = os.path.join(upload_path, unique_filename)
         
-        # Montar arquivo
-        assembly_result = upload_manager.assemble_file(upload_id, output_path)
-        
-        # Processar metadados da lâmina
-        processor = SlideProcessor()
-        
-        # Validar arquivo primeiro
-        with open(output_path, 'rb') as f:
-            file_header = f.read(1024)  # Ler primeiro KB para validação
-        
-        validation = upload_manager.validate_file_format(status['filename'], file_header)
-        if not validation['valid']:
-            os.remove(output_path)
-            return jsonify({'error': validation['error']}), 400
-        
-        # Extrair metadados
-        slide_metadata = processor.extract_metadata(output_path)
-        
-        # Criar registro no banco de dados
-        slide = Slide(
-            filename=unique_filename,
-            original_filename=status['filename'],
-            file_path=output_path,
-            file_size=assembly_result['file_size'],
-            scanner_type=slide_metadata.get('scanner_type'),
-            stain_type=slide_metadata.get('stain_type'),
-            width=slide_metadata.get('width'),
-            height=slide_metadata.get('height'),
-            levels=slide_metadata.get('levels'),
-            mpp_x=slide_metadata.get('mpp_x'),
-            mpp_y=slide_metadata.get('mpp_y'),
-            uploaded_by=current_user.id,
-            status='ready'
-        )
-        
-        db.session.add(slide)
-        db.session.commit()
-        
-        # Finalizar rastreamento
+        try:
+            # Criar registro no banco de dados (metadados preenchidos pela ingestão)
+            slide = Slide(
+                filename=unique_filename,
+                original_filename=status['filename'],
+                file_path=output_path,
+                file_size=status['file_size'],
+                uploaded_by=current_user.id,
+                status='processing'
+            )
+            
+            db.session.add(slide)
+            db.session.flush()
+            create_ingest_stages(slide, upload_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            upload_manager.store.transition_status(upload_id, 'queued', 'ready_for_assembly')
+            raise
+        
+        # Finalizar rastreamento (transferência concluída)
         progress_tracker.finish_tracking(upload_id)
         
+        ingest_pool.submit(current_app._get_current_object(), slide.id, upload_manager)
+        
         return jsonify({
-            'message': 'Upload completado com sucesso',
+            'message': 'Upload recebido; processamento em andamento',
             'slide': slide.to_dict(),
             'upload_id': upload_id,
-            'file_size': assembly_result['file_size']
-        }), 201
+            'file_size': status['file_size'],
+            'ingest_url': f'/api/upload/{upload_id}/ingest'
+        }), 202
         
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': f'Erro ao completar upload: {str(e)}'}), 500
 
+def _get_ingest(upload_id):
+    """Carregar estágios de ingestão verificando acesso; retorna (lâmina, estágios, erro)"""
+    current_user = get_current_user()
+    if not current_user:
+        return None, None, (jsonify({'error': 'Usuário não encontrado'}), 404)
+    
+    stages = get_ingest_stages(upload_id)
+    if not stages:
+        return None, None, (jsonify({'error': 'Ingestão não encontrada'}), 404)
+    
+    slide = stages[0].slide
+    if not current_user.can_access_slide(slide):
+        return None, None, (jsonify({'error': 'Acesso negado'}), 403)
+    
+    return slide, stages, None
+
+@upload_bp.route('/upload/<upload_id>/ingest', methods=['GET'])
+@jwt_required()
+def get_ingest_status(upload_id):
+    """Obter status de cada estágio da ingestão"""
+    slide, stages, error = _get_ingest(upload_id)
+    if error:
+        return error
+    
+    # Retomar ingestões órfãs (worker reciclado/encerrado sem heartbeat)
+    if slide.status == 'processing' and not is_ingest_running(stages):
+        ingest_pool.recover_stale(current_app._get_current_object(), upload_manager)
+        db.session.refresh(slide)
+        stages = get_ingest_stages(upload_id)
+    
+    return jsonify({
+        'upload_id': upload_id,
+        'status': slide.status,
+        'slide': slide.to_dict(),
+        'stages': [stage.to_dict() for stage in stages]
+    }), 200
+
+@upload_bp.route('/upload/<upload_id>/ingest/retry', methods=['POST'])
+@jwt_required()
+def retry_ingest(upload_id):
+    """Reexecutar ingestão a partir de um estágio (padrão: o que falhou)"""
+    slide, stages, error = _get_ingest(upload_id)
+    if error:
+        return error
+    
+    if is_ingest_running(stages):
+        return jsonify({'error': 'Ingestão em andamento'}), 409
+    
+    data = request.get_json(silent=True) or {}
+    stage_name = data.get('stage')
+    
+    if stage_name is None:
+        # Falhou ou foi interrompido; numa ingestão órfã, o primeiro pendente
+        stage_name = get_resume_stage(stages)
+        if stage_name is None or (slide.status != 'processing' and
+                                  not any(stage.status in ('failed', 'running') for stage in stages)):
+            return jsonify({'error': 'Nenhum estágio com falha'}), 400
+    elif stage_name not in INGEST_STAGES:
+        return jsonify({'error': f'Estágio inválido. Opções: {", ".join(INGEST_STAGES)}'}), 400
+    
+    # Reserva atômica: outra requisição ou a retomada automática pode ter assumido
+    if not claim_ingest(slide, stages):
+        return jsonify({'error': 'Ingestão em andamento'}), 409
+    
+    ingest_pool.submit(current_app._get_current_object(), slide.id, upload_manager, start_stage=stage_name)
+    
+    return jsonify({
+        'message': f'Ingestão reagendada a partir de {stage_name}',
+        'upload_id': upload_id,
+        'slide': slide.to_dict()
+    }), 202
+
 @upload_bp.route('/upload/<upload_id>/status', methods=['GET'])
 @jwt_required()
 def get_upload_status(upload_id):
@@ -179,7 +336,7 @@ def get_upload_status(upload_id):
         
         # Combinar informações
         result = {**upload_status}
-        if progress['status'] != 'not_found':
+        if progress.get('status') != 'not_found':
             result.update({
                 'real_time_progress': progress['progress_percent'],
                 'upload_speed': progress['speed'],
@@ -203,9 +360,11 @@ def resume_upload(upload_id):
     try:
         result = upload_manager.resume_upload(upload_id)
         
-        # Reiniciar rastreamento se necessário
-        if result['status'] in ['uploading', 'initialized']:
-            progress_tracker.start_tracking(upload_id, result['file_size'])
+        # Reiniciar rastreamento se necessário (estado compartilhado pode já existir)
+        if (result['status'] in ['uploading', 'initialized'] and
+                progress_tracker.get_progress(upload_id).get('status') == 'not_found'):
+            uploaded_size = result['file_size'] * result['uploaded_chunks'] // max(result['total_chunks'], 1)
+            progress_tracker.start_tracking(upload_id, result['file_size'], uploaded_size)
         
         return jsonify(result), 200
         
@@ -243,8 +402,8 @@ def cleanup_uploads():
         return jsonify({'error': 'Permissão insuficiente'}), 403
     
     try:
-        upload_manager.cleanup_orphaned_uploads()
-        return jsonify({'message': 'Limpeza realizada com sucesso'}), 200
+        result = upload_manager.cleanup_orphaned_uploads()
+        return jsonify({'message': 'Limpeza realizada com sucesso', **result}), 200
         
     except Exception as e:
         return jsonify({'error': f'Erro na limpeza: {str(e)}'}), 500
@@ -262,19 +421,29 @@ def validate_file():
     
     file = request.files['file']
     
-    # Ler apenas o cabeçalho para validação
-    file_header = file.read(1024)
+    # Ler o início do arquivo: cabeçalho e, em geral, os primeiros IFDs
+    file_header = file.read(VALIDATE_HEADER_SIZE)
     file.seek(0)  # Resetar posição
     
     try:
         validation = upload_manager.validate_file_format(file.filename, file_header)
         
-        return jsonify({
+        response = {
             'valid': validation['valid'],
             'error': validation.get('error'),
             'detected_format': validation.get('detected_format'),
             'extension': validation.get('extension')
-        }), 200
+        }
+        
+        if validation['valid']:
+            structure = upload_manager.inspect_structure(file.filename, file_header)
+            if structure.get('error'):
+                response['valid'] = False
+                response['error'] = structure['error']
+            response['tiff'] = structure.get('structure')
+            response['needs_more_data'] = structure.get('needs_more_data')
+        
+        return jsonify(response), 200
         
     except Exception as e:
         return jsonify({'error': f'Erro na validação: {str(e)}'}), 500
@@ -292,8 +461,8 @@ def get_upload_stats():
         total_slides = Slide.query.count()
         total_size = db.session.query(db.func.sum(Slide.file_size)).scalar() or 0
         
-        # Uploads ativos
-        active_uploads = len(progress_tracker.active_uploads)
+        # Uploads ativos (compartilhado entre workers)
+        upload_stats = progress_tracker.get_stats()
         
         # Estatísticas por usuário
         user_stats = db.session.query(
@@ -305,7 +474,9 @@ def get_upload_stats():
         return jsonify({
             'total_slides': total_slides,
             'total_size': total_size,
-            'active_uploads': active_uploads,
+            'active_uploads': upload_stats['active_uploads'],
+            'upload_throughput': upload_stats['total_speed'],
+            'upload_storage': upload_manager.get_disk_usage(),
             'user_stats': [
                 {
                     'username': stat.username,
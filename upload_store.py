@@ -0,0 +1,332 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Estado das sessões de upload fica junto dos dados parciais (mesmo disco/nó),
+# independente do banco principal da aplicação
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    upload_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    file_hash TEXT,
+    total_chunks INTEGER NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    hash_algorithm TEXT,
+    status TEXT NOT NULL,
+    uploaded_count INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    completed_at REAL,
+    output_path TEXT,
+    content_hash TEXT,
+    format_status TEXT,
+    format_info TEXT,
+    format_pending_offset INTEGER,
+    format_pending_length INTEGER,
+    expires_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS chunks (
+    upload_id TEXT NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    leaves BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (upload_id, chunk_index)
+) WITHOUT ROWID;
+"""
+
+SESSION_FIELDS = [
+    'upload_id', 'filename', 'file_size', 'file_hash', 'total_chunks', 'chunk_size',
+    'hash_algorithm', 'status', 'uploaded_count', 'created_at', 'updated_at',
+    'completed_at', 'output_path', 'content_hash', 'format_status', 'format_info',
+    'format_pending_offset', 'format_pending_length', 'expires_at'
+]
+
+# Colunas adicionadas depois da criação da tabela (bancos já existentes)
+SESSION_MIGRATIONS = [
+    ('format_status', 'TEXT'),
+    ('format_info', 'TEXT'),
+    ('format_pending_offset', 'INTEGER'),
+    ('format_pending_length', 'INTEGER'),
+    ('expires_at', 'REAL')
+]
+
+# Criados depois das migrações (podem depender de colunas novas)
+SESSION_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)'
+]
+
+# Status em que a sessão ainda recebe chunks
+ACCEPTING_STATUSES = ('initialized', 'uploading', 'ready_for_assembly')
+
+DIGEST_SIZE = 32  # SHA-256
+
+class UploadSessionStore:
+    """Sessões de upload em SQLite (WAL), com registro atômico de chunks
+
+    expiry mapeia status -> segundos até a sessão expirar (None: não expira).
+    expires_at é recalculado a cada troca de status e a cada chunk registrado,
+    e o índice sobre ele permite remover apenas as sessões vencidas.
+    """
+
+    def __init__(self, db_path: str, timeout: float = 30.0,
+                 expiry: Optional[Dict[str, Optional[float]]] = None):
+        self.db_path = db_path
+        self.timeout = timeout
+        self.expiry = expiry or {}
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Conexão por thread (sqlite3 não compartilha conexões entre threads)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+
+        # isolation_level=None: transações explícitas com BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+
+        with self._schema_lock:
+            if not self._schema_ready:
+                conn.executescript(SCHEMA)
+                self._migrate(conn)
+                self._schema_ready = True
+
+        self._local.conn = conn
+        return conn
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """Adicionar colunas novas em bancos criados por versões anteriores"""
+        existing = {row[1] for row in conn.execute('PRAGMA table_info(sessions)')}
+        for column, column_type in SESSION_MIGRATIONS:
+            if column not in existing:
+                try:
+                    conn.execute(f'ALTER TABLE sessions ADD COLUMN {column} {column_type}')
+                except sqlite3.OperationalError:
+                    # Outro processo adicionou a coluna ao mesmo tempo
+                    pass
+
+        for statement in SESSION_INDEXES:
+            conn.execute(statement)
+
+        # Sessões anteriores ao índice de expiração passam a expirar pela política atual
+        for status, ttl in self.expiry.items():
+            if ttl is not None:
+                conn.execute(
+                    'UPDATE sessions SET expires_at = updated_at + ? '
+                    'WHERE expires_at IS NULL AND status = ?', (ttl, status)
+                )
+
+    def _expires_at(self, status: str, now: float) -> Optional[float]:
+        ttl = self.expiry.get(status)
+        return now + ttl if ttl is not None else None
+
+    def _row_to_dict(self, row: sqlite3.Row) -> Dict:
+        return {field: row[field] for field in SESSION_FIELDS}
+
+    def create_session(self, session: Dict) -> Dict:
+        """Registrar nova sessão de upload"""
+        now = time.time()
+        values = {field: session.get(field) for field in SESSION_FIELDS}
+        values['uploaded_count'] = 0
+        values['created_at'] = session.get('created_at', now)
+        values['updated_at'] = now
+        if values['expires_at'] is None:
+            values['expires_at'] = self._expires_at(values['status'], now)
+
+        conn = self._connect()
+        conn.execute(
+            f"INSERT INTO sessions ({', '.join(SESSION_FIELDS)}) "
+            f"VALUES ({', '.join('?' for _ in SESSION_FIELDS)})",
+            [values[field] for field in SESSION_FIELDS]
+        )
+        return values
+
+    def get_session(self, upload_id: str) -> Optional[Dict]:
+        """Obter sessão (None se não existir)"""
+        row = self._connect().execute(
+            'SELECT * FROM sessions WHERE upload_id = ?', (upload_id,)
+        ).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def has_chunk(self, upload_id: str, chunk_index: int) -> bool:
+        """Verificar se o chunk já foi registrado (busca pela chave primária)"""
+        row = self._connect().execute(
+            'SELECT 1 FROM chunks WHERE upload_id = ? AND chunk_index = ?',
+            (upload_id, chunk_index)
+        ).fetchone()
+        return row is not None
+
+    def mark_chunk(self, upload_id: str, chunk_index: int, sha256: str,
+                   leaf_digests: List[bytes], size: int) -> Tuple[bool, Dict]:
+        """Registrar chunk gravado e atualizar contador/status na mesma transação
+
+        Retorna (inserido, sessão). Se o chunk já estava registrado (envio
+        duplicado ou concorrente), inserido é False e o contador não muda.
+        Cada chunk registrado adia a expiração da sessão.
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Sessão pode ter sido cancelada ou expirada durante a escrita do chunk
+            row = conn.execute(
+                'SELECT status FROM sessions WHERE upload_id = ?', (upload_id,)
+            ).fetchone()
+            if row is None or row['status'] not in ACCEPTING_STATUSES:
+                raise ValueError("Upload não aceita mais chunks")
+
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO chunks (upload_id, chunk_index, sha256, leaves, size) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (upload_id, chunk_index, sha256, b''.join(leaf_digests), size)
+            )
+            inserted = cursor.rowcount == 1
+
+            if inserted:
+                conn.execute(
+                    "UPDATE sessions SET uploaded_count = uploaded_count + 1, "
+                    "status = CASE WHEN uploaded_count + 1 >= total_chunks "
+                    "THEN 'ready_for_assembly' ELSE 'uploading' END, "
+                    "updated_at = ?, expires_at = ? WHERE upload_id = ?",
+                    (now, self._expires_at('uploading', now), upload_id)
+                )
+
+            row = conn.execute(
+                'SELECT * FROM sessions WHERE upload_id = ?', (upload_id,)
+            ).fetchone()
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        return inserted, self._row_to_dict(row)
+
+    def update_session(self, upload_id: str, **fields) -> None:
+        """Atualizar campos da sessão (troca de status recalcula a expiração)"""
+        fields = {key: value for key, value in fields.items() if key in SESSION_FIELDS}
+        fields['updated_at'] = time.time()
+        if 'status' in fields and 'expires_at' not in fields:
+            fields['expires_at'] = self._expires_at(fields['status'], fields['updated_at'])
+
+        assignments = ', '.join(f'{key} = ?' for key in fields)
+        self._connect().execute(
+            f'UPDATE sessions SET {assignments} WHERE upload_id = ?',
+            list(fields.values()) + [upload_id]
+        )
+
+    def transition_status(self, upload_id: str, from_status, to_status: str) -> bool:
+        """Trocar status apenas se ainda for from_status (compare-and-set)
+
+        from_status pode ser um status ou uma tupla de status aceitos.
+        Retorna True se esta chamada efetuou a transição.
+        """
+        if isinstance(from_status, str):
+            from_status = (from_status,)
+
+        now = time.time()
+        placeholders = ', '.join('?' for _ in from_status)
+        cursor = self._connect().execute(
+            f'UPDATE sessions SET status = ?, updated_at = ?, expires_at = ? '
+            f'WHERE upload_id = ? AND status IN ({placeholders})',
+            (to_status, now, self._expires_at(to_status, now), upload_id, *from_status)
+        )
+        return cursor.rowcount == 1
+
+    def uploaded_chunks(self, upload_id: str) -> List[int]:
+        """Índices dos chunks já registrados, em ordem"""
+        rows = self._connect().execute(
+            'SELECT chunk_index FROM chunks WHERE upload_id = ? ORDER BY chunk_index',
+            (upload_id,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def leaf_digests(self, upload_id: str) -> List[Tuple[int, List[bytes]]]:
+        """Digests das folhas por chunk, em ordem de chunk"""
+        rows = self._connect().execute(
+            'SELECT chunk_index, leaves FROM chunks WHERE upload_id = ? ORDER BY chunk_index',
+            (upload_id,)
+        ).fetchall()
+
+        result = []
+        for chunk_index, leaves in rows:
+            leaves = bytes(leaves)
+            result.append((chunk_index, [
+                leaves[i:i + DIGEST_SIZE] for i in range(0, len(leaves), DIGEST_SIZE)
+            ]))
+        return result
+
+    def delete_chunks(self, upload_id: str) -> None:
+        """Remover registros de chunks (a sessão é mantida)"""
+        self._connect().execute('DELETE FROM chunks WHERE upload_id = ?', (upload_id,))
+
+    def delete_session(self, upload_id: str) -> None:
+        """Remover sessão e seus chunks"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM chunks WHERE upload_id = ?', (upload_id,))
+            conn.execute('DELETE FROM sessions WHERE upload_id = ?', (upload_id,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def list_sessions(self, created_before: float = None) -> List[Dict]:
+        """Listar sessões (opcionalmente apenas as criadas antes de um instante)"""
+        if created_before is None:
+            rows = self._connect().execute('SELECT * FROM sessions').fetchall()
+        else:
+            rows = self._connect().execute(
+                'SELECT * FROM sessions WHERE created_at < ?', (created_before,)
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def claim_expired(self, now: float, limit: int, lease: float) -> List[str]:
+        """Reservar até limit sessões vencidas para remoção (busca pelo índice)
+
+        Sessões que ainda recebiam chunks passam a 'expired' (novos chunks são
+        recusados) e a expiração é adiada por lease segundos: outros processos
+        não pegam as mesmas sessões, e se este falhar elas voltam a vencer.
+        """
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT upload_id FROM sessions WHERE expires_at <= ? '
+                'ORDER BY expires_at LIMIT ?', (now, limit)
+            ).fetchall()
+            upload_ids = [row[0] for row in rows]
+
+            if upload_ids:
+                placeholders = ', '.join('?' for _ in upload_ids)
+                accepting = ', '.join('?' for _ in ACCEPTING_STATUSES)
+                conn.execute(
+                    f"UPDATE sessions SET status = CASE WHEN status IN ({accepting}) "
+                    f"THEN 'expired' ELSE status END, expires_at = ? "
+                    f"WHERE upload_id IN ({placeholders})",
+                    (*ACCEPTING_STATUSES, now + lease, *upload_ids)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        return upload_ids
+
+    def usage_by_status(self) -> Dict[str, Dict]:
+        """Quantidade de sessões e bytes declarados por status"""
+        rows = self._connect().execute(
+            'SELECT status, COUNT(*), COALESCE(SUM(file_size), 0) FROM sessions GROUP BY status'
+        ).fetchall()
+        return {row[0]: {'sessions': row[1], 'bytes': row[2]} for row in rows}